@@ -0,0 +1,85 @@
+"""
+Benchmark do Modo Entregador: guloso antigo vs delivery.py (2-opt/Or-opt)
+
+Uso:
+    python bench_delivery.py [--budget 0.5] [--seed 42]
+"""
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+from delivery import haversine_matrix, order_deliveries
+
+# Centro de São Paulo, paradas espalhadas num raio de ~15km
+CENTER = (-23.5505, -46.6333)
+SPREAD_DEG = 0.14
+
+
+def legacy_greedy(stops: list, start: dict) -> list:
+    """
+    Cópia do optimize_delivery_route original: vizinho mais próximo com
+    distância euclidiana em graus, O(N²) em Python puro
+    """
+    if len(stops) <= 2:
+        return list(range(len(stops)))
+
+    visited = [False] * len(stops)
+    ordered = []
+    curr_lat, curr_lng = start["lat"], start["lng"]
+    for _ in range(len(stops)):
+        min_distance = float("inf")
+        next_idx = -1
+        for i, stop in enumerate(stops):
+            if not visited[i]:
+                distance = ((stop["lat"] - curr_lat) ** 2 + (stop["lng"] - curr_lng) ** 2) ** 0.5
+                if distance < min_distance:
+                    min_distance = distance
+                    next_idx = i
+        visited[next_idx] = True
+        ordered.append(next_idx)
+        curr_lat, curr_lng = stops[next_idx]["lat"], stops[next_idx]["lng"]
+    return ordered
+
+
+def route_km(order: list, stops: list, start: dict) -> float:
+    points = [start] + [stops[i] for i in order] + [start]
+    dist = haversine_matrix([p["lat"] for p in points], [p["lng"] for p in points])
+    return float(np.diagonal(dist, offset=1).sum()) / 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget", type=float, default=0.5, help="orçamento da busca local (s)")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    start = {"lat": CENTER[0], "lng": CENTER[1]}
+
+    print(f"{'paradas':>8} | {'guloso km':>10} {'ms':>8} | {'2-opt/Or-opt km':>16} {'ms':>8} | {'ganho':>6}")
+    for n in (10, 50, 100, 200, 300):
+        stops = [{
+            "lat": CENTER[0] + rng.uniform(-SPREAD_DEG, SPREAD_DEG),
+            "lng": CENTER[1] + rng.uniform(-SPREAD_DEG, SPREAD_DEG),
+        } for _ in range(n)]
+
+        t0 = time.perf_counter()
+        legacy = legacy_greedy(stops, start)
+        legacy_ms = (time.perf_counter() - t0) * 1000
+
+        t0 = time.perf_counter()
+        improved = order_deliveries(start, stops, time_budget=args.budget)
+        improved_ms = (time.perf_counter() - t0) * 1000
+
+        assert sorted(improved) == list(range(n))
+        legacy_km = route_km(legacy, stops, start)
+        improved_km = route_km(improved, stops, start)
+        gain = (1 - improved_km / legacy_km) * 100
+        print(f"{n:>8} | {legacy_km:>10.1f} {legacy_ms:>8.1f} | {improved_km:>16.1f} {improved_ms:>8.1f} | {gain:>5.1f}%")
+
+
+if __name__ == "__main__":
+    main()
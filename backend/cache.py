@@ -1,26 +1,266 @@
 """
 Melhoria #7: Cache Inteligente
 Sistema de cache para reduzir chamadas às APIs e melhorar performance
+
+Cache LRU limitado por número de entradas e por bytes, com TTL gravado em
+cada entrada no momento da escrita. A expiração é amortizada por um heap de
+expiração (min-heap) e por uma tarefa de limpeza em segundo plano.
 """
 
-from functools import lru_cache
-from typing import Optional, Tuple
+import asyncio
 import hashlib
+import heapq
 import json
-from datetime import datetime, timedelta
-
-# Cache em memória simples (em produção, usar Redis)
-_memory_cache = {}
-_cache_timestamps = {}
+import os
+import pickle
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Optional, Tuple
 
 # TTL padrão: 1 hora para lugares, 5 minutos para rotas
 CACHE_TTL_PLACES = 3600  # 1 hora
 CACHE_TTL_ROUTES = 300   # 5 minutos
+CACHE_TTL_PLACE_DETAILS = 86400  # 24 horas: horário de funcionamento muda pouco
+CACHE_TTL_LLM = int(os.getenv("CACHE_TTL_LLM", "21600"))  # 6 horas
+
+# Limites do cache em memória (em produção, usar Redis)
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # 64 MB
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))  # 16 MB
+CACHE_JANITOR_INTERVAL = int(os.getenv("CACHE_JANITOR_INTERVAL", "60"))  # segundos
+
+
+def _approx_size(value: Any) -> int:
+    """
+    Tamanho aproximado em bytes, medido uma única vez na escrita
+    """
+    try:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(value)
+
+
+class _Entry:
+    __slots__ = ("value", "expires_at", "size", "created_at")
+    
+    def __init__(self, value: Any, expires_at: float, size: int, created_at: datetime):
+        self.value = value
+        self.expires_at = expires_at
+        self.size = size
+        self.created_at = created_at
+
+
+class CacheEngine:
+    """
+    Cache LRU com TTL por entrada.
+    
+    - get/set/delete em O(1) (OrderedDict em ordem de uso)
+    - expiração preguiçosa no get + heap de expiração para a limpeza
+    - despejo do menos usado quando passa de max_entries ou max_bytes
+    """
+    
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, max_bytes: int = CACHE_MAX_BYTES,
+                 default_ttl: int = CACHE_TTL_PLACES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._expiry_heap: list = []  # (expires_at, key); itens obsoletos são ignorados
+        # Melhoria #32: estatísticas mantidas incrementalmente (stats() em O(1))
+        self._by_write: "OrderedDict[str, datetime]" = OrderedDict()  # ordem de escrita
+        self._prefixes: dict = {}  # prefixo -> contadores
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def _prefix_stats(self, key: str) -> dict:
+        prefix = key.split(":", 1)[0] if ":" in key else "other"
+        stats = self._prefixes.get(prefix)
+        if stats is None:
+            stats = self._prefixes[prefix] = {"entries": 0, "bytes": 0, "hits": 0, "misses": 0}
+        return stats
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            self._prefix_stats(key)["misses"] += 1
+            return None
+        
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            self._prefix_stats(key)["misses"] += 1
+            return None
+        
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self._prefix_stats(key)["hits"] += 1
+        return entry.value
+    
+    def set(self, key: str, value: Any, ttl: Optional[int] = None) -> None:
+        ttl = self.default_ttl if ttl is None else ttl
+        if key in self._entries:
+            self._remove(key)
+        
+        entry = _Entry(value, time.monotonic() + ttl, _approx_size(value), datetime.now())
+        if entry.size > self.max_bytes:
+            return  # Nunca caberia: não vale a pena despejar o cache inteiro por ela
+        
+        self._entries[key] = entry
+        self._by_write[key] = entry.created_at
+        self.total_bytes += entry.size
+        prefix_stats = self._prefix_stats(key)
+        prefix_stats["entries"] += 1
+        prefix_stats["bytes"] += entry.size
+        heapq.heappush(self._expiry_heap, (entry.expires_at, key))
+        
+        while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+        
+        # Compacta o heap quando acumula muitos itens obsoletos (sobrescritas/despejos)
+        if len(self._expiry_heap) > 2 * len(self._entries) + 64:
+            self._expiry_heap = [(e.expires_at, k) for k, e in self._entries.items()]
+            heapq.heapify(self._expiry_heap)
+    
+    def delete(self, key: str) -> bool:
+        if key not in self._entries:
+            return False
+        self._remove(key)
+        return True
+    
+    def _remove(self, key: str) -> _Entry:
+        entry = self._entries.pop(key)
+        del self._by_write[key]
+        self.total_bytes -= entry.size
+        prefix_stats = self._prefix_stats(key)
+        prefix_stats["entries"] -= 1
+        prefix_stats["bytes"] -= entry.size
+        return entry
+    
+    def purge_expired(self) -> int:
+        """
+        Remove entradas expiradas consumindo o topo do heap: O(k log n) para k expiradas
+        """
+        now = time.monotonic()
+        removed = 0
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expires_at, key = heapq.heappop(self._expiry_heap)
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at == expires_at:
+                self._remove(key)
+                removed += 1
+        self.expirations += removed
+        return removed
+    
+    def clear(self) -> None:
+        self._entries.clear()
+        self._by_write.clear()
+        self._expiry_heap.clear()
+        self.total_bytes = 0
+        for prefix_stats in self._prefixes.values():
+            prefix_stats["entries"] = prefix_stats["bytes"] = 0
+    
+    def stats(self) -> dict:
+        """
+        Estatísticas em tempo constante (independe do tamanho do cache)
+        """
+        lookups = self.hits + self.misses
+        return {
+            "total_entries": len(self._entries),
+            "cache_size_kb": self.total_bytes / 1024,
+            "max_entries": self.max_entries,
+            "max_size_kb": self.max_bytes / 1024,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "oldest_entry": next(iter(self._by_write.values()), None),
+            "newest_entry": next(reversed(self._by_write.values()), None),
+            "by_prefix": {
+                prefix: {
+                    **stats,
+                    "hit_ratio": stats["hits"] / (stats["hits"] + stats["misses"])
+                    if stats["hits"] + stats["misses"] else 0.0
+                }
+                for prefix, stats in self._prefixes.items()
+            },
+        }
+
+
+class SingleFlight:
+    """
+    Melhoria #17: coalescência de chamadas idênticas em andamento.
+    
+    Enquanto uma busca por `key` está em voo, chamadas concorrentes com a
+    mesma chave esperam o mesmo resultado em vez de ir ao Google/OpenAI de novo.
+    A busca roda numa tarefa própria, então cancelar quem a iniciou não
+    cancela os demais que estão esperando.
+    """
+    
+    def __init__(self):
+        self._inflight: dict = {}
+        self.upstream_calls = 0
+        self.deduplicated = 0
+        self._by_prefix: dict = {}
+    
+    def _count(self, key: str, field: str) -> None:
+        prefix = key.split(":", 1)[0] if ":" in key else "other"
+        stats = self._by_prefix.setdefault(prefix, {"upstream_calls": 0, "deduplicated": 0})
+        stats[field] += 1
+    
+    async def do(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run(key, fetch))
+            self._inflight[key] = task
+            self.upstream_calls += 1
+            self._count(key, "upstream_calls")
+        else:
+            self.deduplicated += 1
+            self._count(key, "deduplicated")
+        return await asyncio.shield(task)
+    
+    async def _run(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            return await fetch()
+        finally:
+            self._inflight.pop(key, None)
+    
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._inflight),
+            "upstream_calls": self.upstream_calls,
+            "deduplicated": self.deduplicated,
+            "by_prefix": {prefix: dict(stats) for prefix, stats in self._by_prefix.items()},
+        }
+
+
+# Cache global da aplicação
+_cache = CacheEngine()
+_single_flight = SingleFlight()
+
+# Melhoria #18: respostas do LLM têm cache próprio (TTL e limites separados)
+_llm_cache = CacheEngine(LLM_CACHE_MAX_ENTRIES, LLM_CACHE_MAX_BYTES, CACHE_TTL_LLM)
+_llm_tokens_saved = 0
 
 
 def get_cache_key(prefix: str, *args, **kwargs) -> str:
     """
     Gera uma chave de cache única baseada nos argumentos
+    Formato "prefixo:hash" para que as estatísticas possam ser agrupadas por prefixo
     """
     data = {
         'prefix': prefix,
@@ -28,60 +268,21 @@ def get_cache_key(prefix: str, *args, **kwargs) -> str:
         'kwargs': sorted(kwargs.items())
     }
     data_str = json.dumps(data, sort_keys=True, default=str)
-    return hashlib.md5(data_str.encode()).hexdigest()
+    return f"{prefix}:{hashlib.md5(data_str.encode()).hexdigest()}"
 
 
-def get_cached(key: str, ttl: int = CACHE_TTL_PLACES) -> Optional[any]:
+def get_cached(key: str) -> Optional[Any]:
     """
     Recupera valor do cache se ainda válido
     """
-    if key not in _memory_cache:
-        return None
-    
-    # Verifica se expirou
-    if key in _cache_timestamps:
-        timestamp = _cache_timestamps[key]
-        if datetime.now() - timestamp > timedelta(seconds=ttl):
-            # Expirou, remove do cache
-            del _memory_cache[key]
-            del _cache_timestamps[key]
-            return None
-    
-    return _memory_cache[key]
-
-
-def set_cached(key: str, value: any) -> None:
-    """
-    Armazena valor no cache
-    """
-    _memory_cache[key] = value
-    _cache_timestamps[key] = datetime.now()
+    return _cache.get(key)
 
 
-def cache_place_search(query: str, lat: float, lng: float):
+def set_cached(key: str, value: Any, ttl: int = CACHE_TTL_PLACES) -> None:
     """
-    Decorator para cachear buscas de lugares
+    Armazena valor no cache; o TTL fica gravado na própria entrada
     """
-    def decorator(func):
-        def wrapper(*args, **kwargs):
-            cache_key = get_cache_key('place_search', query, lat, lng)
-            
-            # Tenta recuperar do cache
-            cached_result = get_cached(cache_key, CACHE_TTL_PLACES)
-            if cached_result is not None:
-                print(f"✅ Cache HIT: place_search {query}")
-                return cached_result
-            
-            # Não está no cache, executa função
-            print(f"❌ Cache MISS: place_search {query}")
-            result = func(*args, **kwargs)
-            
-            # Armazena no cache
-            set_cached(cache_key, result)
-            
-            return result
-        return wrapper
-    return decorator
+    _cache.set(key, value, ttl)
 
 
 def cache_geocoding(address: str):
@@ -92,29 +293,92 @@ def cache_geocoding(address: str):
         def wrapper(*args, **kwargs):
             cache_key = get_cache_key('geocoding', address)
             
-            cached_result = get_cached(cache_key, CACHE_TTL_PLACES)
+            cached_result = get_cached(cache_key)
             if cached_result is not None:
                 print(f"✅ Cache HIT: geocoding {address[:30]}...")
                 return cached_result
             
             print(f"❌ Cache MISS: geocoding {address[:30]}...")
             result = func(*args, **kwargs)
-            set_cached(cache_key, result)
+            set_cached(cache_key, result, CACHE_TTL_PLACES)
             
             return result
         return wrapper
     return decorator
 
 
+async def single_flight(key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Executa `fetch()` uma única vez para chamadas concorrentes com a mesma chave
+    """
+    return await _single_flight.do(key, fetch)
+
+
+async def cached_fetch(key: str, fetch: Callable[[], Awaitable[Any]], ttl: int = CACHE_TTL_PLACES) -> Any:
+    """
+    Retorna o valor em cache ou executa `fetch()` e armazena o resultado.
+    Misses concorrentes para a mesma chave viram uma única chamada externa
+    (o cache é gravado antes de liberar quem estava esperando).
+    """
+    cached = get_cached(key)
+    if cached is not None:
+        return cached
+    
+    async def fetch_and_store():
+        result = await fetch()
+        if result is not None:
+            set_cached(key, result, ttl)
+        return result
+    
+    return await single_flight(key, fetch_and_store)
+
+
+def get_llm_cached(key: str) -> Optional[Any]:
+    """
+    Melhoria #18: valor do cache do LLM; num hit os tokens da resposta
+    original contam como economizados
+    """
+    global _llm_tokens_saved
+    cached = _llm_cache.get(key)
+    if cached is None:
+        return None
+    value, tokens = cached
+    _llm_tokens_saved += tokens
+    return value
+
+
+def set_llm_cached(key: str, value: Any, tokens: int) -> None:
+    _llm_cache.set(key, (value, tokens), CACHE_TTL_LLM)
+
+
+async def cached_llm_fetch(key: str, fetch: Callable[[], Awaitable[Tuple[Any, int]]]) -> Any:
+    """
+    Melhoria #18: cache de respostas do LLM.
+    `fetch()` retorna (valor, tokens_gastos); num hit o modelo não é chamado
+    e os tokens da resposta original contam como economizados.
+    O valor deve ser imutável na prática (ex: dicts do JSON), nunca objetos
+    que o pipeline altera depois.
+    """
+    cached = get_llm_cached(key)
+    if cached is not None:
+        return cached
+    
+    async def fetch_and_store():
+        value, tokens = await fetch()
+        set_llm_cached(key, value, tokens)
+        return value
+    
+    return await single_flight(key, fetch_and_store)
+
+
 def get_cache_stats() -> dict:
     """
     Retorna estatísticas do cache
     """
     return {
-        "total_entries": len(_memory_cache),
-        "cache_size_kb": len(str(_memory_cache)) / 1024,
-        "oldest_entry": min(_cache_timestamps.values()) if _cache_timestamps else None,
-        "newest_entry": max(_cache_timestamps.values()) if _cache_timestamps else None
+        **_cache.stats(),
+        "single_flight": _single_flight.stats(),
+        "llm": {**_llm_cache.stats(), "tokens_saved": _llm_tokens_saved},
     }
 
 
@@ -122,8 +386,8 @@ def clear_cache() -> None:
     """
     Limpa todo o cache
     """
-    _memory_cache.clear()
-    _cache_timestamps.clear()
+    _cache.clear()
+    _llm_cache.clear()
     print("🗑️  Cache limpo!")
 
 
@@ -132,20 +396,18 @@ def clear_expired_cache() -> int:
     Remove apenas entradas expiradas
     Retorna quantidade de itens removidos
     """
-    now = datetime.now()
-    expired_keys = []
+    removed = _cache.purge_expired() + _llm_cache.purge_expired()
     
-    for key, timestamp in _cache_timestamps.items():
-        # Usa o maior TTL como padrão
-        if now - timestamp > timedelta(seconds=CACHE_TTL_PLACES):
-            expired_keys.append(key)
+    if removed:
+        print(f"🗑️  Removidos {removed} itens expirados do cache")
     
-    for key in expired_keys:
-        del _memory_cache[key]
-        del _cache_timestamps[key]
-    
-    if expired_keys:
-        print(f"🗑️  Removidos {len(expired_keys)} itens expirados do cache")
-    
-    return len(expired_keys)
+    return removed
+
 
+async def run_cache_janitor(interval: int = CACHE_JANITOR_INTERVAL) -> None:
+    """
+    Tarefa de fundo: remove entradas expiradas periodicamente
+    """
+    while True:
+        await asyncio.sleep(interval)
+        clear_expired_cache()
@@ -0,0 +1,139 @@
+"""
+Melhoria #13: Modo Entregador para centenas de paradas
+Matriz de distâncias geodésicas (haversine) + tour guloso melhorado por busca
+local 2-opt / Or-opt dentro de um orçamento de tempo. Os laços internos são
+vetorizados com NumPy.
+"""
+
+import os
+import time
+from typing import List, Optional
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371008.8
+
+# Orçamento de tempo da busca local (segundos)
+DELIVERY_TIME_BUDGET = float(os.getenv("DELIVERY_TIME_BUDGET", "0.5"))
+
+_EPS = 1e-9
+
+
+def haversine_matrix(lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+    """
+    Matriz NxN de distâncias em metros entre todos os pontos
+    """
+    lat = np.radians(np.asarray(lats, dtype=float))
+    lng = np.radians(np.asarray(lngs, dtype=float))
+    dlat = lat[:, None] - lat[None, :]
+    dlng = lng[:, None] - lng[None, :]
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat[:, None]) * np.cos(lat[None, :]) * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def tour_length(tour: np.ndarray, dist: np.ndarray) -> float:
+    """Comprimento de um tour fechado [0, ..., 0]"""
+    return float(dist[tour[:-1], tour[1:]].sum())
+
+
+def greedy_tour(dist: np.ndarray, start: int = 0) -> np.ndarray:
+    """
+    Vizinho mais próximo a partir de `start`; retorna tour fechado
+    """
+    n = len(dist)
+    visited = np.zeros(n, dtype=bool)
+    visited[start] = True
+    tour = [start]
+    current = start
+    for _ in range(n - 1):
+        row = np.where(visited, np.inf, dist[current])
+        current = int(np.argmin(row))
+        visited[current] = True
+        tour.append(current)
+    tour.append(start)
+    return np.array(tour, dtype=np.int64)
+
+
+def two_opt(tour: np.ndarray, dist: np.ndarray, deadline: float) -> bool:
+    """
+    Uma passada de 2-opt (assume matriz simétrica). Para cada i avalia
+    todos os j de uma vez e aplica a melhor reversão. Retorna True se melhorou.
+    """
+    m = len(tour) - 1
+    improved = False
+    for i in range(1, m - 1):
+        if time.perf_counter() > deadline:
+            break
+        a, b = tour[i - 1], tour[i]
+        c = tour[i + 1:m]
+        d = tour[i + 2:m + 1]
+        delta = dist[a, c] + dist[b, d] - dist[a, b] - dist[c, d]
+        k = int(np.argmin(delta))
+        if delta[k] < -_EPS:
+            j = i + 1 + k
+            tour[i:j + 1] = tour[i:j + 1][::-1].copy()
+            improved = True
+    return improved
+
+
+def or_opt(tour: np.ndarray, dist: np.ndarray, deadline: float, max_segment: int = 3) -> tuple:
+    """
+    Uma passada de Or-opt: move segmentos de 1..max_segment paradas (também
+    invertidos) para a melhor posição do tour. Retorna (tour, melhorou).
+    """
+    improved = False
+    for seg_len in range(1, max_segment + 1):
+        i = 1
+        while i + seg_len < len(tour):
+            if time.perf_counter() > deadline:
+                return tour, improved
+            s0, s1 = tour[i], tour[i + seg_len - 1]
+            prev, nxt = tour[i - 1], tour[i + seg_len]
+            removal_gain = dist[prev, s0] + dist[s1, nxt] - dist[prev, nxt]
+
+            rest = np.concatenate((tour[:i], tour[i + seg_len:]))
+            u, v = rest[:-1], rest[1:]
+            forward = dist[u, s0] + dist[s1, v] - dist[u, v]
+            backward = dist[u, s1] + dist[s0, v] - dist[u, v]
+            cost = np.minimum(forward, backward)
+            k = int(np.argmin(cost))
+
+            if cost[k] - removal_gain < -_EPS:
+                segment = tour[i:i + seg_len]
+                if backward[k] < forward[k]:
+                    segment = segment[::-1]
+                tour = np.concatenate((rest[:k + 1], segment, rest[k + 1:]))
+                improved = True
+            else:
+                i += 1
+    return tour, improved
+
+
+def solve_tour(dist: np.ndarray, time_budget: Optional[float] = None) -> List[int]:
+    """
+    Resolve o tour partindo e voltando ao índice 0.
+    Retorna os índices das paradas (sem o depósito) na ordem de visita.
+    """
+    if len(dist) <= 1:
+        return []
+    deadline = time.perf_counter() + (DELIVERY_TIME_BUDGET if time_budget is None else time_budget)
+
+    tour = greedy_tour(dist)
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = two_opt(tour, dist, deadline)
+        tour, moved = or_opt(tour, dist, deadline)
+        improved = improved or moved
+
+    return [int(i) for i in tour[1:-1]]
+
+
+def order_deliveries(start_coords: dict, stops: List[dict], time_budget: Optional[float] = None) -> List[int]:
+    """
+    Ordena paradas {"lat", "lng"} partindo e voltando a start_coords.
+    Retorna os índices de `stops` na ordem de visita.
+    """
+    lats = np.array([start_coords["lat"]] + [s["lat"] for s in stops])
+    lngs = np.array([start_coords["lng"]] + [s["lng"] for s in stops])
+    dist = haversine_matrix(lats, lngs)
+    return [i - 1 for i in solve_tour(dist, time_budget)]
@@ -0,0 +1,90 @@
+"""
+Melhoria #9: I/O Externo Não-Bloqueante
+Os SDKs do OpenAI e do googlemaps são síncronos. Todas as chamadas externas
+passam por aqui e rodam num pool de threads limitado, para que uma resposta
+lenta do Google ou do OpenAI não trave o event loop do worker.
+"""
+
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+import metrics
+
+# Tamanho do pool: máximo de chamadas externas simultâneas por worker
+EXTERNAL_IO_POOL_SIZE = int(os.getenv("EXTERNAL_IO_POOL_SIZE", "32"))
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Retorna o pool compartilhado, criando-o sob demanda
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=EXTERNAL_IO_POOL_SIZE,
+            thread_name_prefix="external-io"
+        )
+    return _executor
+
+
+def configure_executor(max_workers: int) -> None:
+    """
+    Recria o pool com outro tamanho (chamadas em andamento terminam no pool antigo)
+    """
+    global _executor, EXTERNAL_IO_POOL_SIZE
+    old = _executor
+    EXTERNAL_IO_POOL_SIZE = max_workers
+    _executor = None
+    if old is not None:
+        old.shutdown(wait=False)
+
+
+async def run_blocking(func: Callable, *args, **kwargs) -> Any:
+    """
+    Executa uma chamada síncrona no pool sem bloquear o event loop
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+class AsyncClient:
+    """
+    Proxy que expõe os métodos de um cliente síncrono como corrotinas.
+
+    Atributos que não são chamáveis (ex: openai_client.chat.completions) são
+    embrulhados recursivamente, então:
+        await AsyncClient(openai_client).chat.completions.create(...)
+        await AsyncClient(gmaps).places(...)
+
+    Melhoria #31: cada chamada vira um span (serviço, método) e conta em
+    errand_external_calls_total; o serviço é o pacote do cliente
+    ("openai", "googlemaps") se não for informado.
+    """
+
+    def __init__(self, client: Any, service: Optional[str] = None, path: str = ""):
+        self._client = client
+        self._service = service or type(client).__module__.split(".")[0]
+        self._path = path
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._client, name)
+        method = f"{self._path}.{name}" if self._path else name
+        if not callable(attr):
+            return AsyncClient(attr, self._service, method)
+
+        async def call(*args, **kwargs):
+            status = "error"
+            try:
+                with metrics.span(self._service, method):
+                    result = await run_blocking(attr, *args, **kwargs)
+                status = "ok"
+                return result
+            finally:
+                metrics.external_calls.inc(service=self._service, method=method, status=status)
+
+        return call
@@ -0,0 +1,213 @@
+"""
+Melhoria #19: Parser local para frases comuns de recados
+A maior parte das entradas é formulaica ("ir ao banco (fecha às 16h),
+farmácia, correios, pão na volta"). Este parser determinístico produz as
+mesmas tarefas que o GPT (place_name, closing_time, constraint) em
+microssegundos; o GPT só é chamado quando a confiança é baixa.
+"""
+
+import os
+import re
+import unicodedata
+from typing import List, Optional, Tuple
+
+# Só usa o resultado local se todas as partes da frase forem reconhecidas
+FAST_PARSE_MIN_CONFIDENCE = float(os.getenv("FAST_PARSE_MIN_CONFIDENCE", "1.0"))
+
+# Categoria -> palavras-chave (sem acento, minúsculas). A ordem importa:
+# a primeira categoria cujas palavras aparecem na parte vence.
+PLACE_KEYWORDS: List[Tuple[str, Tuple[str, ...]]] = [
+    ("posto de gasolina", ("posto", "gasolina", "abastecer", "combustivel", "etanol")),
+    ("caixa eletrônico", ("caixa eletronico", "caixa 24", "sacar dinheiro", "sacar")),
+    ("banco", ("banco", "agencia bancaria", "deposito", "depositar")),
+    ("farmácia", ("farmacia", "drogaria", "remedio", "remedios")),
+    ("correios", ("correio", "correios", "encomenda", "sedex", "pacote")),
+    ("padaria", ("padaria", "pao", "paes", "pao frances")),
+    ("supermercado", ("supermercado", "mercado", "compras do mes")),
+    ("açougue", ("acougue", "carne")),
+    ("hortifruti", ("hortifruti", "sacolao", "feira", "frutas", "verduras")),
+    ("lotérica", ("loterica", "boleto", "conta de luz", "conta de agua")),
+    ("lavanderia", ("lavanderia",)),
+    ("pet shop", ("pet shop", "petshop", "racao")),
+    ("cartório", ("cartorio", "reconhecer firma", "autenticar")),
+    ("papelaria", ("papelaria", "xerox", "copias", "imprimir")),
+    ("chaveiro", ("chaveiro", "copia da chave", "copia de chave")),
+    ("academia", ("academia",)),
+    ("banca de jornal", ("banca de jornal", "banca")),
+    ("floricultura", ("floricultura", "flores")),
+    ("livraria", ("livraria",)),
+    ("restaurante", ("restaurante", "almocar", "almoco")),
+]
+
+_PLACE_RES = [
+    (place_name, re.compile(r"\b(?:" + "|".join(map(re.escape, keywords)) + r")\b"))
+    for place_name, keywords in PLACE_KEYWORDS
+]
+
+FIRST_PATTERNS = ("primeiro", "primeira coisa", "antes de tudo", "logo cedo", "comecar pel")
+LAST_PATTERNS = ("na volta", "por ultimo", "no final", "no fim", "depois de tudo", "voltando", "ultima coisa")
+URGENT_PATTERNS = ("urgente", "sem falta", "rapidinho")
+_ORDER_PHRASES_RE = re.compile(
+    r"\s*\b(?:" + "|".join(LAST_PATTERNS + FIRST_PATTERNS) + r")\b\s*", re.IGNORECASE
+)
+_FIRST_RE = re.compile(r"\b(?:" + "|".join(FIRST_PATTERNS) + r")")
+_LAST_RE = re.compile(r"\b(?:" + "|".join(LAST_PATTERNS) + r")\b")
+_URGENT_RE = re.compile(r"\b(?:" + "|".join(URGENT_PATTERNS) + r")\b")
+
+# Negação ("não preciso ir ao banco") e conectivos que deixam a tarefa em
+# aberto ("banco ou lotérica", "se der tempo"): a parte fica para o GPT
+_NEGATION_RE = re.compile(r"\b(?:nao|nem|nada de|nenhum|nenhuma|sem(?!\s+falta)|cancela\w*|esquece\w*|desist\w*)\b")
+_AMBIGUOUS_RE = re.compile(r"\b(?:ou|talvez|se der|se sobrar|se precisar|se possivel|caso|quem sabe)\b")
+
+# Lugar introduzido por preposição ("na portaria"): se a palavra não é de
+# nenhuma categoria, a palavra-chave da parte pode ser só o objeto ("pacote")
+_LOCATION_RE = re.compile(r"\b(?:n[oa]s?|num|numa|em|aos?|pel[oa]s?)\s+(?:(?:um|uma|o|a|os|as)\s+)?(\w+)")
+_KEYWORD_WORDS = frozenset(
+    word for _, keywords in PLACE_KEYWORDS for keyword in keywords for word in keyword.split()
+) | {"caminho", "mesmo", "mesma", "carro"}
+
+# "fecha às 16h", "que fecha as 16:30", "fecha 17h", "até as 18h", "até 18h30"
+_CLOSING_RE = re.compile(
+    r"\b(?:fecha(?:m)?|ate)\s+(?:as\s+|a\s+)?(\d{1,2})\s*(?:h|:|horas?)\s*(\d{2})?"
+)
+_SPLIT_RE = re.compile(r"\s*(?:[,;\n]|\s+e\s+depois\s+|\s+e\s+|\s+depois\s+|\.\s+)\s*")
+_CONNECTOR_RE = re.compile(r"^(?:e\s+)?(?:depois\s+|entao\s+|então\s+)?(?:e\s+)?", re.IGNORECASE)
+# Preposição que sobra no começo do nome ("e depois no correio" -> "Correio")
+_LEADING_PREPOSITION_RE = re.compile(r"^(?:n[oa]s?|em|aos?|à|às)\s+", re.IGNORECASE)
+_PERSON_PREFIX_RE = re.compile(r"^\s*([\w\s]{1,30}):\s+")
+_FILLER_RE = re.compile(
+    r"^(?:eu\s+)?(?:preciso|tenho que|tenho de|quero|vou|hoje|amanha)\s+(?:de\s+)?", re.IGNORECASE
+)
+_PARENS_RE = re.compile(r"\([^)]*\)")
+
+
+def _fold(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def _split_outside_parens(text: str) -> List[str]:
+    """
+    Divide a frase em partes por vírgula / " e " / ";" ignorando o que
+    está dentro de parênteses
+    """
+    parts, depth, start = [], 0, 0
+    protected = []
+    for char in text:
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth = max(0, depth - 1)
+        protected.append(depth > 0)
+
+    for match in _SPLIT_RE.finditer(text):
+        if protected[match.start()]:
+            continue
+        parts.append(text[start:match.start()])
+        start = match.end()
+    parts.append(text[start:])
+    parts = [_CONNECTOR_RE.sub("", p.strip(" .!")) for p in parts]
+    return [p for p in parts if p]
+
+
+def _match_place(folded: str) -> Optional[str]:
+    matches = [place_name for place_name, pattern in _PLACE_RES if pattern.search(folded)]
+    if not matches:
+        return None
+    # "caixa eletrônico" + "banco" numa mesma parte ("sacar dinheiro no banco")
+    if set(matches) <= {"banco", "caixa eletrônico"}:
+        return "banco" if "banco" in matches else "caixa eletrônico"
+    return matches[0] if len(matches) == 1 else None
+
+
+def _closing_time(folded: str) -> Optional[str]:
+    match = _CLOSING_RE.search(folded)
+    if not match:
+        return None
+    hour = int(match.group(1))
+    minute = int(match.group(2) or 0)
+    if hour > 23 or minute > 59:
+        return None
+    return f"{hour:02d}:{minute:02d}"
+
+
+def _constraint(folded: str, closing_time: Optional[str]) -> Optional[str]:
+    if _FIRST_RE.search(folded):
+        return "first"
+    if _LAST_RE.search(folded):
+        return "last"
+    if closing_time or _URGENT_RE.search(folded):
+        return "urgent"
+    return None
+
+
+def _is_ambiguous(folded: str) -> bool:
+    """
+    A parte tem negação, um conectivo que deixa a tarefa em aberto ou um
+    lugar (depois de preposição) que o parser não conhece
+    """
+    if _NEGATION_RE.search(folded) or _AMBIGUOUS_RE.search(folded):
+        return True
+    without_order = _ORDER_PHRASES_RE.sub(" ", folded)
+    return any(word not in _KEYWORD_WORDS for word in _LOCATION_RE.findall(without_order))
+
+
+def _task_name(part: str) -> str:
+    name = _PARENS_RE.sub("", part)
+    name = _FILLER_RE.sub("", name.strip())
+    name = _ORDER_PHRASES_RE.sub(" ", name)
+    name = _LEADING_PREPOSITION_RE.sub("", name.strip())
+    name = " ".join(name.split()).strip(" ,.")
+    return name[:1].upper() + name[1:] if name else part
+
+
+def parse_errands_locally(user_input: str) -> Tuple[List[dict], float]:
+    """
+    Retorna (tarefas, confiança). Cada tarefa tem o mesmo formato do JSON do
+    GPT: name, place_name, closing_time, constraint.
+    A confiança é a fração das partes da frase que tiveram um local
+    reconhecido sem ambiguidade (negação, "ou", lugar desconhecido).
+    """
+    text = user_input
+    prefix = _PERSON_PREFIX_RE.match(text)
+    # "Maria: farmácia" é o nome de quem pediu; "banco: depositar cheque" não
+    if prefix and _match_place(_fold(prefix.group(1))) is None:
+        text = text[prefix.end():]
+    parts = _split_outside_parens(text)
+    if not parts:
+        return [], 0.0
+
+    tasks = []
+    for part in parts:
+        folded = _fold(part)
+        place_name = None if _is_ambiguous(folded) else _match_place(folded)
+        closing_time = _closing_time(folded)
+        if place_name is None:
+            # Parte solta só com horário ("que fecha às 16h") vale para a anterior
+            if closing_time and tasks and not tasks[-1]["closing_time"]:
+                tasks[-1]["closing_time"] = closing_time
+                if tasks[-1]["constraint"] is None:
+                    tasks[-1]["constraint"] = "urgent"
+                continue
+            tasks.append(None)
+            continue
+
+        tasks.append({
+            "name": _task_name(part),
+            "place_name": place_name,
+            "closing_time": closing_time,
+            "constraint": _constraint(folded, closing_time),
+        })
+
+    recognized = [t for t in tasks if t is not None]
+    return recognized, len(recognized) / len(tasks)
+
+
+def parse_if_confident(user_input: str) -> Optional[List[dict]]:
+    """
+    Tarefas do parser local, ou None se a confiança ficar abaixo do mínimo
+    """
+    tasks, confidence = parse_errands_locally(user_input)
+    if tasks and confidence >= FAST_PARSE_MIN_CONFIDENCE:
+        return tasks
+    return None
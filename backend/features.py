@@ -5,20 +5,86 @@ Novas Features Avançadas para Smart Errand Runner
 from typing import List, Optional, Dict
 from datetime import datetime, timedelta
 from openai import OpenAI
+from pydantic import BaseModel
 import os
-import json
 from dotenv import load_dotenv
+from external import AsyncClient
+from llm import complete_json, LLMResponseError
+from cache import cached_fetch, get_cache_key, CACHE_TTL_PLACES
+from geo import geohash_encode, geohash_center
+from routing import RouteLeg
 
 load_dotenv()
 openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+openai_async = AsyncClient(openai_client)  # Melhoria #9: chamadas fora do event loop
+
+# Melhoria #28: células de ~1,2km x 0,6km para o cache das buscas de alternativas
+ALTERNATIVES_CELL_PRECISION = 6
+
+
+# Melhoria #20: formato de resposta de cada feature com GPT (schema do response_format)
+class AttractionVisit(BaseModel):
+    attraction: str
+    visit_duration: str
+    best_time: str
+    tips: str
+    nearby_restaurants: List[str]
+
+
+class TouristItinerary(BaseModel):
+    itinerary: List[AttractionVisit]
+    total_time: str
+    recommendations: List[str]
+
+
+class PersonSplit(BaseModel):
+    person: int
+    tasks: List[str]
+    estimated_time: str
+    route_summary: str
+
+
+class TaskSplit(BaseModel):
+    splits: List[PersonSplit]
+    meeting_point: str
+    time_saved: str
+    recommendations: List[str]
+
+
+class StoreRecommendation(BaseModel):
+    store_type: str
+    items_available: List[str]
+    items_missing: List[str]
+    convenience_score: str
+    reasoning: str
+
+
+class ShoppingAnalysis(BaseModel):
+    recommendations: List[StoreRecommendation]
+    optimal_strategy: str
+    time_estimate: str
+
+
+class ScheduleSuggestion(BaseModel):
+    best_start_time: str
+    reasoning: str
+    alternative_times: List[str]
+    time_savings: str
+    warnings: List[str]
+
+
+# Melhoria #20: limite de tokens da resposta de cada feature
+TOURIST_MAX_TOKENS = 900
+SPLIT_MAX_TOKENS = 600
+SHOPPING_MAX_TOKENS = 700
 
 
 # FEATURE 1: Modo Turista
-async def analyze_tourist_route(attractions: str, days: int = 1) -> dict:
+def tourist_route_instructions(attractions: str, days: int = 1) -> str:
     """
-    Analisa lista de atrações turísticas e cria itinerário otimizado
+    Prompt do itinerário sem o formato da resposta (também usado no prompt batching)
     """
-    prompt = f"""Você é um guia turístico especialista. Analise estas atrações e crie um itinerário otimizado:
+    return f"""Você é um guia turístico especialista. Analise estas atrações e crie um itinerário otimizado:
 
 Atrações desejadas: {attractions}
 Tempo disponível: {days} dia(s)
@@ -28,34 +94,43 @@ Para cada atração, forneça:
 2. Melhor horário para visitar (evitar filas)
 3. Dicas importantes
 4. Restaurantes próximos recomendados
+"""
 
+
+async def analyze_tourist_route(attractions: str, days: int = 1) -> Optional[dict]:
+    """
+    Analisa lista de atrações turísticas e cria itinerário otimizado
+    """
+    prompt = tourist_route_instructions(attractions, days) + """
 Retorne um JSON no formato:
-{{
+{
     "itinerary": [
-        {{
+        {
             "attraction": "Nome",
             "visit_duration": "tempo em minutos",
             "best_time": "horário recomendado",
             "tips": "dicas importantes",
             "nearby_restaurants": ["restaurante1", "restaurante2"]
-        }}
+        }
     ],
     "total_time": "tempo total estimado",
     "recommendations": ["dica1", "dica2"]
-}}
+}
 """
     
-    response = openai_client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.7
-    )
-    
-    content = response.choices[0].message.content.strip()
-    if "```json" in content:
-        content = content.split("```json")[1].split("```")[0].strip()
+    try:
+        result, _ = await complete_json(
+            openai_async,
+            [{"role": "user", "content": prompt}],
+            TouristItinerary,
+            temperature=0.7,
+            max_tokens=TOURIST_MAX_TOKENS
+        )
+    except LLMResponseError as e:
+        print(f"⚠️  Itinerário turístico indisponível: {e}")
+        return None
     
-    return json.loads(content)
+    return result.model_dump()
 
 
 # FEATURE 2: Rotas Favoritas com IA
@@ -99,95 +174,110 @@ class FavoriteRoutesAI:
 
 
 # FEATURE 3: Split de Tarefas
-async def split_tasks_multiple_people(tasks: List[dict], num_people: int = 2) -> dict:
+def split_tasks_instructions(tasks_description: str, num_people: int) -> str:
     """
-    Divide tarefas entre múltiplas pessoas de forma otimizada
+    Prompt da divisão de tarefas, sem o formato da resposta
     """
-    tasks_str = "\n".join([f"- {t.get('name', t)}" for t in tasks])
-    
-    prompt = f"""Você precisa dividir estas tarefas entre {num_people} pessoas de forma otimizada:
+    return f"""Você precisa dividir estas tarefas entre {num_people} pessoas de forma otimizada:
 
-Tarefas:
-{tasks_str}
+{tasks_description}
 
 Divida considerando:
 1. Proximidade geográfica (tarefas próximas para a mesma pessoa)
 2. Tempo total balanceado entre as pessoas
 3. Tipos de tarefa compatíveis (ex: compras juntas)
+"""
 
+
+async def split_tasks_multiple_people(tasks: List[dict], num_people: int = 2) -> Optional[dict]:
+    """
+    Divide tarefas entre múltiplas pessoas de forma otimizada
+    """
+    tasks_str = "\n".join([f"- {t.get('name', t)}" for t in tasks])
+    
+    prompt = split_tasks_instructions(f"Tarefas:\n{tasks_str}", num_people) + """
 Retorne JSON:
-{{
+{
     "splits": [
-        {{
+        {
             "person": 1,
             "tasks": ["tarefa1", "tarefa2"],
             "estimated_time": "tempo em minutos",
             "route_summary": "resumo da rota"
-        }}
+        }
     ],
     "meeting_point": "sugestão de ponto de encontro",
     "time_saved": "tempo economizado vs uma pessoa fazer tudo",
     "recommendations": ["dica1", "dica2"]
-}}
+}
 """
     
-    response = openai_client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.5
-    )
-    
-    content = response.choices[0].message.content.strip()
-    if "```json" in content:
-        content = content.split("```json")[1].split("```")[0].strip()
+    try:
+        result, _ = await complete_json(
+            openai_async,
+            [{"role": "user", "content": prompt}],
+            TaskSplit,
+            temperature=0.5,
+            max_tokens=SPLIT_MAX_TOKENS
+        )
+    except LLMResponseError as e:
+        print(f"⚠️  Divisão de tarefas indisponível: {e}")
+        return None
     
-    return json.loads(content)
+    return result.model_dump()
 
 
 # FEATURE 4: Compras Inteligentes
-async def analyze_shopping_list(items: List[str], location: dict) -> dict:
+def shopping_list_instructions(items: List[str]) -> str:
     """
-    Analisa lista de compras e sugere estabelecimentos que têm tudo
+    Prompt da análise de compras, sem o formato da resposta
     """
-    items_str = ", ".join(items)
-    
-    prompt = f"""Analise esta lista de compras e sugira estabelecimentos que possam ter TODOS ou a maioria dos itens:
+    return f"""Analise esta lista de compras e sugira estabelecimentos que possam ter TODOS ou a maioria dos itens:
 
-Lista: {items_str}
+Lista: {', '.join(items)}
 
 Considere:
 1. Supermercados grandes (geralmente têm de tudo)
 2. Farmácias (remédios + alguns itens de conveniência)
 3. Lojas de conveniência 24h
 4. Mercados especializados
+"""
+
 
+async def analyze_shopping_list(items: List[str], location: dict) -> Optional[dict]:
+    """
+    Analisa lista de compras e sugere estabelecimentos que têm tudo
+    """
+    prompt = shopping_list_instructions(items) + """
 Retorne JSON:
-{{
+{
     "recommendations": [
-        {{
+        {
             "store_type": "tipo de estabelecimento",
             "items_available": ["item1", "item2"],
             "items_missing": ["item3"],
             "convenience_score": "1-10",
             "reasoning": "por que essa opção é boa"
-        }}
+        }
     ],
     "optimal_strategy": "melhor estratégia (1 ou 2 lugares)",
     "time_estimate": "tempo total estimado"
-}}
+}
 """
     
-    response = openai_client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.6
-    )
-    
-    content = response.choices[0].message.content.strip()
-    if "```json" in content:
-        content = content.split("```json")[1].split("```")[0].strip()
+    try:
+        result, _ = await complete_json(
+            openai_async,
+            [{"role": "user", "content": prompt}],
+            ShoppingAnalysis,
+            temperature=0.6,
+            max_tokens=SHOPPING_MAX_TOKENS
+        )
+    except LLMResponseError as e:
+        print(f"⚠️  Análise de compras indisponível: {e}")
+        return None
     
-    return json.loads(content)
+    return result.model_dump()
 
 
 # FEATURE 7: Assistant Proativo
@@ -197,10 +287,10 @@ def generate_proactive_notifications(route_data: dict, current_time: datetime) -
     """
     notifications = []
     
-    # Analisa cada parada
+    # Analisa cada parada (RouteLeg)
     for stop in route_data.get("optimized_route", []):
-        arrival = stop.get("arrival_time")
-        closing = stop.get("closing_time")
+        arrival = stop.arrival_time
+        closing = stop.closing_time
         
         if arrival and closing:
             # Converte strings para datetime para comparação
@@ -222,14 +312,14 @@ def generate_proactive_notifications(route_data: dict, current_time: datetime) -
                     notifications.append({
                         "type": "urgent",
                         "title": f"⚠️ Tempo Apertado!",
-                        "message": f"{stop['task']} fecha em {time_margin:.0f} min após sua chegada",
+                        "message": f"{stop.task} fecha em {time_margin:.0f} min após sua chegada",
                         "action": "Considere ir direto para lá"
                     })
                 elif time_margin < 30:
                     notifications.append({
                         "type": "warning",
                         "title": "⏰ Atenção ao Horário",
-                        "message": f"{stop['task']} tem apenas {time_margin:.0f} min de margem",
+                        "message": f"{stop.task} tem apenas {time_margin:.0f} min de margem",
                         "action": "Não demore nas paradas anteriores"
                     })
             except:
@@ -242,36 +332,46 @@ def generate_proactive_notifications(route_data: dict, current_time: datetime) -
 async def discover_better_alternatives(gmaps, current_place: dict, place_type: str) -> Optional[dict]:
     """
     Descobre estabelecimentos alternativos melhores avaliados
+    `gmaps` deve ser o cliente assíncrono (external.AsyncClient)
+    Melhoria #28: a busca de 2km sai do centro da célula (geohash) do lugar e
+    fica em cache por célula + tipo; paradas vizinhas reaproveitam a mesma busca
     """
+    cell = geohash_encode(current_place["lat"], current_place["lng"], ALTERNATIVES_CELL_PRECISION)
+    center = geohash_center(cell)
     try:
         # Busca lugares similares próximos
-        nearby = gmaps.places_nearby(
-            location=(current_place["lat"], current_place["lng"]),
-            radius=2000,  # 2km
-            type=place_type
+        nearby = await cached_fetch(
+            get_cache_key('alternatives_nearby', cell, place_type),
+            lambda: gmaps.places_nearby(
+                location=(center["lat"], center["lng"]),
+                radius=2000,  # 2km
+                type=place_type
+            ),
+            CACHE_TTL_PLACES
         )
-        
-        # Filtra por rating
-        better_options = []
-        for place in nearby.get("results", [])[:5]:
-            rating = place.get("rating", 0)
-            if rating >= 4.5:  # Apenas bem avaliados
-                better_options.append({
-                    "name": place["name"],
-                    "rating": rating,
-                    "user_ratings": place.get("user_ratings_total", 0),
-                    "address": place.get("vicinity", ""),
-                    "reason": f"⭐ {rating} estrelas com {place.get('user_ratings_total', 0)} avaliações"
-                })
-        
-        if better_options:
-            return {
-                "has_alternatives": True,
-                "alternatives": better_options[:3],
-                "message": "Encontramos opções bem avaliadas próximas!"
-            }
-    except:
-        pass
+    except Exception as e:
+        print(f"⚠️ Busca de alternativas ({place_type}) na célula {cell} falhou: {e}")
+        return None
+    
+    # Filtra por rating
+    better_options = []
+    for place in nearby.get("results", [])[:5]:
+        rating = place.get("rating", 0)
+        if rating >= 4.5:  # Apenas bem avaliados
+            better_options.append({
+                "name": place["name"],
+                "rating": rating,
+                "user_ratings": place.get("user_ratings_total", 0),
+                "address": place.get("vicinity", ""),
+                "reason": f"⭐ {rating} estrelas com {place.get('user_ratings_total', 0)} avaliações"
+            })
+    
+    if better_options:
+        return {
+            "has_alternatives": True,
+            "alternatives": better_options[:3],
+            "message": "Encontramos opções bem avaliadas próximas!"
+        }
     
     return None
 
@@ -285,14 +385,8 @@ def check_calendar_conflicts(route_data: dict, calendar_events: List[dict]) -> d
     suggestions = []
     
     route_start = route_data.get("start_time", "now")
-    route_duration = route_data.get("total_duration", "60min")
-    
-    # Parse duration
-    duration_min = 60  # default
-    if "hour" in route_duration:
-        duration_min = int(route_duration.split("hour")[0]) * 60
-    elif "min" in route_duration:
-        duration_min = int(route_duration.split("min")[0])
+    # Melhoria #30: duração numérica do plano (o texto "1h 8min" não é mais lido)
+    duration_min = route_data.get("total_duration_s", 3600) / 60
     
     # Simula checagem de conflitos
     for event in calendar_events:
@@ -365,29 +459,22 @@ def estimate_crowdedness(place_types: List[str], current_hour: int, day_of_week:
 
 
 # FEATURE 15: Rota com Pausas
-def add_rest_stops(route: List[dict], max_driving_time: int = 90) -> dict:
+def add_rest_stops(route: List[RouteLeg], max_driving_time: int = 90) -> dict:
     """
     Adiciona paradas estratégicas para descanso
+    Melhoria #30: soma os segundos de cada trecho (RouteLeg.duration_s)
     """
     suggestions = []
-    total_time = 0
+    total_time = 0  # minutos dirigindo desde a última pausa
     
     for i, leg in enumerate(route):
-        duration_text = leg.get("duration", "")
-        
-        # Parse duration
-        if "hour" in duration_text:
-            hours = int(duration_text.split("hour")[0].strip())
-            total_time += hours * 60
-        elif "min" in duration_text:
-            mins = int(duration_text.split("min")[0].strip())
-            total_time += mins
+        total_time += leg.duration_s / 60
         
         # Se passou de 90min, sugere pausa
         if total_time >= max_driving_time and i < len(route) - 1:
             suggestions.append({
-                "after_stop": leg["task"],
-                "reason": f"Você já dirigiu por {total_time} minutos",
+                "after_stop": leg.task,
+                "reason": f"Você já dirigiu por {int(total_time)} minutos",
                 "suggestion": "☕ Parada para café/banheiro recomendada",
                 "duration": "10-15 minutos",
                 "location_type": "Posto de gasolina ou café"
@@ -397,7 +484,7 @@ def add_rest_stops(route: List[dict], max_driving_time: int = 90) -> dict:
     return {
         "needs_rest": len(suggestions) > 0,
         "rest_suggestions": suggestions,
-        "total_driving_time": f"{sum([s.get('after_stop', 0) for s in suggestions if isinstance(s.get('after_stop'), int)])} min"
+        "total_driving_time": f"{int(sum(leg.duration_s for leg in route) / 60)} min"
     }
 
 
@@ -508,21 +595,16 @@ Retorne JSON:
 """
     
     try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
+        result, _ = await complete_json(
+            openai_async,
+            [{"role": "user", "content": prompt}],
+            ScheduleSuggestion,
             temperature=0.3,  # Lower temp for more consistent scheduling
-            max_tokens=500
+            max_tokens=300
         )
         
-        content = response.choices[0].message.content.strip()
-        if "```json" in content:
-            content = content.split("```json")[1].split("```")[0].strip()
-        
-        result = json.loads(content)
-        
         return {
-            "optimized_schedule": result,
+            "optimized_schedule": result.model_dump(),
             "confidence": 0.92,
             "factors_considered": [
                 "Horários de pico",
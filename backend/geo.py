@@ -0,0 +1,100 @@
+"""
+Utilitários geográficos compartilhados pelos caches e pelo roteamento
+"""
+
+from datetime import datetime
+from typing import List, Tuple
+
+# 4 casas decimais ~ 11 metros: pontos mais próximos que isso compartilham cache
+COORD_DECIMALS = 4
+
+# Precisão do geohash das células de cache de buscas (5 caracteres ~ 4,9km x 4,9km)
+SEARCH_CELL_PRECISION = 5
+
+_GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+_GEOHASH_INDEX = {c: i for i, c in enumerate(_GEOHASH_ALPHABET)}
+
+# Janela de horário de partida que compartilha o mesmo resultado de trânsito
+DEPARTURE_BUCKET_MINUTES = 15
+
+
+def quantize_point(point: dict, decimals: int = COORD_DECIMALS) -> Tuple[float, float]:
+    """
+    Arredonda {"lat", "lng"} para usar como parte de chave de cache
+    """
+    return (round(point["lat"], decimals), round(point["lng"], decimals))
+
+
+def departure_bucket(departure_time: datetime, minutes: int = DEPARTURE_BUCKET_MINUTES) -> int:
+    """
+    Índice da janela de `minutes` minutos que contém o horário de partida
+    """
+    return int(departure_time.timestamp() // (minutes * 60))
+
+
+def geohash_encode(lat: float, lng: float, precision: int = SEARCH_CELL_PRECISION) -> str:
+    """
+    Geohash da célula que contém o ponto
+    """
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True  # bits pares codificam longitude
+
+    while len(chars) < precision:
+        rng, value = (lng_range, lng) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            rng[0] = mid
+        else:
+            bits <<= 1
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_GEOHASH_ALPHABET[bits])
+            bits = bit_count = 0
+
+    return "".join(chars)
+
+
+def geohash_bounds(cell: str) -> Tuple[float, float, float, float]:
+    """
+    Retângulo (min_lat, min_lng, max_lat, max_lng) da célula
+    """
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in cell:
+        bits = _GEOHASH_INDEX[char]
+        for shift in range(4, -1, -1):
+            rng = lng_range if even else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            if (bits >> shift) & 1:
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            even = not even
+    return lat_range[0], lng_range[0], lat_range[1], lng_range[1]
+
+
+def geohash_center(cell: str) -> dict:
+    """
+    Centro da célula como {"lat", "lng"}
+    """
+    min_lat, min_lng, max_lat, max_lng = geohash_bounds(cell)
+    return {"lat": (min_lat + max_lat) / 2, "lng": (min_lng + max_lng) / 2}
+
+
+def geohash_neighbors(cell: str) -> List[str]:
+    """
+    A célula e suas 8 vizinhas (mesma precisão)
+    """
+    min_lat, min_lng, max_lat, max_lng = geohash_bounds(cell)
+    height, width = max_lat - min_lat, max_lng - min_lng
+    center_lat, center_lng = (min_lat + max_lat) / 2, (min_lng + max_lng) / 2
+    return [
+        geohash_encode(center_lat + dy * height, center_lng + dx * width, len(cell))
+        for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+    ]
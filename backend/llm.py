@@ -0,0 +1,255 @@
+"""
+Melhoria #20: chamada única ao LLM com saída estruturada
+Todas as features com GPT pedem JSON via response_format (JSON schema gerado
+do modelo pydantic), com max_tokens apertado. A resposta é validada no modelo
+tipado; se não passar, tenta uma vez mais mandando o erro de volta ao modelo.
+"""
+
+import asyncio
+import json
+from typing import Callable, List, Tuple, Type, TypeVar
+
+from pydantic import BaseModel
+
+import metrics
+from external import get_executor
+
+DEFAULT_MODEL = "gpt-4o-mini"
+
+# Quantas novas tentativas depois de uma resposta fora do schema
+SCHEMA_RETRIES = 1
+
+T = TypeVar("T", bound=BaseModel)
+
+
+class LLMResponseError(Exception):
+    """O modelo não devolveu um JSON válido para o schema pedido"""
+
+
+# Chaves cujo valor é um mapa nome -> schema (os nomes não são palavras do schema)
+_SCHEMA_MAPS = ("properties", "$defs", "definitions", "patternProperties")
+# Chaves cujo valor é dado, não schema: copiadas como estão
+_SCHEMA_VALUES = ("enum", "const", "examples", "required")
+
+
+def _strict(schema):
+    """
+    Ajusta o JSON schema do pydantic ao modo strict da OpenAI: todo objeto
+    fecha additionalProperties e lista todas as propriedades como obrigatórias
+    (campos opcionais continuam aceitando null). "default" e "title" saem só
+    dos nós de schema; uma propriedade chamada "title" continua lá.
+    """
+    if isinstance(schema, list):
+        return [_strict(item) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+
+    node = {}
+    for key, value in schema.items():
+        if key in ("default", "title"):
+            continue
+        if key in _SCHEMA_MAPS and isinstance(value, dict):
+            node[key] = {name: _strict(sub) for name, sub in value.items()}
+        elif key in _SCHEMA_VALUES:
+            node[key] = value
+        else:
+            node[key] = _strict(value)
+    if node.get("type") == "object" and "properties" in node:
+        node["additionalProperties"] = False
+        node["required"] = list(node["properties"])
+    return node
+
+
+def response_format(model: Type[BaseModel]) -> dict:
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": model.__name__,
+            "schema": _strict(model.model_json_schema()),
+            "strict": True,
+        },
+    }
+
+
+def extract_json(content: str) -> dict:
+    """
+    Lê o primeiro objeto JSON da resposta, ignorando texto ou cercas ```json
+    em volta (modelos sem suporte a response_format ainda fazem isso)
+    """
+    start = content.find("{")
+    if start < 0:
+        raise ValueError("resposta sem objeto JSON")
+    value, _ = json.JSONDecoder().raw_decode(content, start)
+    return value
+
+
+async def complete_json(
+    client,
+    messages: List[dict],
+    schema: Type[T],
+    *,
+    max_tokens: int,
+    temperature: float = 0.3,
+    model: str = DEFAULT_MODEL,
+) -> Tuple[T, int]:
+    """
+    Chama o chat completions com saída estruturada e retorna
+    (resposta validada no `schema`, tokens gastos somando as tentativas).
+    Levanta LLMResponseError se nenhuma tentativa passar na validação.
+    """
+    messages = list(messages)
+    tokens = 0
+    error = None
+
+    for _ in range(SCHEMA_RETRIES + 1):
+        response = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            response_format=response_format(schema),
+        )
+        usage = getattr(response, "usage", None)
+        spent = getattr(usage, "total_tokens", 0) or 0
+        tokens += spent
+        metrics.llm_tokens.inc(spent, schema=schema.__name__)
+
+        choice = response.choices[0]
+        content = (choice.message.content or "").strip()
+        try:
+            if getattr(choice, "finish_reason", None) == "length":
+                raise ValueError(f"resposta cortada em max_tokens={max_tokens}")
+            return schema.model_validate(extract_json(content)), tokens
+        except ValueError as e:  # inclui JSONDecodeError e ValidationError
+            error = e
+
+        messages += [
+            {"role": "assistant", "content": content},
+            {"role": "user", "content": (
+                f"A resposta anterior é inválida: {error}. "
+                "Responda de novo apenas com o JSON corrigido, no formato pedido."
+            )},
+        ]
+
+    raise LLMResponseError(f"{schema.__name__}: {error}")
+
+
+class JSONArrayStream:
+    """
+    Melhoria #21: decodificador incremental do JSON que chega em streaming.
+    Recebe pedaços do texto e devolve cada objeto do primeiro array
+    (ex: {"tasks": [{...}, {...}]}) assim que ele fecha.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._item_start = None
+        self._array_done = False
+
+    def feed(self, chunk: str) -> List[dict]:
+        self.text += chunk
+        items = []
+        for i in range(self._pos, len(self.text)):
+            char = self.text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+
+            if char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._stack.append(char)
+                if char == "{" and self._stack[:-1] == ["{", "["] and not self._array_done:
+                    self._item_start = i
+            elif char in "}]":
+                if self._stack:
+                    self._stack.pop()
+                if char == "}" and self._item_start is not None and self._stack == ["{", "["]:
+                    items.append(json.loads(self.text[self._item_start:i + 1]))
+                    self._item_start = None
+                elif char == "]" and self._stack == ["{"]:
+                    self._array_done = True
+        self._pos = len(self.text)
+        return items
+
+
+async def stream_json(
+    client,
+    messages: List[dict],
+    schema: Type[T],
+    item_schema: Type[BaseModel],
+    on_item: Callable[[BaseModel], None],
+    *,
+    max_tokens: int,
+    temperature: float = 0.3,
+    model: str = DEFAULT_MODEL,
+) -> Tuple[T, int]:
+    """
+    Como complete_json, mas com stream=True: cada elemento do array da
+    resposta é validado em `item_schema` e entregue a `on_item` assim que
+    fecha, antes de o modelo terminar. Retorna (resposta completa, tokens).
+    Sem nova tentativa: uma resposta inválida levanta LLMResponseError.
+    """
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        response_format=response_format(schema),
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+
+    # O iterador do SDK síncrono bloqueia: é consumido numa thread do pool
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    end = object()
+
+    def pump():
+        try:
+            for chunk in stream:
+                loop.call_soon_threadsafe(queue.put_nowait, chunk)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, end)
+
+    loop.run_in_executor(get_executor(), pump)
+
+    decoder = JSONArrayStream()
+    tokens = 0
+    finish_reason = None
+    try:
+        while (chunk := await queue.get()) is not end:
+            if isinstance(chunk, Exception):
+                raise chunk
+            usage = getattr(chunk, "usage", None)
+            tokens += getattr(usage, "total_tokens", 0) or 0
+            for choice in getattr(chunk, "choices", None) or []:
+                finish_reason = getattr(choice, "finish_reason", None) or finish_reason
+                for item in decoder.feed(getattr(choice.delta, "content", None) or ""):
+                    try:
+                        on_item(item_schema.model_validate(item))
+                    except ValueError as e:
+                        raise LLMResponseError(f"{item_schema.__name__}: {e}") from e
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+
+    metrics.llm_tokens.inc(tokens, schema=schema.__name__)
+    try:
+        if finish_reason == "length":
+            raise ValueError(f"resposta cortada em max_tokens={max_tokens}")
+        return schema.model_validate(extract_json(decoder.text)), tokens
+    except ValueError as e:
+        raise LLMResponseError(f"{schema.__name__}: {e}") from e
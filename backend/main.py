@@ -1,23 +1,62 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, create_model, field_validator
+from typing import Callable, List, Literal, Optional
 import os
+import asyncio
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 import json
+import time
+import unicodedata
 from openai import OpenAI
 import googlemaps
 from datetime import datetime, timedelta
-from cache import get_cache_key, get_cached, set_cached, CACHE_TTL_PLACES, CACHE_TTL_ROUTES, get_cache_stats
+from pipeline import StageGraph
+import metrics
+from external import AsyncClient
+from llm import complete_json, stream_json, LLMResponseError
+from delivery import order_deliveries
+from routing import (
+    fetch_duration_matrix, fetch_route_legs, order_stops, matrix_avoid, carpool_detours,
+    RouteLeg, SERVICE_SECONDS, format_duration
+)
+from cache import (
+    get_cache_key, cached_fetch, cached_llm_fetch,
+    CACHE_TTL_PLACES, CACHE_TTL_ROUTES,
+    CACHE_TTL_PLACE_DETAILS, get_cache_stats, run_cache_janitor
+)
+from geo import geohash_encode, geohash_center
+from spatial import POIIndex, precision_for_radius, cell_radius_m, nearest_first, CORRIDOR_SIMPLIFY_M
+import polyline
+from fast_parser import parse_if_confident
 from features import (
     analyze_tourist_route, favorite_routes_manager, split_tasks_multiple_people,
     analyze_shopping_list, generate_proactive_notifications, discover_better_alternatives,
-    check_calendar_conflicts, estimate_crowdedness, add_rest_stops
+    check_calendar_conflicts, estimate_crowdedness, add_rest_stops,
+    TouristItinerary, TaskSplit, ShoppingAnalysis, tourist_route_instructions, split_tasks_instructions,
+    shopping_list_instructions, TOURIST_MAX_TOKENS, SPLIT_MAX_TOKENS, SHOPPING_MAX_TOKENS,
+    ALTERNATIVES_CELL_PRECISION
 )
 
 load_dotenv()
 
-app = FastAPI(title="Smart Errand Runner API")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Melhoria #7: limpeza periódica das entradas expiradas do cache
+    janitor = asyncio.create_task(run_cache_janitor())
+    # Melhoria #27: dump regional de POIs dispensa as buscas por célula
+    if POI_DUMP_PATH:
+        loaded = poi_index.load_dump(POI_DUMP_PATH)
+        print(f"📍 {loaded} POIs carregados de {POI_DUMP_PATH}")
+    yield
+    janitor.cancel()
+
+
+app = FastAPI(title="Smart Errand Runner API", lifespan=lifespan)
 
 # CORS
 app.add_middleware(
@@ -28,17 +67,79 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Melhoria #31: header Server-Timing em todas as respostas (sem isso, só com "X-Debug-Timing: 1")
+SERVER_TIMING_HEADER = os.getenv("SERVER_TIMING_HEADER", "false").lower() in ("1", "true", "yes")
+
+
+@app.middleware("http")
+async def trace_request(request: Request, call_next):
+    """
+    Melhoria #31: coleta os spans da requisição (estágios e chamadas
+    externas) e mede a duração total por rota
+    """
+    trace = metrics.start_trace()
+    started = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - started
+    
+    route = request.scope.get("route")
+    metrics.http_request_seconds.observe(
+        elapsed, method=request.method, path=getattr(route, "path", "unmatched"), status=response.status_code
+    )
+    if SERVER_TIMING_HEADER or request.headers.get("x-debug-timing") == "1":
+        # Respostas em streaming saem antes dos estágios: só o que já terminou aparece
+        response.headers["Server-Timing"] = metrics.server_timing(trace, elapsed)
+    return response
+
+
 # Initialize APIs
 openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 gmaps = googlemaps.Client(key=os.getenv("GOOGLE_MAPS_API_KEY"))
 
+# Melhoria #9: toda chamada externa passa pelo pool limitado de external.py
+openai_async = AsyncClient(openai_client)
+gmaps_async = AsyncClient(gmaps)
+
+# Melhoria #10: máximo de buscas no Places em paralelo por requisição
+PLACES_MAX_CONCURRENCY = int(os.getenv("PLACES_MAX_CONCURRENCY", "8"))
+
+# Melhoria #25: endpoint em lote: pedidos por chamada e planos simultâneos
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "100"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "4"))
+
+# Melhoria #28: máximo de células (geohash) consultadas em "Descubra Locais Novos"
+ALTERNATIVES_BUDGET = int(os.getenv("ALTERNATIVES_BUDGET", "6"))
+
+# Melhoria #29: zoom usado na simplificação da rota quando o cliente não informa map_zoom
+ROUTE_POLYLINE_ZOOM = int(os.getenv("ROUTE_POLYLINE_ZOOM", "15"))
+
+# Melhoria #27: POIs sugeridos ao longo da rota (tipos do Places, separados por vírgula)
+NEARBY_POI_TYPES = [t.strip() for t in os.getenv("NEARBY_POI_TYPES", "gas_station").split(",") if t.strip()]
+NEARBY_POI_RADIUS = int(os.getenv("NEARBY_POI_RADIUS", "500"))  # metros da rota
+POI_DUMP_PATH = os.getenv("POI_DUMP_PATH")  # dump regional opcional (JSON / JSON Lines)
+# Máximo de células sem cache buscadas (places_nearby) por plano; as demais
+# células do corredor são respondidas só pelo índice / dump
+NEARBY_POI_WARM_BUDGET = int(os.getenv("NEARBY_POI_WARM_BUDGET", "6"))
+# Índice espacial com células do tamanho que o raio exige
+poi_index = POIIndex(precision_for_radius(NEARBY_POI_RADIUS))
+POI_TYPE_LABELS = {
+    "gas_station": "Posto de gasolina",
+    "cafe": "Café",
+    "restaurant": "Restaurante",
+    "pharmacy": "Farmácia",
+    "atm": "Caixa eletrônico",
+    "parking": "Estacionamento",
+    "supermarket": "Supermercado",
+}
+
 
 class ErrandRequest(BaseModel):
     user_input: str
     start_address: str
     start_time: Optional[str] = None  # Format: "HH:MM"
     mode: Optional[str] = "balanced"  # "economy", "fast", "balanced"
-    carpooling: Optional[List[dict]] = None  # [{"name": "Maria", "tasks": "ir ao mercado"}]
+    # [{"name": "Maria", "tasks": "ir ao mercado", "pickup_address": "...", "dropoff_address": "..."}]
+    carpooling: Optional[List[dict]] = None
     suggest_best_time: Optional[bool] = False
     delivery_mode: Optional[bool] = False  # Para modo entregador/uber
     # Novas features
@@ -48,6 +149,9 @@ class ErrandRequest(BaseModel):
     calendar_events: Optional[List[dict]] = None
     include_rest_stops: Optional[bool] = False
     user_id: Optional[str] = "default_user"  # Para rotas favoritas
+    # Melhoria #29: zoom em que o cliente mostra a rota (define a simplificação da polyline)
+    map_zoom: Optional[int] = None
+    leg_polylines: Optional[bool] = False  # Polyline de cada trecho além de route_polyline
 
 
 class Task(BaseModel):
@@ -61,6 +165,49 @@ class Task(BaseModel):
     order: Optional[int] = None
     popular_times: Optional[dict] = None  # Info sobre filas/horários de pico
     combined_with: Optional[List[str]] = None  # Tarefas que podem ser combinadas aqui
+    person: Optional[str] = None  # Carona: de quem é a tarefa (None = do motorista)
+    stop_type: Optional[str] = None  # Carona: "pickup" / "dropoff" (None = tarefa)
+    
+    @property
+    def display_name(self) -> str:
+        """Nome mostrado na rota: tarefas de carona indicam a pessoa"""
+        return f"{self.name} ({self.person})" if self.person and not self.stop_type else self.name
+
+
+# Melhoria #20: uma tarefa como o GPT deve devolver no parse. A docstring vira
+# a descrição no JSON schema enviado ao modelo.
+class ParsedTask(BaseModel):
+    """Uma tarefa do usuário: o que fazer, onde, até que horas e em que ordem"""
+    name: str
+    place_name: Optional[str] = None
+    closing_time: Optional[str] = None  # "HH:MM"
+    constraint: Optional[Literal["first", "last", "urgent"]] = None
+    
+    @field_validator("closing_time")
+    @classmethod
+    def normalize_closing_time(cls, value: Optional[str]) -> Optional[str]:
+        if value is None:
+            return None
+        hour, _, minute = value.strip().lower().replace("h", ":").strip(":").partition(":")
+        return f"{int(hour):02d}:{int(minute or 0):02d}"
+
+
+class ParsedErrands(BaseModel):
+    tasks: List[ParsedTask]
+
+
+# Melhoria #23: tarefa de carona marcada com a pessoa dona dela
+class ParsedCarpoolTask(ParsedTask):
+    """Uma tarefa de carona, com o nome da pessoa que pediu"""
+    person: str
+
+
+class ParsedCarpool(BaseModel):
+    tasks: List[ParsedCarpoolTask]
+
+
+class TaskCombinations(BaseModel):
+    suggestions: List[str]
 
 
 class RouteResponse(BaseModel):
@@ -70,6 +217,7 @@ class RouteResponse(BaseModel):
     total_distance: str
     warnings: List[str]
     map_url: Optional[str] = None
+    route_polyline: Optional[str] = None  # Melhoria #29: geometria da rota inteira (todos os trechos)
     smart_suggestions: Optional[List[str]] = []  # Sugestões inteligentes
     nearby_points: Optional[List[dict]] = []  # Pontos de interesse no caminho
     best_departure_time: Optional[str] = None  # Melhor horário para sair
@@ -87,6 +235,23 @@ class RouteResponse(BaseModel):
     rest_stops: Optional[dict] = None  # FEATURE 15: Pausas
 
 
+class BatchErrandRequest(BaseModel):
+    requests: List[ErrandRequest]
+
+
+class BatchItemResult(BaseModel):
+    index: int  # posição do pedido no lote
+    status_code: int
+    result: Optional[RouteResponse] = None
+    error: Optional[str] = None
+
+
+class BatchRouteResponse(BaseModel):
+    results: List[BatchItemResult]
+    succeeded: int
+    failed: int
+
+
 @app.get("/")
 def read_root():
     return {"message": "Smart Errand Runner API is running"}
@@ -100,6 +265,17 @@ def cache_stats():
     return get_cache_stats()
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    """
+    Melhoria #31: métricas no formato de texto do Prometheus
+    """
+    return PlainTextResponse(
+        metrics.render(metrics.cache_samples(get_cache_stats())),
+        media_type="text/plain; version=0.0.4"
+    )
+
+
 # FEATURE 2: Endpoints para Rotas Favoritas
 @app.post("/api/favorites/save")
 async def save_favorite_route(user_id: str, route_name: str, route_data: dict):
@@ -125,149 +301,493 @@ async def optimize_errands(request: ErrandRequest):
     Main endpoint to optimize errands based on user input with advanced features
     """
     try:
-        # FEATURE 1: Modo Turista
-        tourist_itinerary = None
-        if request.tourist_mode:
-            tourist_itinerary = await analyze_tourist_route(request.user_input)
-        
-        # FEATURE 4: Compras Inteligentes
-        shopping_analysis = None
-        if request.is_shopping_list:
-            items = request.user_input.split(",")
-            shopping_analysis = await analyze_shopping_list(items, {})
-        
-        # Step 1: Use GPT to parse the user input
-        tasks = await parse_errands_with_gpt(request.user_input, request.start_time)
-        
-        # FEATURE 2: Rotas Favoritas - Detectar padrões
-        favorite_match = await favorite_routes_manager.detect_patterns(
-            request.user_id,
-            [t.name for t in tasks]
+        return await plan_errands(request)
+    except Exception as e:
+        raise HTTPException(status_code=error_status(e), detail=str(e))
+
+
+@app.post("/api/optimize-errands/batch", response_model=BatchRouteResponse)
+async def optimize_errands_batch(batch: BatchErrandRequest):
+    """
+    Melhoria #25: planeja vários pedidos de uma vez (ex: a equipe inteira de
+    manhã). Os endereços de partida únicos são geocodificados uma vez antes
+    de tudo; buscas no Places, trechos e células da matriz repetidas entre os
+    itens saem do cache / single-flight. No máximo BATCH_MAX_CONCURRENCY
+    planos rodam ao mesmo tempo e a falha de um item não afeta os outros.
+    """
+    if len(batch.requests) > BATCH_MAX_REQUESTS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Máximo de {BATCH_MAX_REQUESTS} pedidos por lote (recebidos {len(batch.requests)})"
         )
+    
+    # Falhas de geocoding aparecem no item, quando o plano dele tentar de novo
+    await asyncio.gather(*[
+        get_coordinates(address) for address in dict.fromkeys(r.start_address for r in batch.requests)
+    ], return_exceptions=True)
+    
+    semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+    
+    async def plan_item(index: int, request: ErrandRequest) -> BatchItemResult:
+        async with semaphore:
+            try:
+                return BatchItemResult(index=index, status_code=200, result=await plan_errands(request))
+            except Exception as e:
+                return BatchItemResult(index=index, status_code=error_status(e), error=str(e))
+    
+    results = await asyncio.gather(*[plan_item(i, r) for i, r in enumerate(batch.requests)])
+    failed = sum(1 for r in results if r.error is not None)
+    return BatchRouteResponse(results=results, succeeded=len(results) - failed, failed=failed)
+
+
+@app.post("/api/optimize-errands/stream")
+async def optimize_errands_stream(request: ErrandRequest, format: str = "ndjson"):
+    """
+    Melhoria #26: mesma otimização, entregue em partes conforme ficam prontas:
+    parsed_tasks -> tasks (com locais) -> route -> totals -> cada enriquecimento.
+    O cliente já desenha a rota sem esperar o enriquecimento mais lento.
+    format=ndjson (padrão): uma linha JSON {"event", "data"} por parte;
+    format=sse: Server-Sent Events. O último evento é "done" ou "error".
+    """
+    if format not in ("ndjson", "sse"):
+        raise HTTPException(status_code=422, detail="format deve ser 'ndjson' ou 'sse'")
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(stream_plan_events(request, sse=format == "sse"), media_type=media_type)
+
+
+# Melhoria #26: estágios enviados como estão no stream (mesmo nome do campo no RouteResponse)
+STREAMED_SECTIONS = {
+    "smart_suggestions", "nearby_points", "best_departure_time", "economy_savings", "carpooling_info",
+    "tourist_itinerary", "favorite_match", "task_split", "shopping_analysis", "proactive_notifications",
+    "better_alternatives", "calendar_check", "crowdedness_info", "rest_stops"
+}
+
+
+def plan_event(request: ErrandRequest, stage: str, result) -> Optional[tuple]:
+    """
+    (evento, dados) de um estágio concluído, ou None para estágios internos
+    """
+    if stage == "parsed_tasks":
+        return "parsed_tasks", result
+    if stage == "all_tasks":
+        return "tasks", result
+    if stage == "route":
+        return "route", {**serialize_route(request, result[0]), "warnings": result[1]}
+    if stage == "totals":
+        return "totals", {"total_duration": result[0], "total_distance": result[1]}
+    if stage in STREAMED_SECTIONS:
+        return stage, result
+    return None
+
+
+def encode_event(event: str, data, sse: bool) -> str:
+    body = jsonable_encoder(data)
+    if sse:
+        return f"event: {event}\ndata: {json.dumps(body, ensure_ascii=False)}\n\n"
+    return json.dumps({"event": event, "data": body}, ensure_ascii=False) + "\n"
+
+
+async def stream_plan_events(request: ErrandRequest, sse: bool):
+    """
+    Melhoria #26: eventos do plano na ordem em que os estágios terminam
+    """
+    try:
+        async for stage, result in build_errand_graph(request).iter_results():
+            event = plan_event(request, stage, result)
+            if event is not None:
+                yield encode_event(*event, sse)
+    except Exception as e:
+        yield encode_event("error", {"status_code": error_status(e), "detail": str(e)}, sse)
+        return
+    yield encode_event("done", {}, sse)
+
+
+def route_polyline(route_legs: List[RouteLeg], tolerance_m: float) -> Optional[str]:
+    """
+    Melhoria #29: polylines dos trechos numa só geometria, simplificada
+    """
+    parts = [leg.polyline for leg in route_legs if leg.polyline]
+    return polyline.merge(parts, tolerance_m) if parts else None
+
+
+def serialize_route(request: ErrandRequest, route_legs: List[RouteLeg]) -> dict:
+    """
+    Melhoria #29: optimized_route + route_polyline com a geometria
+    simplificada para o zoom do cliente (um pixel de tolerância). As
+    polylines por trecho só vão se o cliente pedir (leg_polylines).
+    """
+    lat = route_legs[0].start_location["lat"] if route_legs else 0.0
+    tolerance = polyline.zoom_tolerance(request.map_zoom or ROUTE_POLYLINE_ZOOM, lat)
+    leg_tolerance = tolerance if request.leg_polylines else None
+    return {
+        "optimized_route": [leg.to_dict(leg_tolerance) for leg in route_legs],
+        "route_polyline": route_polyline(route_legs, tolerance),
+    }
+
+
+def error_status(error: Exception) -> int:
+    """
+    Código HTTP de uma falha no plano
+    """
+    if isinstance(error, LLMResponseError):
+        # Melhoria #20: resposta do modelo fora do schema mesmo após a nova tentativa
+        return 502
+    return 500
+
+
+async def plan_errands(request: ErrandRequest) -> RouteResponse:
+    """
+    Executa o grafo de estágios de um pedido e monta a resposta
+    """
+    results = await build_errand_graph(request).run()
+    return RouteResponse(
+        tasks=results["all_tasks"],
+        **serialize_route(request, results["route"][0]),
+        total_duration=results["totals"][0],
+        total_distance=results["totals"][1],
+        warnings=results["route"][1],
+        map_url=None,
+        smart_suggestions=results["smart_suggestions"],
+        nearby_points=results["nearby_points"],
+        best_departure_time=results["best_departure_time"],
+        economy_savings=results["economy_savings"],
+        carpooling_info=results["carpooling_info"],
+        # Novas features
+        tourist_itinerary=results["tourist_itinerary"],
+        favorite_match=results["favorite_match"],
+        task_split=results["task_split"],
+        shopping_analysis=results["shopping_analysis"],
+        proactive_notifications=results["proactive_notifications"],
+        better_alternatives=results["better_alternatives"],
+        calendar_check=results["calendar_check"],
+        crowdedness_info=results["crowdedness_info"],
+        rest_stops=results["rest_stops"]
+    )
+
+
+def build_errand_graph(request: ErrandRequest) -> StageGraph:
+    """
+    Melhoria #8: Monta o grafo de estágios do optimize_errands.
+    Cada estágio declara apenas as entradas de que realmente precisa, então
+    GPT, geocoding e Places rodam em paralelo e a latência fica próxima do
+    caminho crítico (parse -> places -> rota -> enriquecimentos).
+    """
+    graph = StageGraph()
+    split_enabled = bool(request.num_people_split and request.num_people_split > 1)
+    # Melhoria #22: o split entra no lote só sem carona (senão precisa das tarefas dos outros)
+    batch_split = split_enabled and not request.carpooling
+    batched = LLM_PROMPT_BATCHING and (
+        bool(request.tourist_mode) or bool(request.is_shopping_list) or batch_split
+    )
+    
+    if batched:
+        # O parse fica fora do lote: tarefas, lugares e rota não esperam a resposta combinada
+        graph.add("llm_batch", lambda parsed_tasks: request_batched_analysis(
+            request, parsed_tasks, include_split=batch_split
+        ), deps=["parsed_tasks"])
         
-        # Step 2: Find places using Google Places API
-        start_coords = get_coordinates(request.start_address)
-        tasks = await find_places_for_tasks(tasks, start_coords)
-        
-        # FEATURE 14: Evite Multidões
-        crowdedness_info = []
-        for task in tasks:
-            if hasattr(task, 'popular_times') and task.popular_times:
-                crowd_data = estimate_crowdedness(
-                    task.popular_times.get("types", []),
-                    datetime.now().hour,
-                    datetime.now().weekday()
-                )
-                crowdedness_info.append({
-                    "task": task.name,
-                    **crowd_data
-                })
-        
-        # NEW FEATURE 2: Sugestões Inteligentes de Combinação
-        smart_suggestions = await analyze_task_combinations(tasks)
-        
-        # NEW FEATURE 4: Modo Carona (Carpooling)
-        carpooling_info = None
-        if request.carpooling:
-            carpooling_tasks = await parse_carpooling_tasks(request.carpooling, start_coords)
-            tasks.extend(carpooling_tasks)
-            carpooling_info = await optimize_carpooling(tasks, carpooling_tasks)
+        # FEATURE 1 / FEATURE 4 / NEW FEATURE 2: saem da mesma resposta
+        graph.add("tourist_itinerary", lambda llm_batch: llm_batch["tourist_itinerary"],
+                  deps=["llm_batch"], enabled=bool(request.tourist_mode))
+        graph.add("shopping_analysis", lambda llm_batch: llm_batch["shopping_analysis"],
+                  deps=["llm_batch"], enabled=bool(request.is_shopping_list))
+        graph.add("smart_suggestions", lambda llm_batch: llm_batch["smart_suggestions"], deps=["llm_batch"])
+    else:
+        # FEATURE 1: Modo Turista
+        graph.add("tourist_itinerary", lambda: analyze_tourist_route(request.user_input),
+                  enabled=bool(request.tourist_mode))
         
-        # NEW FEATURE 3: Melhor Horário para Sair
-        best_departure_time = None
-        if request.suggest_best_time:
-            best_departure_time = await suggest_best_departure_time(tasks, start_coords)
+        # FEATURE 4: Compras Inteligentes
+        graph.add("shopping_analysis", lambda: analyze_shopping_list(request.user_input.split(","), {}),
+                  enabled=bool(request.is_shopping_list))
         
-        # Step 3: Optimize route considering time constraints and mode
-        optimized_route, warnings = await optimize_route_with_constraints(
-            tasks, start_coords, request.start_time or "now", 
-            mode=request.mode, delivery_mode=request.delivery_mode
+        # NEW FEATURE 2: Sugestões Inteligentes de Combinação (só precisa dos nomes)
+        graph.add("smart_suggestions", lambda parsed_tasks: analyze_task_combinations(parsed_tasks),
+                  deps=["parsed_tasks"])
+    
+    # Step 1: Use GPT to parse the user input
+    graph.add("start_coords", lambda: get_coordinates(request.start_address))
+    if LLM_STREAM_PARSE:
+        # Melhoria #21: as buscas no Places começam durante a geração do parse
+        graph.add("parse_stream", lambda: parse_and_find_places(request))
+        graph.add("parsed_tasks", lambda parse_stream: parse_stream.parsed, deps=["parse_stream"])
+    else:
+        graph.add("parsed_tasks", lambda: parse_errands_with_gpt(request.user_input, request.start_time))
+    
+    # FEATURE 2: Rotas Favoritas - Detectar padrões
+    graph.add("favorite_match", lambda parsed_tasks: favorite_routes_manager.detect_patterns(
+        request.user_id, [t.name for t in parsed_tasks]
+    ), deps=["parsed_tasks"])
+    
+    # Step 2: Find places using Google Places API
+    if LLM_STREAM_PARSE:
+        graph.add("tasks", lambda parse_stream: parse_stream.places, deps=["parse_stream"])
+    else:
+        graph.add("tasks", lambda parsed_tasks, start_coords: find_places_for_tasks(parsed_tasks, start_coords),
+                  deps=["parsed_tasks", "start_coords"])
+    
+    # FEATURE 14: Evite Multidões
+    graph.add("crowdedness_info", build_crowdedness_info, deps=["tasks"])
+    
+    # NEW FEATURE 4: Modo Carona (Carpooling)
+    # Melhoria #24: embarque, tarefas (com local) e desembarque de cada pessoa
+    graph.add("carpooling_tasks", lambda start_coords: build_carpool_stops(request.carpooling, start_coords),
+              deps=["start_coords"], enabled=bool(request.carpooling), default=[])
+    graph.add("all_tasks", lambda tasks, carpooling_tasks: tasks + carpooling_tasks,
+              deps=["tasks", "carpooling_tasks"])
+    
+    # NEW FEATURE 3: Melhor Horário para Sair
+    graph.add("best_departure_time", lambda all_tasks, start_coords: suggest_best_departure_time(
+        all_tasks, start_coords
+    ), deps=["all_tasks", "start_coords"], enabled=bool(request.suggest_best_time))
+    
+    # Step 3: Optimize route considering time constraints and mode
+    graph.add("route", lambda all_tasks, start_coords: optimize_route_with_constraints(
+        all_tasks, start_coords, request.start_time or "now",
+        mode=request.mode, delivery_mode=request.delivery_mode
+    ), deps=["all_tasks", "start_coords"])
+    
+    # NEW FEATURE 4: desvio real de cada pessoa da carona (sai junto com a rota)
+    graph.add("carpooling_info", lambda all_tasks, carpooling_tasks, route: optimize_carpooling(
+        all_tasks, carpooling_tasks, route[2]
+    ), deps=["all_tasks", "carpooling_tasks", "route"], enabled=bool(request.carpooling))
+    
+    # NEW FEATURE 11: Pontos de Interesse no Caminho
+    graph.add("nearby_points", lambda route: find_nearby_points_of_interest(route[0]), deps=["route"])
+    
+    # Step 4: Calculate total duration and distance
+    graph.add("totals", lambda route: calculate_totals(route[0]), deps=["route"])
+    
+    # NEW FEATURE 1: Economia vs Rápido - Calcular savings
+    graph.add("economy_savings", lambda route: calculate_mode_savings(route[0], request.mode),
+              deps=["route"], enabled=request.mode in ["economy", "fast"])
+    
+    # FEATURE 3: Split de Tarefas
+    if batched and batch_split:
+        graph.add("task_split", lambda llm_batch: llm_batch["task_split"], deps=["llm_batch"])
+    else:
+        graph.add("task_split", lambda all_tasks: split_tasks_multiple_people(
+            [{"name": t.name, "address": t.address} for t in all_tasks if not t.stop_type],
+            request.num_people_split
+        ), deps=["all_tasks"], enabled=split_enabled)
+    
+    # FEATURE 7: Assistant Proativo
+    graph.add("proactive_notifications", lambda route: generate_proactive_notifications({
+        "optimized_route": route[0],
+        "start_time": request.start_time
+    }, datetime.now()), deps=["route"])
+    
+    # FEATURE 8: Descubra Locais Novos
+    graph.add("better_alternatives", find_better_alternatives, deps=["tasks"])
+    
+    # FEATURE 12: Integração com Calendário
+    graph.add("calendar_check", lambda totals: check_calendar_conflicts({
+        "start_time": request.start_time,
+        "total_duration_s": totals[2]
+    }, request.calendar_events), deps=["totals"], enabled=bool(request.calendar_events))
+    
+    # FEATURE 15: Rota com Pausas
+    graph.add("rest_stops", lambda route: add_rest_stops(route[0]),
+              deps=["route"], enabled=bool(request.include_rest_stops))
+    
+    return graph
+
+
+# Melhoria #22: resposta máxima das sugestões de combinação
+COMBINATIONS_MAX_TOKENS = 200
+
+
+async def request_batched_analysis(request: ErrandRequest, parsed_tasks: List[Task],
+                                   include_split: bool) -> dict:
+    """
+    Melhoria #22: prompt batching. Sugestões de combinação, modo turista,
+    compras e split (os que estiverem habilitados) viram seções de um único
+    pedido estruturado: o texto do usuário vai uma vez só e a resposta é
+    separada de volta nos campos do RouteResponse. O parse não entra no lote
+    (a rota depende dele e não deve esperar a resposta combinada). Se a
+    chamada combinada falhar na validação, cada feature é pedida separadamente.
+    """
+    sections = []  # (campo, tipo, instruções, max_tokens)
+    task_list = "\n".join(f"- {t.name} em {t.place_name or 'local desconhecido'}" for t in parsed_tasks)
+    
+    sections.append(("smart_suggestions", List[str], (
+        f"Analise esta lista de tarefas e sugira combinações inteligentes:\n\n{task_list}\n\n"
+        f"{COMBINATION_GUIDELINES}\n\nSugestões práticas e curtas. Máximo 3 sugestões."
+    ), COMBINATIONS_MAX_TOKENS))
+    if request.tourist_mode:
+        sections.append(("tourist_itinerary", TouristItinerary,
+                         tourist_route_instructions(request.user_input), TOURIST_MAX_TOKENS))
+    if request.is_shopping_list:
+        sections.append(("shopping_analysis", ShoppingAnalysis,
+                         shopping_list_instructions(request.user_input.split(",")), SHOPPING_MAX_TOKENS))
+    if include_split:
+        sections.append(("task_split", TaskSplit,
+                         split_tasks_instructions(task_list, request.num_people_split), SPLIT_MAX_TOKENS))
+    
+    schema = create_model("PlanAnalysis", **{name: (kind, ...) for name, kind, _, _ in sections})
+    prompt = "Responda um único JSON com uma chave para cada seção abaixo.\n\n" + "\n\n".join(
+        f"## Seção {name}\n{instructions}" for name, _, instructions, _ in sections
+    )
+    
+    try:
+        result, _ = await complete_json(
+            openai_async,
+            [{"role": "user", "content": prompt}],
+            schema,
+            temperature=0.5,
+            max_tokens=sum(budget for _, _, _, budget in sections)
         )
-        
-        # NEW FEATURE 11: Pontos de Interesse no Caminho
-        nearby_points = await find_nearby_points_of_interest(optimized_route)
-        
-        # Step 4: Calculate total duration and distance
-        total_duration, total_distance = calculate_totals(optimized_route)
-        
-        # NEW FEATURE 1: Economia vs Rápido - Calcular savings
-        economy_savings = None
-        if request.mode in ["economy", "fast"]:
-            economy_savings = await calculate_mode_savings(optimized_route, request.mode)
-        
-        # FEATURE 3: Split de Tarefas
-        task_split = None
-        if request.num_people_split and request.num_people_split > 1:
-            task_split = await split_tasks_multiple_people(
-                [{"name": t.name, "address": t.address} for t in tasks],
-                request.num_people_split
+    except LLMResponseError as e:
+        print(f"⚠️  Chamada combinada inválida, pedindo as features separadamente: {e}")
+        return await request_unbatched_analysis(request, parsed_tasks, include_split)
+    
+    def section(name: str):
+        value = getattr(result, name, None)
+        return value.model_dump() if isinstance(value, BaseModel) else value
+    
+    return {
+        "smart_suggestions": (
+            [s.strip() for s in result.smart_suggestions if s.strip()][:3] if len(parsed_tasks) >= 2 else []
+        ),
+        "tourist_itinerary": section("tourist_itinerary"),
+        "shopping_analysis": section("shopping_analysis"),
+        "task_split": section("task_split"),
+    }
+
+
+async def request_unbatched_analysis(request: ErrandRequest, parsed_tasks: List[Task],
+                                     include_split: bool) -> dict:
+    """
+    Melhoria #22: mesmas saídas de request_batched_analysis com uma chamada por feature
+    """
+    async def disabled():
+        return None
+    
+    smart_suggestions, tourist_itinerary, shopping_analysis, task_split = await asyncio.gather(
+        analyze_task_combinations(parsed_tasks),
+        analyze_tourist_route(request.user_input) if request.tourist_mode else disabled(),
+        analyze_shopping_list(request.user_input.split(","), {}) if request.is_shopping_list else disabled(),
+        split_tasks_multiple_people([{"name": t.name} for t in parsed_tasks], request.num_people_split)
+        if include_split else disabled()
+    )
+    return {
+        "smart_suggestions": smart_suggestions,
+        "tourist_itinerary": tourist_itinerary,
+        "shopping_analysis": shopping_analysis,
+        "task_split": task_split,
+    }
+
+
+def build_crowdedness_info(tasks: List[Task]) -> List[dict]:
+    """
+    FEATURE 14: Evite Multidões - lotação estimada para cada local encontrado
+    """
+    crowdedness_info = []
+    for task in tasks:
+        if hasattr(task, 'popular_times') and task.popular_times:
+            crowd_data = estimate_crowdedness(
+                task.popular_times.get("types", []),
+                datetime.now().hour,
+                datetime.now().weekday()
             )
-        
-        # FEATURE 7: Assistant Proativo
-        proactive_notifications = generate_proactive_notifications({
-            "optimized_route": optimized_route,
-            "start_time": request.start_time
-        }, datetime.now())
-        
-        # FEATURE 8: Descubra Locais Novos
-        better_alternatives = []
-        for task in tasks[:2]:  # Apenas primeiros 2 para não sobrecarregar
-            if task.lat and task.lng:
-                alternative = await discover_better_alternatives(
-                    gmaps, 
-                    {"lat": task.lat, "lng": task.lng},
-                    "point_of_interest"
-                )
-                if alternative and alternative.get("has_alternatives"):
-                    better_alternatives.append({
-                        "for_task": task.name,
-                        **alternative
-                    })
-        
-        # FEATURE 12: Integração com Calendário
-        calendar_check = None
-        if request.calendar_events:
-            calendar_check = check_calendar_conflicts({
-                "start_time": request.start_time,
-                "total_duration": total_duration
-            }, request.calendar_events)
-        
-        # FEATURE 15: Rota com Pausas
-        rest_stops = None
-        if request.include_rest_stops:
-            rest_stops = add_rest_stops(optimized_route)
-        
-        return RouteResponse(
-            tasks=tasks,
-            optimized_route=optimized_route,
-            total_duration=total_duration,
-            total_distance=total_distance,
-            warnings=warnings,
-            map_url=None,
-            smart_suggestions=smart_suggestions,
-            nearby_points=nearby_points,
-            best_departure_time=best_departure_time,
-            economy_savings=economy_savings,
-            carpooling_info=carpooling_info,
-            # Novas features
-            tourist_itinerary=tourist_itinerary,
-            favorite_match=favorite_match,
-            task_split=task_split,
-            shopping_analysis=shopping_analysis,
-            proactive_notifications=proactive_notifications,
-            better_alternatives=better_alternatives,
-            calendar_check=calendar_check,
-            crowdedness_info=crowdedness_info,
-            rest_stops=rest_stops
-        )
+            crowdedness_info.append({
+                "task": task.name,
+                **crowd_data
+            })
+    return crowdedness_info
+
+
+async def find_better_alternatives(tasks: List[Task]) -> List[dict]:
+    """
+    FEATURE 8: Descubra Locais Novos
+    Melhoria #28: todas as tarefas ao mesmo tempo; tarefas na mesma célula
+    dividem uma busca. ALTERNATIVES_BUDGET limita as células consultadas.
+    """
+    place_type = "point_of_interest"
+    selected, cells = [], set()
+    for task in tasks:
+        if not (task.lat and task.lng):
+            continue
+        cell = geohash_encode(task.lat, task.lng, ALTERNATIVES_CELL_PRECISION)
+        if cell not in cells and len(cells) >= ALTERNATIVES_BUDGET:
+            continue
+        cells.add(cell)
+        selected.append(task)
     
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    alternatives = await asyncio.gather(*[
+        discover_better_alternatives(gmaps_async, {"lat": task.lat, "lng": task.lng}, place_type)
+        for task in selected
+    ])
+    
+    return [
+        {"for_task": task.name, **alternative}
+        for task, alternative in zip(selected, alternatives)
+        if alternative and alternative.get("has_alternatives")
+    ]
+
+
+# Melhoria #18: incrementar sempre que o prompt do parse mudar (invalida o cache)
+PARSE_PROMPT_VERSION = "v2"
 
+# Melhoria #20: resposta do parse limitada (~40 tokens por tarefa)
+PARSE_MAX_TOKENS = 800
 
-async def parse_errands_with_gpt(user_input: str, start_time: Optional[str]) -> List[Task]:
+# Melhoria #22: features com GPT habilitadas na mesma requisição vão numa única chamada
+LLM_PROMPT_BATCHING = os.getenv("LLM_PROMPT_BATCHING", "true").lower() in ("1", "true", "yes")
+
+# Melhoria #23: tarefas de todos os passageiros da carona numa única chamada
+CARPOOL_BATCH_PARSE = os.getenv("CARPOOL_BATCH_PARSE", "true").lower() in ("1", "true", "yes")
+
+# Melhoria #21: parse em streaming; a busca de cada local começa assim que a tarefa sai do modelo
+LLM_STREAM_PARSE = os.getenv("LLM_STREAM_PARSE", "false").lower() in ("1", "true", "yes")
+
+
+def normalize_errand_text(user_input: str) -> str:
+    """
+    Normaliza o texto do usuário para a chave do cache do LLM
+    """
+    return " ".join(user_input.casefold().split())
+
+
+def parse_cache_key(user_input: str, start_time: Optional[str]) -> str:
+    return get_cache_key(
+        'llm_parse', PARSE_PROMPT_VERSION, normalize_errand_text(user_input), start_time or 'agora'
+    )
+
+
+async def parse_errands_with_gpt(user_input: str, start_time: Optional[str],
+                                 on_task: Optional[Callable[[Task], None]] = None) -> List[Task]:
     """
     Use GPT to parse natural language input into structured tasks
+    Melhoria #18: a mesma lista (normalizada) com o mesmo horário não chama o modelo de novo
+    Melhoria #19: frases comuns são interpretadas pelo parser local; o GPT só
+    é chamado quando a confiança dele é baixa
+    Melhoria #21: com LLM_STREAM_PARSE, `on_task` recebe cada tarefa assim que
+    o modelo termina de gerá-la (as primeiras tarefas retornadas são esses
+    mesmos objetos). Sem streaming (parser local, cache) ele não é chamado.
+    """
+    local_tasks = parse_if_confident(user_input)
+    if local_tasks is not None:
+        return [Task(**task) for task in local_tasks]
+    
+    streamed: List[Task] = []
+    
+    def emit(task: Task):
+        streamed.append(task)
+        on_task(task)
+    
+    if on_task is not None and LLM_STREAM_PARSE:
+        fetch = lambda: stream_errand_parse(user_input, start_time, emit)
+    else:
+        fetch = lambda: request_errand_parse(user_input, start_time)
+    
+    parsed_tasks = await cached_llm_fetch(parse_cache_key(user_input, start_time), fetch)
+    return streamed + [Task(**task) for task in parsed_tasks[len(streamed):]]
+
+
+def errand_parse_messages(user_input: str, start_time: Optional[str]) -> List[dict]:
+    """
+    Mensagens (system + user) do parse de recados
     """
     system_prompt = """Você é um assistente que interpreta listas de tarefas/recados.
     Analise o texto do usuário e extraia:
@@ -276,7 +796,7 @@ async def parse_errands_with_gpt(user_input: str, start_time: Optional[str]) ->
     3. Restrições de horário (ex: "fecha às 16h")
     4. Restrições de ordem (ex: "na volta", "primeiro", "último")
     
-    Retorne APENAS um JSON válido no formato:
+    Retorne um JSON no formato:
     {
         "tasks": [
             {
@@ -294,110 +814,237 @@ async def parse_errands_with_gpt(user_input: str, start_time: Optional[str]) ->
     
     user_prompt = f"Hora de início: {start_time or 'agora'}\n\nTarefas: {user_input}"
     
-    response = openai_client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ],
-        temperature=0.3
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+
+async def request_errand_parse(user_input: str, start_time: Optional[str]) -> tuple:
+    """
+    Chama o GPT e retorna (lista de tarefas em dict, tokens gastos)
+    """
+    parsed, tokens = await complete_json(
+        openai_async,
+        errand_parse_messages(user_input, start_time),
+        ParsedErrands,
+        temperature=0.3,
+        max_tokens=PARSE_MAX_TOKENS
     )
     
-    content = response.choices[0].message.content.strip()
+    return [task.model_dump() for task in parsed.tasks], tokens
+
+
+async def stream_errand_parse(user_input: str, start_time: Optional[str],
+                              on_task: Callable[[Task], None]) -> tuple:
+    """
+    Melhoria #21: parse em streaming. Cada tarefa vai para `on_task` assim que
+    o objeto dela fecha no texto gerado; retorna (tarefas em dict, tokens).
+    Se a resposta for inválida antes da primeira tarefa, cai no parse normal
+    (que tem a nova tentativa).
+    """
+    emitted = 0
     
-    # Try to extract JSON from markdown code blocks if present
-    if "```json" in content:
-        content = content.split("```json")[1].split("```")[0].strip()
-    elif "```" in content:
-        content = content.split("```")[1].split("```")[0].strip()
+    def emit(item: ParsedTask):
+        nonlocal emitted
+        emitted += 1
+        on_task(Task(**item.model_dump()))
     
-    parsed = json.loads(content)
-    tasks = [Task(**task) for task in parsed["tasks"]]
+    try:
+        parsed, tokens = await stream_json(
+            openai_async,
+            errand_parse_messages(user_input, start_time),
+            ParsedErrands,
+            ParsedTask,
+            emit,
+            temperature=0.3,
+            max_tokens=PARSE_MAX_TOKENS
+        )
+    except LLMResponseError:
+        if emitted:
+            raise
+        return await request_errand_parse(user_input, start_time)
     
-    return tasks
+    return [task.model_dump() for task in parsed.tasks], tokens
 
 
-def get_coordinates(address: str) -> dict:
+async def get_coordinates(address: str) -> dict:
     """
     Get latitude and longitude for an address
     Melhoria #7: Com cache inteligente
+    Melhoria #17: geocodings concorrentes do mesmo endereço viram uma só chamada
     """
-    # Tentar recuperar do cache
-    cache_key = get_cache_key('geocoding', address)
-    cached = get_cached(cache_key, CACHE_TTL_PLACES)
-    if cached:
-        print(f"✅ Cache HIT: geocoding {address[:30]}...")
-        return cached
-    
-    print(f"❌ Cache MISS: geocoding {address[:30]}...")
-    geocode_result = gmaps.geocode(address)
-    if not geocode_result:
-        raise ValueError(f"Could not find coordinates for address: {address}")
-    
-    location = geocode_result[0]["geometry"]["location"]
-    result = {"lat": location["lat"], "lng": location["lng"]}
-    
-    # Armazenar no cache
-    set_cached(cache_key, result)
+    async def geocode() -> dict:
+        geocode_result = await gmaps_async.geocode(address)
+        if not geocode_result:
+            raise ValueError(f"Could not find coordinates for address: {address}")
+        
+        location = geocode_result[0]["geometry"]["location"]
+        return {"lat": location["lat"], "lng": location["lng"]}
     
-    return result
+    return await cached_fetch(get_cache_key('geocoding', address), geocode, CACHE_TTL_PLACES)
 
 
 async def find_places_for_tasks(tasks: List[Task], start_coords: dict) -> List[Task]:
     """
     Find actual places for each task using Google Places API
     NEW FEATURE 10: Includes popular_times (queue info)
+    Melhoria #10: todas as tarefas são resolvidas em paralelo (limitado por
+    PLACES_MAX_CONCURRENCY); a busca de detalhes de cada tarefa começa assim
+    que a sua própria busca termina. Uma falha não derruba as demais.
     """
-    for task in tasks:
-        if task.place_name:
-            # Search for the place
-            places_result = gmaps.places(
-                query=task.place_name,
-                location=(start_coords["lat"], start_coords["lng"]),
-                radius=10000  # 10km radius
-            )
-            
-            if places_result["results"]:
-                place = places_result["results"][0]
-                task.address = place["formatted_address"]
-                task.lat = place["geometry"]["location"]["lat"]
-                task.lng = place["geometry"]["location"]["lng"]
-                
-                # Get types from initial search result
-                place_types = place.get("types", [])
-                
-                # Get place details for opening hours
-                place_details = gmaps.place(place["place_id"], 
-                                           fields=["opening_hours", "name"])
-                result = place_details["result"]
-                
-                if "opening_hours" in result:
-                    opening_hours = result["opening_hours"]
-                    if "periods" in opening_hours and not task.closing_time:
-                        # Extract closing time for today
-                        try:
-                            today = datetime.now().weekday()
-                            for period in opening_hours["periods"]:
-                                if "close" in period:
-                                    close_time = period["close"]["time"]
-                                    task.closing_time = f"{close_time[:2]}:{close_time[2:]}"
-                                    break
-                        except:
-                            pass
-                
-                # NEW FEATURE 10: Extract popular times info
-                # Note: Google doesn't provide this directly via API, but we can simulate
-                # In production, you'd use populartimes library or scrape
-                current_hour = datetime.now().hour
-                task.popular_times = {
-                    "current_busy_level": estimate_busy_level(current_hour, place_types),
-                    "peak_hours": get_peak_hours(place_types),
-                    "recommendation": get_queue_recommendation(current_hour, place_types)
-                }
+    semaphore = asyncio.Semaphore(PLACES_MAX_CONCURRENCY)
+    results = await asyncio.gather(
+        *[resolve_task_place(task, start_coords, semaphore) for task in tasks if task.place_name],
+        return_exceptions=True
+    )
+    for task, result in zip([t for t in tasks if t.place_name], results):
+        if isinstance(result, Exception):
+            print(f"⚠️  Falha ao buscar local para '{task.name}': {result}")
     
     return tasks
 
 
+class StreamedParse:
+    """
+    Melhoria #21: resultado do parse em streaming: as tarefas já interpretadas
+    e a busca dos locais (que começou durante a geração) ainda em andamento
+    """
+    
+    def __init__(self, parsed: List[Task], places: asyncio.Future):
+        self.parsed = parsed
+        self.places = places
+
+
+async def parse_and_find_places(request: ErrandRequest) -> StreamedParse:
+    """
+    Melhoria #21: cada tarefa emitida pelo parse em streaming segue direto para
+    a busca do local. O geocoding da origem é o mesmo do estágio start_coords
+    (cache + single-flight), então não gera chamada extra.
+    """
+    semaphore = asyncio.Semaphore(PLACES_MAX_CONCURRENCY)
+    lookups = []
+    
+    async def resolve(task: Task):
+        start_coords = await get_coordinates(request.start_address)
+        await resolve_task_place(task, start_coords, semaphore)
+    
+    def start_lookup(task: Task):
+        if task.place_name:
+            lookups.append((task, asyncio.ensure_future(resolve(task))))
+    
+    try:
+        parsed = await parse_errands_with_gpt(request.user_input, request.start_time, on_task=start_lookup)
+    except BaseException:
+        for _, lookup in lookups:
+            lookup.cancel()
+        raise
+    
+    # Parser local ou cache: nenhuma tarefa passou pelo streaming
+    started = {id(task) for task, _ in lookups}
+    for task in parsed:
+        if id(task) not in started:
+            start_lookup(task)
+    
+    async def finish() -> List[Task]:
+        results = await asyncio.gather(*[lookup for _, lookup in lookups], return_exceptions=True)
+        for (task, _), result in zip(lookups, results):
+            if isinstance(result, Exception):
+                print(f"⚠️  Falha ao buscar local para '{task.name}': {result}")
+        return parsed
+    
+    return StreamedParse(parsed, asyncio.ensure_future(finish()))
+
+
+async def resolve_task_place(task: Task, start_coords: dict, semaphore: asyncio.Semaphore) -> None:
+    """
+    Resolve o local de uma tarefa: busca textual seguida dos detalhes (horário)
+    """
+    # Search for the place
+    async with semaphore:
+        places_result = await search_places_cached(task.place_name, start_coords)
+    
+    if not places_result["results"]:
+        return
+    
+    place = places_result["results"][0]
+    task.address = place["formatted_address"]
+    task.lat = place["geometry"]["location"]["lat"]
+    task.lng = place["geometry"]["location"]["lng"]
+    
+    # Get types from initial search result
+    place_types = place.get("types", [])
+    
+    # NEW FEATURE 10: Extract popular times info
+    # Note: Google doesn't provide this directly via API, but we can simulate
+    # In production, you'd use populartimes library or scrape
+    current_hour = datetime.now().hour
+    task.popular_times = {
+        "current_busy_level": estimate_busy_level(current_hour, place_types),
+        "peak_hours": get_peak_hours(place_types),
+        "recommendation": get_queue_recommendation(current_hour, place_types)
+    }
+    
+    # Get place details for opening hours
+    async with semaphore:
+        place_details = await get_place_details_cached(place["place_id"])
+    result = place_details["result"]
+    
+    if "opening_hours" in result:
+        opening_hours = result["opening_hours"]
+        if "periods" in opening_hours and not task.closing_time:
+            # Extract closing time for today
+            try:
+                today = datetime.now().weekday()
+                for period in opening_hours["periods"]:
+                    if "close" in period:
+                        close_time = period["close"]["time"]
+                        task.closing_time = f"{close_time[:2]}:{close_time[2:]}"
+                        break
+            except:
+                pass
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normaliza o texto da busca: minúsculas, sem acentos e espaços repetidos
+    """
+    text = unicodedata.normalize("NFKD", query.casefold())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(text.split())
+
+
+async def search_places_cached(query: str, near: dict) -> dict:
+    """
+    Melhoria #16: busca textual em cache por consulta normalizada + célula
+    geográfica (geohash) do ponto de partida. A busca é feita a partir do
+    centro da célula, então o resultado não depende de quem buscou primeiro.
+    """
+    cell = geohash_encode(near["lat"], near["lng"])
+    center = geohash_center(cell)
+    normalized = normalize_query(query)
+    return await cached_fetch(
+        get_cache_key('place_search', normalized, cell),
+        lambda: gmaps_async.places(
+            query=query,
+            location=(center["lat"], center["lng"]),
+            radius=10000  # 10km radius
+        ),
+        CACHE_TTL_PLACES
+    )
+
+
+async def get_place_details_cached(place_id: str) -> dict:
+    """
+    Melhoria #16: detalhes do lugar (horário de funcionamento) em cache por place_id
+    """
+    return await cached_fetch(
+        get_cache_key('place_details', place_id),
+        lambda: gmaps_async.place(place_id, fields=["opening_hours", "name"]),
+        CACHE_TTL_PLACE_DETAILS
+    )
+
+
 def estimate_busy_level(hour: int, place_types: List[str]) -> str:
     """Estimate how busy a place is based on time and type"""
     if "bank" in place_types:
@@ -451,8 +1098,11 @@ async def optimize_route_with_constraints(
     Optimize route considering time constraints using Google Maps Directions API
     NEW FEATURE 1: Supports economy/fast/balanced modes
     NEW FEATURE 12: Supports delivery mode (TSP optimization)
+    Melhoria #12: O(1) chamadas externas por plano (matrix + directions com waypoints)
+    Melhoria #24: retorna também o desvio (segundos) de cada pessoa da carona
     """
     warnings = []
+    detours = {}
     
     # Parse start time
     if start_time == "now":
@@ -466,161 +1116,110 @@ async def optimize_route_with_constraints(
             microsecond=0
         )
     
-    # NEW FEATURE 12: Delivery mode uses different optimization (TSP)
-    if delivery_mode:
-        ordered_tasks = await optimize_delivery_route(tasks, start_coords)
-        warnings.append("🚚 Modo Entregador: Rota otimizada para múltiplas entregas")
-    else:
-        # Separate tasks by constraints
-        first_tasks = [t for t in tasks if t.constraint == "first"]
-        last_tasks = [t for t in tasks if t.constraint == "last"]
-        urgent_tasks = sorted(
-            [t for t in tasks if t.constraint == "urgent" or t.closing_time],
-            key=lambda x: x.closing_time or "23:59"
-        )
-        normal_tasks = [
-            t for t in tasks 
-            if t not in first_tasks and t not in last_tasks and t not in urgent_tasks
-        ]
-        
-        # Build ordered task list
-        ordered_tasks = first_tasks + urgent_tasks + normal_tasks + last_tasks
-    
-    # Create waypoints
-    waypoints = []
-    for task in ordered_tasks:
-        if task.lat and task.lng:
-            waypoints.append({"lat": task.lat, "lng": task.lng, "task": task})
-    
-    # Get directions
-    route_legs = []
-    current_location = start_coords
-    accumulated_time = current_time
-    
     # NEW FEATURE 1: Configure route parameters based on mode
     route_params = {}
     if mode == "economy":
         route_params["avoid"] = ["tolls", "highways"]  # Evita pedágios e rodovias
         warnings.append("🌱 Modo Economia: Rota otimizada para menor distância e sem pedágios")
     elif mode == "fast":
-        route_params["optimize_waypoints"] = False  # Prioriza velocidade sobre distância
         warnings.append("⚡ Modo Rápido: Rota otimizada para menor tempo")
     
-    for i, waypoint in enumerate(waypoints):
-        # Get directions to next waypoint with mode-specific parameters
-        directions = gmaps.directions(
-            origin=current_location,
-            destination={"lat": waypoint["lat"], "lng": waypoint["lng"]},
-            mode="driving",
+    stops = [t for t in tasks if t.lat and t.lng]
+    
+    # O TSP do modo entregador não conhece embarque/desembarque: com carona,
+    # a ordem vem do motor de rotas (precedências e desvio de cada pessoa)
+    if delivery_mode and any(t.person for t in stops):
+        delivery_mode = False
+        warnings.append("🚗 Modo Entregador ignorado: a carona exige buscar e deixar cada pessoa na ordem")
+    
+    # NEW FEATURE 12: Delivery mode uses different optimization (TSP)
+    if delivery_mode:
+        ordered_tasks = await optimize_delivery_route(stops, start_coords)
+        warnings.insert(0, "🚚 Modo Entregador: Rota otimizada para múltiplas entregas")
+    else:
+        # Melhoria #12: uma única Distance Matrix com todos os pares, ordenação local
+        # Melhoria #14: ordem exata respeitando horários de fechamento (routing.order_stops)
+        durations, _ = await fetch_duration_matrix(
+            gmaps_async,
+            [start_coords] + [{"lat": t.lat, "lng": t.lng} for t in stops],
             departure_time=datetime.now(),
-            **route_params
+            avoid=matrix_avoid(route_params.get("avoid"))
         )
-        
-        if directions:
-            leg = directions[0]["legs"][0]
-            duration_seconds = leg["duration"]["value"]
-            
-            # Calculate arrival time
-            accumulated_time += timedelta(seconds=duration_seconds)
-            arrival_time_str = accumulated_time.strftime("%H:%M")
-            
-            # Check if we'll arrive before closing time
-            task = waypoint["task"]
-            if task.closing_time and arrival_time_str > task.closing_time:
-                warnings.append(
-                    f"AVISO: Você pode chegar em '{task.name}' às {arrival_time_str}, "
-                    f"mas fecha às {task.closing_time}!"
-                )
-            
-            route_legs.append({
-                "task": task.name,
-                "address": task.address,
-                "distance": leg["distance"]["text"],
-                "duration": leg["duration"]["text"],
-                "arrival_time": arrival_time_str,
-                "closing_time": task.closing_time,
-                "start_location": leg["start_location"],
-                "end_location": leg["end_location"],
-                "polyline": directions[0]["overview_polyline"]["points"]
-            })
-            
-            current_location = {"lat": waypoint["lat"], "lng": waypoint["lng"]}
-            # Add 10 minutes for the errand
-            accumulated_time += timedelta(minutes=10)
+        ordered_tasks = [stops[i] for i in order_stops(stops, durations, current_time)]
+        if any(t.person for t in stops):
+            detours = carpool_detours(stops, durations, current_time)
     
-    # Add return to home
-    directions_home = gmaps.directions(
-        origin=current_location,
-        destination=start_coords,
-        mode="driving",
-        departure_time=datetime.now()
+    # Melhoria #12: geometria de toda a rota (ida e volta) em uma chamada com waypoints
+    legs = await fetch_route_legs(
+        gmaps_async,
+        start_coords,
+        [{"lat": t.lat, "lng": t.lng} for t in ordered_tasks],
+        start_coords,
+        departure_time=datetime.now(),
+        **route_params
     )
     
-    if directions_home:
-        leg = directions_home[0]["legs"][0]
+    route_legs = []
+    accumulated_time = current_time
+    
+    for task, leg in zip(ordered_tasks, legs):
+        if not leg:
+            continue
+        
+        # Calculate arrival time
         accumulated_time += timedelta(seconds=leg["duration"]["value"])
+        arrival_time_str = accumulated_time.strftime("%H:%M")
         
-        route_legs.append({
-            "task": "Retornar para casa",
-            "address": leg["end_address"],
-            "distance": leg["distance"]["text"],
-            "duration": leg["duration"]["text"],
-            "arrival_time": accumulated_time.strftime("%H:%M"),
-            "closing_time": None,
-            "start_location": leg["start_location"],
-            "end_location": leg["end_location"],
-            "polyline": directions_home[0]["overview_polyline"]["points"]
-        })
+        # Check if we'll arrive before closing time
+        if task.closing_time and arrival_time_str > task.closing_time:
+            warnings.append(
+                f"AVISO: Você pode chegar em '{task.display_name}' às {arrival_time_str}, "
+                f"mas fecha às {task.closing_time}!"
+            )
+        
+        route_legs.append(RouteLeg.from_directions(
+            leg, task.display_name, task.address, arrival_time_str, task.closing_time,
+            person=task.person, stop_type=task.stop_type
+        ))
+        
+        # Add 10 minutes for the errand
+        accumulated_time += timedelta(minutes=10)
+    
+    # Add return to home
+    leg = legs[-1] if legs else None
+    if leg:
+        accumulated_time += timedelta(seconds=leg["duration"]["value"])
+        
+        route_legs.append(RouteLeg.from_directions(
+            leg, "Retornar para casa", leg["end_address"], accumulated_time.strftime("%H:%M")
+        ))
     
-    return route_legs, warnings
+    return route_legs, warnings, detours
 
 
-def calculate_totals(route_legs: List[dict]) -> tuple:
+def calculate_totals(route_legs: List[RouteLeg]) -> tuple:
     """
     Calculate total duration and distance
+    Melhoria #30: soma direta dos segundos/metros dos trechos.
+    Retorna (duração em texto, distância em texto, segundos, metros).
     """
-    total_duration_min = 0
-    total_distance_km = 0.0
-    
-    for leg in route_legs[:-1]:  # Exclude return home from duration count
-        # Parse duration (e.g., "15 mins" or "1 hour 20 mins")
-        duration_text = leg["duration"]
-        if "hour" in duration_text:
-            hours = int(duration_text.split("hour")[0].strip())
-            total_duration_min += hours * 60
-            if "min" in duration_text:
-                mins = int(duration_text.split("hour")[1].split("min")[0].strip())
-                total_duration_min += mins
-        elif "min" in duration_text:
-            mins = int(duration_text.split("min")[0].strip())
-            total_duration_min += mins
-        
-        # Parse distance
-        distance_text = leg["distance"].replace(",", ".")
-        if "km" in distance_text:
-            km = float(distance_text.split("km")[0].strip())
-            total_distance_km += km
-        elif "m" in distance_text:
-            m = float(distance_text.split("m")[0].strip())
-            total_distance_km += m / 1000
+    travel = route_legs[:-1]  # Exclude return home from the totals
     
     # Add 10 minutes per errand (except last)
-    total_duration_min += (len(route_legs) - 1) * 10
-    
-    hours = total_duration_min // 60
-    mins = total_duration_min % 60
-    
-    if hours > 0:
-        duration_str = f"{int(hours)}h {int(mins)}min"
-    else:
-        duration_str = f"{int(mins)}min"
-    
-    distance_str = f"{total_distance_km:.1f} km"
+    total_seconds = sum(leg.duration_s for leg in travel) + len(travel) * SERVICE_SECONDS
+    total_meters = sum(leg.distance_m for leg in travel)
     
-    return duration_str, distance_str
+    # Sempre em km: o frontend (CostEstimator) lê o número antes de " km"
+    return format_duration(total_seconds), f"{total_meters / 1000:.1f} km", total_seconds, total_meters
 
 
 # NEW FEATURE 2: Sugestões Inteligentes de Combinação
+COMBINATION_GUIDELINES = """Procure por:
+1. Estabelecimentos que oferecem múltiplos serviços (ex: farmácia com caixa eletrônico)
+2. Locais muito próximos que podem ser visitados juntos
+3. Tarefas que podem ser combinadas (ex: comprar remédio e sacar dinheiro na mesma farmácia)"""
+
+
 async def analyze_task_combinations(tasks: List[Task]) -> List[str]:
     """
     Use GPT to suggest smart task combinations
@@ -634,25 +1233,21 @@ async def analyze_task_combinations(tasks: List[Task]) -> List[str]:
 
 {chr(10).join(task_descriptions)}
 
-Procure por:
-1. Estabelecimentos que oferecem múltiplos serviços (ex: farmácia com caixa eletrônico)
-2. Locais muito próximos que podem ser visitados juntos
-3. Tarefas que podem ser combinadas (ex: comprar remédio e sacar dinheiro na mesma farmácia)
+{COMBINATION_GUIDELINES}
 
-Retorne uma lista de sugestões práticas e curtas. Máximo 3 sugestões."""
+Retorne JSON {{"suggestions": [...]}} com sugestões práticas e curtas. Máximo 3 sugestões."""
     
     try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
+        result, _ = await complete_json(
+            openai_async,
+            [{"role": "user", "content": prompt}],
+            TaskCombinations,
             temperature=0.7,
             max_tokens=200
         )
-        
-        content = response.choices[0].message.content.strip()
-        suggestions = [s.strip() for s in content.split('\n') if s.strip() and not s.strip().startswith('#')]
-        return suggestions[:3]
-    except:
+        return [s.strip() for s in result.suggestions if s.strip()][:3]
+    except Exception as e:
+        print(f"⚠️  Sugestões de combinação indisponíveis: {e}")
         return []
 
 
@@ -700,101 +1295,256 @@ async def suggest_best_departure_time(tasks: List[Task], start_coords: dict) ->
 async def parse_carpooling_tasks(carpooling_list: List[dict], start_coords: dict) -> List[Task]:
     """
     Parse carpooling tasks from other people
+    Melhoria #23: cada pessoa passa primeiro pelo parser local; as que sobram
+    vão juntas numa única chamada que devolve as tarefas marcadas por pessoa
+    (com cache). Se a chamada falhar, ou faltar alguém na resposta, essas
+    pessoas são interpretadas em paralelo, uma chamada cada.
+    Quem só precisa da carona (sem texto de tarefas) não gera chamada.
     """
-    all_tasks = []
-    for person in carpooling_list:
-        person_name = person.get("name", "Pessoa")
-        tasks_text = person.get("tasks", "")
-        
-        # Use GPT to parse these tasks
-        tasks = await parse_errands_with_gpt(f"{person_name}: {tasks_text}", None)
-        for task in tasks:
-            task.name = f"{task.name} ({person_name})"
-        all_tasks.extend(tasks)
+    riders = [(person_name, entry.get("tasks") or "") for person_name, entry in carpool_riders(carpooling_list)]
+    tasks_by_rider = {}
+    pending = []
+    for person_name, tasks_text in riders:
+        if not tasks_text.strip():
+            tasks_by_rider[person_name] = []
+            continue
+        local_tasks = parse_if_confident(tasks_text)
+        if local_tasks is None:
+            pending.append((person_name, tasks_text))
+        else:
+            tasks_by_rider[person_name] = [Task(**task, person=person_name) for task in local_tasks]
+    
+    if pending and CARPOOL_BATCH_PARSE:
+        cache_key = get_cache_key('llm_carpool', PARSE_PROMPT_VERSION, [
+            (person_name, normalize_errand_text(tasks_text)) for person_name, tasks_text in pending
+        ])
+        try:
+            parsed = await cached_llm_fetch(cache_key, lambda: request_carpool_parse(pending))
+            for task in parsed:
+                tasks_by_rider.setdefault(task["person"], []).append(Task(**task))
+            # Resposta válida: quem ficou sem tarefas não tem tarefas, não é reinterpretado
+            for person_name, _ in pending:
+                tasks_by_rider.setdefault(person_name, [])
+        except LLMResponseError as e:
+            print(f"⚠️  Parse combinado da carona falhou, interpretando por pessoa: {e}")
+    
+    missing = [(name, text) for name, text in pending if name not in tasks_by_rider]
+    if missing:
+        results = await asyncio.gather(*[parse_errands_with_gpt(text, None) for _, text in missing])
+        for (person_name, _), tasks in zip(missing, results):
+            for task in tasks:
+                task.person = person_name
+            tasks_by_rider[person_name] = tasks
+    
+    return [task for person_name, _ in riders for task in tasks_by_rider.get(person_name, [])]
+
+
+def carpool_riders(carpooling_list: List[dict]) -> List[tuple]:
+    """
+    (nome, entrada) de cada pessoa, com nomes únicos para marcar as tarefas
+    """
+    riders = []
+    seen = set()
+    for i, person in enumerate(carpooling_list, start=1):
+        person_name = person.get("name") or "Pessoa"
+        if person_name in seen:
+            person_name = f"{person_name} #{i}"
+        seen.add(person_name)
+        riders.append((person_name, person))
+    return riders
+
+
+async def request_carpool_parse(riders: List[tuple]) -> tuple:
+    """
+    Melhoria #23: uma chamada para as tarefas de todas as pessoas da carona.
+    Retorna (tarefas em dict com "person", tokens gastos)
+    """
+    names = [person_name for person_name, _ in riders]
+    messages = errand_parse_messages("", None)
+    messages[0]["content"] += (
+        "\nAs tarefas são de várias pessoas. Em cada tarefa inclua \"person\" com o nome "
+        f"da pessoa exatamente como aparece na lista: {', '.join(names)}."
+    )
+    messages[1]["content"] = "Tarefas por pessoa:\n" + "\n".join(
+        f"- {person_name}: {tasks_text}" for person_name, tasks_text in riders
+    )
+    
+    parsed, tokens = await complete_json(
+        openai_async,
+        messages,
+        ParsedCarpool,
+        temperature=0.3,
+        max_tokens=PARSE_MAX_TOKENS * len(riders)
+    )
+    
+    unknown = {task.person for task in parsed.tasks} - set(names)
+    if unknown:
+        raise LLMResponseError(f"Pessoas fora da carona na resposta: {', '.join(sorted(unknown))}")
+    return [task.model_dump() for task in parsed.tasks], tokens
+
+
+async def build_carpool_stops(carpooling_list: List[dict], start_coords: dict) -> List[Task]:
+    """
+    Melhoria #24: paradas da carona. Para cada pessoa: embarque (se houver
+    pickup_address), as tarefas dela já com local encontrado e o desembarque
+    (se houver dropoff_address). A ordem entre elas é garantida pelas
+    precedências do routing, não pela posição na lista.
+    """
+    errands, addresses = await asyncio.gather(
+        parse_carpooling_tasks(carpooling_list, start_coords),
+        asyncio.gather(*[
+            locate_carpool_stop(person_name, entry.get(field), stop_type)
+            for person_name, entry in carpool_riders(carpooling_list)
+            for field, stop_type in (("pickup_address", "pickup"), ("dropoff_address", "dropoff"))
+        ])
+    )
+    await find_places_for_tasks(errands, start_coords)
     
-    return all_tasks
+    stops = []
+    for person_name, _ in carpool_riders(carpooling_list):
+        stops += [t for t in addresses if t and t.person == person_name and t.stop_type == "pickup"]
+        stops += [t for t in errands if t.person == person_name]
+        stops += [t for t in addresses if t and t.person == person_name and t.stop_type == "dropoff"]
+    return stops
 
 
-async def optimize_carpooling(all_tasks: List[Task], carpooling_tasks: List[Task]) -> dict:
+async def locate_carpool_stop(person_name: str, address: Optional[str], stop_type: str) -> Optional[Task]:
+    """
+    Embarque/desembarque de uma pessoa como Task com coordenadas (None sem endereço)
+    """
+    if not address:
+        return None
+    try:
+        coords = await get_coordinates(address)
+    except Exception as e:
+        print(f"⚠️  Falha ao localizar {stop_type} de {person_name}: {e}")
+        return None
+    
+    name = f"Buscar {person_name}" if stop_type == "pickup" else f"Deixar {person_name}"
+    return Task(name=name, address=address, lat=coords["lat"], lng=coords["lng"],
+                person=person_name, stop_type=stop_type)
+
+
+async def optimize_carpooling(all_tasks: List[Task], carpooling_tasks: List[Task],
+                              detours: Optional[dict] = None) -> dict:
     """
     Analyze carpooling optimization
+    Melhoria #24: desvio real de cada pessoa (rota com ela - rota ótima sem ela)
     """
-    total_tasks = len(all_tasks)
-    carpooling_count = len(carpooling_tasks)
+    detours = detours or {}
+    people = list(dict.fromkeys(t.person for t in carpooling_tasks if t.person))
+    errands = [t for t in carpooling_tasks if not t.stop_type]
+    per_person = [{
+        "person": person,
+        "tasks": sum(1 for t in errands if t.person == person),
+        "detour_minutes": round(detours[person] / 60) if person in detours else None
+    } for person in people]
+    total_detour = sum(p["detour_minutes"] or 0 for p in per_person)
     
     return {
-        "total_people": len(set([t.name.split("(")[-1].strip(")") for t in carpooling_tasks])) + 1,
-        "shared_tasks": carpooling_count,
-        "message": f"🚗 Carona otimizada! Você está levando {carpooling_count} tarefas de outras pessoas. Economia de combustível e tempo para todos!"
+        "total_people": len(people) + 1,
+        "shared_tasks": len(errands),
+        "detours": per_person,
+        "total_detour_minutes": total_detour,
+        "message": f"🚗 Carona otimizada! Você está levando {len(errands)} tarefas de {len(people)} pessoa(s) "
+                   f"com {total_detour} min de desvio no total."
     }
 
 
 # NEW FEATURE 11: Pontos de Interesse no Caminho
-async def find_nearby_points_of_interest(route: List[dict]) -> List[dict]:
+async def warm_poi_cell(cell: str, poi_type: str) -> None:
+    """
+    Melhoria #27: uma busca places_nearby por (célula, tipo), em cache; os
+    resultados alimentam o índice espacial em memória e expiram com o cache
+    """
+    if poi_index.is_warm(cell, poi_type):
+        return
+    center = geohash_center(cell)
+    try:
+        places = await cached_fetch(
+            get_cache_key('poi_nearby', cell, poi_type),
+            lambda: gmaps_async.places_nearby(
+                location=(center["lat"], center["lng"]),
+                radius=cell_radius_m(cell),
+                type=poi_type
+            ),
+            CACHE_TTL_PLACES
+        )
+    except Exception as e:
+        print(f"⚠️ Busca de POIs '{poi_type}' na célula {cell} falhou: {e}")
+        return
+    poi_index.add_places_results(places.get("results", []), warmed=(cell, poi_type))
+
+
+async def find_nearby_points_of_interest(route: List[RouteLeg]) -> List[dict]:
     """
     Find interesting points along the route
+    Melhoria #27: consulta o corredor em volta da polyline real da rota no
+    índice espacial. Só as células do corredor ainda não vistas disparam uma
+    busca places_nearby, que fica em cache; NEARBY_POI_WARM_BUDGET limita
+    essas buscas por plano (primeiro as células mais perto do meio dos trechos).
     """
     if len(route) < 2:
         return []
     
-    nearby_points = []
+    # Polyline da rota inteira, lembrando a qual trecho pertence cada segmento
+    path, leg_of_segment, midpoints = [], [], []
+    for i, leg in enumerate(route):
+        points = polyline.simplify(polyline.decode(leg.polyline), CORRIDOR_SIMPLIFY_M) if leg.polyline else []
+        if len(points) < 2:
+            points = [(leg.start_location["lat"], leg.start_location["lng"]),
+                      (leg.end_location["lat"], leg.end_location["lng"])]
+        # Meio do trecho (com 2 pontos, o ponto médio entre eles)
+        a, b = points[(len(points) - 1) // 2], points[len(points) // 2]
+        midpoints.append(((a[0] + b[0]) / 2, (a[1] + b[1]) / 2))
+        if path and path[-1] == points[0]:
+            points = points[1:]
+        # Cada ponto novo fecha um segmento (o primeiro da rota não)
+        leg_of_segment += [i] * (len(points) - (0 if path else 1))
+        path += points
     
-    # Check points between each leg
-    for i in range(len(route) - 1):
-        start = route[i]["end_location"]
-        end = route[i + 1]["start_location"]
-        
-        # Calculate midpoint
-        mid_lat = (start["lat"] + end["lat"]) / 2
-        mid_lng = (start["lng"] + end["lng"]) / 2
-        
-        try:
-            # Search for interesting places nearby
-            places = gmaps.places_nearby(
-                location=(mid_lat, mid_lng),
-                radius=500,  # 500m radius
-                type="gas_station"  # Start with gas stations
-            )
-            
-            if places["results"]:
-                for place in places["results"][:1]:  # Only first result
-                    nearby_points.append({
-                        "name": place["name"],
-                        "type": "Posto de gasolina",
-                        "location": place["geometry"]["location"],
-                        "between": f"Entre '{route[i]['task']}' e '{route[i+1]['task']}'"
-                    })
-        except:
-            pass
+    try:
+        cells = poi_index.corridor_cells(path, NEARBY_POI_RADIUS)
+    except ValueError as e:
+        # Ex: perto dos polos as células ficam estreitas demais para o raio
+        print(f"⚠️ POIs no caminho indisponíveis: {e}")
+        return []
+    
+    # Aquece as células do corredor ainda frias, para os tipos sem dump regional
+    warm_types = [t for t in NEARBY_POI_TYPES if t not in poi_index.authoritative_types]
+    cold = [cell for cell in nearest_first(cells, midpoints)
+            if any(not poi_index.is_warm(cell, t) for t in warm_types)]
+    await asyncio.gather(*[
+        warm_poi_cell(cell, t) for cell in cold[:NEARBY_POI_WARM_BUDGET] for t in warm_types
+    ])
+    
+    # Um ponto por trecho: o mais próximo da rota
+    nearby_points = []
+    seen_legs = set()
+    for poi in poi_index.corridor(path, NEARBY_POI_RADIUS, NEARBY_POI_TYPES):
+        i = leg_of_segment[poi["segment"]]
+        if i in seen_legs:
+            continue
+        seen_legs.add(i)
+        poi_type = next(t for t in NEARBY_POI_TYPES if t in poi["types"])
+        previous = route[i - 1].task if i > 0 else "Ponto de partida"
+        nearby_points.append({
+            "name": poi["name"],
+            "type": POI_TYPE_LABELS.get(poi_type, poi_type),
+            "location": poi["location"],
+            "between": f"Entre '{previous}' e '{route[i].task}'"
+        })
     
     return nearby_points[:3]  # Max 3 suggestions
 
 
 # NEW FEATURE 1: Calculate savings for economy/fast mode
-async def calculate_mode_savings(route: List[dict], mode: str) -> dict:
+async def calculate_mode_savings(route: List[RouteLeg], mode: str) -> dict:
     """
     Calculate savings/benefits of chosen mode
     """
-    total_distance = 0
-    total_duration = 0
-    
-    for leg in route:
-        # Extract distance in km
-        dist_text = leg["distance"].replace(",", ".")
-        if "km" in dist_text:
-            total_distance += float(dist_text.split("km")[0].strip())
-        
-        # Extract duration in minutes
-        dur_text = leg["duration"]
-        if "hour" in dur_text:
-            hours = int(dur_text.split("hour")[0].strip())
-            total_duration += hours * 60
-            if "min" in dur_text:
-                mins = int(dur_text.split("hour")[1].split("min")[0].strip())
-                total_duration += mins
-        elif "min" in dur_text:
-            mins = int(dur_text.split("min")[0].strip())
-            total_duration += mins
+    total_distance = sum(leg.distance_m for leg in route) / 1000  # km
+    total_duration = sum(leg.duration_s for leg in route) / 60  # minutos
     
     if mode == "economy":
         # Estimate toll savings (average R$ 15 per toll avoided)
@@ -826,42 +1576,14 @@ async def calculate_mode_savings(route: List[dict], mode: str) -> dict:
 async def optimize_delivery_route(tasks: List[Task], start_coords: dict) -> List[Task]:
     """
     Optimize route for delivery mode using distance matrix and greedy TSP
+    Melhoria #13: matriz haversine + 2-opt/Or-opt com orçamento de tempo (delivery.py).
+    Roda numa thread para não segurar o event loop durante a busca local.
     """
-    if len(tasks) <= 2:
-        return tasks
-    
-    # Get all coordinates
-    locations = [start_coords] + [{"lat": t.lat, "lng": t.lng} for t in tasks if t.lat and t.lng]
-    
-    # Simple greedy algorithm: always go to nearest unvisited point
-    visited = [False] * len(tasks)
-    ordered = []
-    current_idx = 0  # Start from origin
-    
-    for _ in range(len(tasks)):
-        min_distance = float('inf')
-        next_idx = -1
-        
-        for i, task in enumerate(tasks):
-            if not visited[i] and task.lat and task.lng:
-                # Calculate rough distance (euclidean approximation)
-                if current_idx == 0:
-                    curr_lat, curr_lng = start_coords["lat"], start_coords["lng"]
-                else:
-                    curr_lat, curr_lng = ordered[-1].lat, ordered[-1].lng
-                
-                distance = ((task.lat - curr_lat) ** 2 + (task.lng - curr_lng) ** 2) ** 0.5
-                
-                if distance < min_distance:
-                    min_distance = distance
-                    next_idx = i
-        
-        if next_idx != -1:
-            visited[next_idx] = True
-            ordered.append(tasks[next_idx])
-            current_idx = next_idx + 1
-    
-    return ordered
+    stops = [t for t in tasks if t.lat and t.lng]
+    order = await asyncio.to_thread(
+        order_deliveries, start_coords, [{"lat": t.lat, "lng": t.lng} for t in stops]
+    )
+    return [stops[i] for i in order]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,194 @@
+"""
+Melhoria #31: Métricas e tracing por requisição
+Spans medem cada estágio do grafo (pipeline.StageGraph) e cada chamada
+externa (external.AsyncClient). As durações alimentam histogramas e
+contadores exportados em texto no formato do Prometheus (/metrics); os spans
+da requisição atual ficam num contextvar para o header Server-Timing.
+Sem dependências: a exposição em texto é simples o bastante para gerar aqui.
+"""
+
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Limites dos buckets de latência (segundos)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# Spans da requisição atual: [(nome, segundos)]. As tarefas criadas pelo grafo
+# herdam o contexto, então todas escrevem na mesma lista.
+_trace: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar(
+    "metrics_trace", default=None
+)
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Sequence[Tuple[str, str]] = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_labels(labels), 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            lines += [f"{self.name}{_format_labels(k)} {v:g}" for k, v in sorted(self._values.items())]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        # labels -> [contagem por bucket..., soma, total]
+        self._values: Dict[Labels, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = _labels(labels)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+                    break
+            row[-2] += value
+            row[-1] += 1
+
+    def count(self, **labels) -> int:
+        row = self._values.get(_labels(labels))
+        return row[-1] if row else 0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, row in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, row):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(key, [('le', f'{bound:g}')])} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {row[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {row[-2]:.6f}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {row[-1]}")
+        return lines
+
+
+span_seconds = Histogram(
+    "errand_span_seconds", "Duração dos estágios do plano e das chamadas externas"
+)
+http_request_seconds = Histogram(
+    "errand_http_request_seconds", "Duração das requisições HTTP"
+)
+external_calls = Counter(
+    "errand_external_calls_total", "Chamadas às APIs externas (OpenAI, Google Maps)"
+)
+llm_tokens = Counter(
+    "errand_llm_tokens_total", "Tokens gastos nas chamadas ao LLM"
+)
+
+REGISTRY = [span_seconds, http_request_seconds, external_calls, llm_tokens]
+
+
+@contextmanager
+def span(kind: str, name: str) -> Iterator[None]:
+    """
+    Mede o bloco: vai para o histograma errand_span_seconds{kind, name} e
+    para o trace da requisição atual (se houver)
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        span_seconds.observe(elapsed, kind=kind, name=name)
+        trace = _trace.get()
+        if trace is not None:
+            trace.append((f"{kind}.{name}", elapsed))
+
+
+def start_trace() -> List[Tuple[str, float]]:
+    """
+    Começa a coletar os spans do contexto atual (uma requisição)
+    """
+    trace: List[Tuple[str, float]] = []
+    _trace.set(trace)
+    return trace
+
+
+def server_timing(trace: List[Tuple[str, float]], total: Optional[float] = None) -> str:
+    """
+    Header Server-Timing: spans com o mesmo nome somados, em ms
+    (desc traz quantas vezes o span ocorreu)
+    """
+    totals: Dict[str, List[float]] = {}
+    for name, elapsed in trace:
+        entry = totals.setdefault(name, [0.0, 0])
+        entry[0] += elapsed
+        entry[1] += 1
+
+    metrics = [
+        f'{name.replace(" ", "_")};dur={elapsed * 1000:.1f};desc="{count}x"'
+        for name, (elapsed, count) in totals.items()
+    ]
+    if total is not None:
+        metrics.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(metrics)
+
+
+def cache_samples(cache_stats: dict) -> List[str]:
+    """
+    Contadores do cache (acertos / erros por prefixo de chave, tokens
+    economizados) a partir de cache.get_cache_stats(), no momento da coleta
+    """
+    lines = [
+        "# HELP errand_cache_requests_total Consultas ao cache por prefixo da chave",
+        "# TYPE errand_cache_requests_total counter",
+    ]
+    for cache_name, stats in (("api", cache_stats), ("llm", cache_stats.get("llm", {}))):
+        for prefix, counts in sorted(stats.get("by_prefix", {}).items()):
+            for field, result in (("hits", "hit"), ("misses", "miss")):
+                labels = _format_labels((("cache", cache_name), ("prefix", prefix), ("result", result)))
+                lines.append(f"errand_cache_requests_total{labels} {counts.get(field, 0)}")
+    lines += [
+        "# HELP errand_llm_tokens_saved_total Tokens que o cache do LLM evitou gastar",
+        "# TYPE errand_llm_tokens_saved_total counter",
+        f"errand_llm_tokens_saved_total {cache_stats.get('llm', {}).get('tokens_saved', 0)}",
+    ]
+    return lines
+
+
+def render(extra: Sequence[str] = ()) -> str:
+    """
+    Todas as métricas no formato de texto do Prometheus
+    """
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    lines += extra
+    return "\n".join(lines) + "\n"
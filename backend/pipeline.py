@@ -0,0 +1,121 @@
+"""
+Melhoria #8: Pipeline de Estágios
+Executa os estágios do optimize_errands como um grafo de dependências:
+cada estágio começa assim que suas entradas ficam prontas e ramos
+independentes rodam em paralelo.
+"""
+
+import asyncio
+import inspect
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Optional, Tuple
+
+import metrics
+
+
+class Stage:
+    """Um nó do grafo: função, dependências e condição de execução"""
+
+    def __init__(self, name: str, func: Callable, deps: Iterable[str] = (),
+                 enabled: bool = True, default: Any = None):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.enabled = enabled
+        self.default = default
+
+
+class StageGraph:
+    """
+    Grafo de estágios assíncronos.
+
+    Cada estágio recebe como keyword arguments os resultados das suas
+    dependências. Estágios desabilitados não executam e produzem `default`.
+    Se qualquer estágio falhar, os demais são cancelados e o erro é propagado.
+    """
+
+    def __init__(self):
+        self._stages: Dict[str, Stage] = {}
+
+    def add(self, name: str, func: Callable, deps: Iterable[str] = (),
+            enabled: bool = True, default: Any = None) -> "StageGraph":
+        if name in self._stages:
+            raise ValueError(f"Estágio duplicado: {name}")
+        self._stages[name] = Stage(name, func, deps, enabled, default)
+        return self
+
+    def _topological_order(self) -> list:
+        order = []
+        state = {}  # 1 = visitando, 2 = concluído
+
+        def visit(name: str, path: tuple):
+            if state.get(name) == 2:
+                return
+            if state.get(name) == 1:
+                raise ValueError(f"Ciclo no grafo de estágios: {' -> '.join(path + (name,))}")
+            if name not in self._stages:
+                raise ValueError(f"Dependência desconhecida: {name} (em {path[-1]})")
+            state[name] = 1
+            for dep in self._stages[name].deps:
+                visit(dep, path + (name,))
+            state[name] = 2
+            order.append(name)
+
+        for name in self._stages:
+            visit(name, ())
+        return order
+
+    async def _run_stage(self, stage: Stage, futures: Dict[str, asyncio.Future],
+                         on_stage_done: Optional[Callable[[str, Any], None]]) -> Any:
+        inputs = {dep: await futures[dep] for dep in stage.deps}
+        if not stage.enabled:
+            return stage.default
+        # Melhoria #31: só a execução do estágio, sem a espera pelas dependências
+        with metrics.span("stage", stage.name):
+            result = stage.func(**inputs)
+            if inspect.isawaitable(result):
+                result = await result
+        if on_stage_done is not None:
+            on_stage_done(stage.name, result)
+        return result
+
+    async def run(self, on_stage_done: Optional[Callable[[str, Any], None]] = None) -> Dict[str, Any]:
+        """
+        Executa o grafo e retorna {nome_do_estágio: resultado}.
+        `on_stage_done(nome, resultado)` é chamado assim que cada estágio
+        habilitado termina.
+        """
+        futures: Dict[str, asyncio.Future] = {}
+        for name in self._topological_order():
+            futures[name] = asyncio.ensure_future(
+                self._run_stage(self._stages[name], futures, on_stage_done)
+            )
+
+        done, pending = await asyncio.wait(futures.values(), return_when=asyncio.FIRST_EXCEPTION)
+        failed: Optional[BaseException] = next(
+            (f.exception() for f in done if not f.cancelled() and f.exception()), None
+        )
+        if failed is not None:
+            for future in pending:
+                future.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            raise failed
+
+        return {name: future.result() for name, future in futures.items()}
+
+    async def iter_results(self) -> AsyncIterator[Tuple[str, Any]]:
+        """
+        Executa o grafo entregando (nome, resultado) na ordem em que os
+        estágios habilitados terminam. Uma falha é propagada depois dos
+        resultados que já saíram.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        runner = asyncio.ensure_future(self.run(lambda name, result: queue.put_nowait((name, result))))
+        runner.add_done_callback(lambda _: queue.put_nowait(None))
+        try:
+            while (item := await queue.get()) is not None:
+                yield item
+            runner.result()
+        finally:
+            if not runner.done():
+                runner.cancel()
+                await asyncio.gather(runner, return_exceptions=True)
@@ -0,0 +1,143 @@
+"""
+Melhoria #11: Polylines
+Codificação/decodificação do formato "Encoded Polyline" do Google
+https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+"""
+
+import math
+from typing import Iterable, List, Sequence, Tuple
+
+Point = Tuple[float, float]
+
+# Metros por pixel no equador com zoom 0 (tiles de 256px do Web Mercator)
+METERS_PER_PIXEL_Z0 = 156543.03392
+
+
+def decode(encoded: str, precision: int = 5) -> List[Point]:
+    """
+    Decodifica uma polyline em lista de (lat, lng)
+    """
+    factor = 10 ** precision
+    points = []
+    index = lat = lng = 0
+    length = len(encoded)
+
+    while index < length:
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                byte = ord(encoded[index]) - 63
+                index += 1
+                result |= (byte & 0x1F) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lng += deltas[1]
+        points.append((lat / factor, lng / factor))
+
+    return points
+
+
+def _encode_value(value: int) -> str:
+    value = ~(value << 1) if value < 0 else value << 1
+    chunks = []
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1F)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+    return "".join(chunks)
+
+
+def encode(points: Iterable[Point], precision: int = 5) -> str:
+    """
+    Codifica uma lista de (lat, lng) em polyline
+    """
+    factor = 10 ** precision
+    output = []
+    prev_lat = prev_lng = 0
+
+    for lat, lng in points:
+        lat_i = int(round(lat * factor))
+        lng_i = int(round(lng * factor))
+        output.append(_encode_value(lat_i - prev_lat))
+        output.append(_encode_value(lng_i - prev_lng))
+        prev_lat, prev_lng = lat_i, lng_i
+
+    return "".join(output)
+
+
+def join(encoded_parts: Iterable[str]) -> str:
+    """
+    Junta várias polylines consecutivas numa só (remove o ponto repetido
+    na emenda entre um trecho e o seguinte)
+    """
+    points: List[Point] = []
+    for part in encoded_parts:
+        decoded = decode(part)
+        if points and decoded and decoded[0] == points[-1]:
+            decoded = decoded[1:]
+        points.extend(decoded)
+    return encode(points)
+
+
+def zoom_tolerance(zoom: int, lat: float = 0.0) -> float:
+    """
+    Melhoria #29: tolerância de simplificação em metros para um zoom do mapa
+    (um pixel na latitude dada); abaixo disso a diferença não aparece na tela
+    """
+    return METERS_PER_PIXEL_Z0 * math.cos(math.radians(lat)) / 2 ** zoom
+
+
+def simplify(points: Sequence[Point], tolerance_m: float) -> List[Point]:
+    """
+    Melhoria #29: Douglas–Peucker. Remove os pontos que ficam a menos de
+    `tolerance_m` metros da reta entre os pontos mantidos; o primeiro e o
+    último sempre ficam.
+    """
+    if len(points) < 3 or tolerance_m <= 0:
+        return list(points)
+
+    # Projeção equiretangular local: distâncias em metros
+    scale = math.pi / 180 * 6_371_000
+    cos_lat = math.cos(math.radians(points[0][0]))
+    xy = [(lng * scale * cos_lat, lat * scale) for lat, lng in points]
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (ax, ay), (bx, by) = xy[first], xy[last]
+        dx, dy = bx - ax, by - ay
+        length2 = dx * dx + dy * dy
+        farthest, max_dist2 = None, tolerance_m * tolerance_m
+        for i in range(first + 1, last):
+            px, py = xy[i]
+            t = 0.0 if length2 == 0 else max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length2))
+            ex, ey = px - ax - t * dx, py - ay - t * dy
+            dist2 = ex * ex + ey * ey
+            if dist2 > max_dist2:
+                farthest, max_dist2 = i, dist2
+        if farthest is not None:
+            keep[farthest] = True
+            stack += [(first, farthest), (farthest, last)]
+
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def simplify_encoded(encoded: str, tolerance_m: float) -> str:
+    """
+    Decodifica, simplifica e codifica de novo uma polyline
+    """
+    return encode(simplify(decode(encoded), tolerance_m))
+
+
+def merge(encoded_parts: Iterable[str], tolerance_m: float = 0.0) -> str:
+    """
+    Melhoria #29: geometria única da rota a partir das polylines dos trechos,
+    simplificada com a tolerância dada
+    """
+    return simplify_encoded(join(encoded_parts), tolerance_m)
@@ -0,0 +1,505 @@
+"""
+Melhoria #12: Motor de Rotas
+Em vez de uma chamada de Directions por trecho, o plano usa:
+1. Uma chamada de Distance Matrix com todos os pares de pontos
+2. Ordenação das paradas feita localmente sobre essa matriz
+3. Uma chamada de Directions com waypoints para a geometria final
+"""
+
+import asyncio
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+import polyline
+from cache import get_cache_key, get_cached, set_cached, single_flight, CACHE_TTL_ROUTES
+from geo import quantize_point, departure_bucket
+
+INF = float("inf")
+
+# Limites da Google Maps Platform por requisição
+MAX_MATRIX_ELEMENTS = 100
+MAX_MATRIX_SIDE = 25
+MAX_WAYPOINTS = 25
+
+# Acima disso a ordenação exata (2^n * n estados) deixa de caber em milissegundos
+EXACT_SOLVER_MAX_STOPS = 12
+
+# Tempo gasto em cada parada (mesmo valor usado no cálculo dos horários de chegada)
+SERVICE_SECONDS = 600
+
+
+def _chunks(items: Sequence, size: int) -> List[Sequence]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def route_params_key(params: dict) -> tuple:
+    """
+    Parte da chave de cache que vem dos parâmetros: modo, restrições (avoid)
+    e janela do horário de partida
+    """
+    departure = params.get("departure_time")
+    avoid = params.get("avoid")
+    if isinstance(avoid, str):
+        avoid = [avoid]
+    return (
+        params.get("mode", "driving"),
+        sorted(avoid or []),
+        departure_bucket(departure) if departure else None
+    )
+
+
+def leg_cache_key(prefix: str, origin: dict, destination: dict, params: dict) -> str:
+    """
+    Melhoria #15: chave de cache de um trecho origem -> destino.
+    Coordenadas quantizadas (~11m), modo, restrições (avoid) e janela do
+    horário de partida: usuários próximos roteando entre as mesmas lojas em
+    poucos minutos reaproveitam o mesmo trecho.
+    """
+    return get_cache_key(prefix, quantize_point(origin), quantize_point(destination), route_params_key(params))
+
+
+async def fetch_duration_matrix(gmaps_async, points: List[dict], **params) -> tuple:
+    """
+    Retorna (durations, distances): matrizes NxN em segundos e metros.
+    Para até 10 pontos é uma única chamada; acima disso os blocos respeitam
+    os limites da API e são buscados em paralelo.
+    Células já em cache (Melhoria #15) não são buscadas de novo.
+    Pares sem rota (status != OK) ficam com INF.
+    """
+    params = {"mode": "driving", **params}
+    n = len(points)
+    durations = [[0.0 if i == j else INF for j in range(n)] for i in range(n)]
+    distances = [[0.0 if i == j else INF for j in range(n)] for i in range(n)]
+
+    missing_rows, missing_cols = set(), set()
+    for i in range(n):
+        for j in range(n):
+            if i == j:
+                continue
+            cell = get_cached(leg_cache_key("route_matrix", points[i], points[j], params))
+            if cell is None:
+                missing_rows.add(i)
+                missing_cols.add(j)
+            else:
+                durations[i][j], distances[i][j] = cell
+
+    if not missing_rows:
+        return durations, distances
+
+    rows_needed, cols_needed = sorted(missing_rows), sorted(missing_cols)
+    col_blocks = _chunks(cols_needed, MAX_MATRIX_SIDE)
+    rows_per_block = max(1, min(MAX_MATRIX_SIDE, MAX_MATRIX_ELEMENTS // len(col_blocks[0])))
+    row_blocks = _chunks(rows_needed, rows_per_block)
+
+    async def fetch_block(rows: Sequence[int], cols: Sequence[int]):
+        origins = [points[i] for i in rows]
+        destinations = [points[j] for j in cols]
+        # Melhoria #17: blocos idênticos pedidos ao mesmo tempo viram uma chamada
+        response = await single_flight(
+            get_cache_key(
+                "route_matrix_call",
+                [quantize_point(p) for p in origins],
+                [quantize_point(p) for p in destinations],
+                route_params_key(params)
+            ),
+            lambda: gmaps_async.distance_matrix(origins=origins, destinations=destinations, **params)
+        )
+        for i, row in zip(rows, response["rows"]):
+            for j, element in zip(cols, row["elements"]):
+                if i != j and element.get("status") == "OK":
+                    durations[i][j] = element["duration"]["value"]
+                    distances[i][j] = element["distance"]["value"]
+                    set_cached(
+                        leg_cache_key("route_matrix", points[i], points[j], params),
+                        (durations[i][j], distances[i][j]),
+                        CACHE_TTL_ROUTES
+                    )
+
+    await asyncio.gather(*[
+        fetch_block(rows, cols) for rows in row_blocks for cols in col_blocks
+    ])
+    return durations, distances
+
+
+def _compact_leg(leg: dict) -> dict:
+    """
+    Mantém só o que o plano usa (os steps detalhados viram uma polyline;
+    a simplificação depende do zoom de quem recebe, então é feita na resposta)
+    """
+    return {
+        "duration": leg["duration"],
+        "distance": leg["distance"],
+        "start_location": leg["start_location"],
+        "end_location": leg["end_location"],
+        "end_address": leg.get("end_address"),
+        "polyline": polyline.join(step["polyline"]["points"] for step in leg.get("steps", [])),
+    }
+
+
+async def fetch_route_legs(gmaps_async, origin: dict, stops: List[dict], destination: dict,
+                           **params) -> List[dict]:
+    """
+    Busca a geometria da rota origin -> stops... -> destination com Directions
+    usando waypoints (uma chamada para até 25 paradas; trechos maiores são
+    divididos e buscados em paralelo).
+    Melhoria #15: cada trecho fica em cache (CACHE_TTL_ROUTES); segmentos cujos
+    trechos já estão todos em cache não geram chamada.
+    Retorna os legs na ordem, cada um com a polyline montada a partir dos steps.
+    """
+    params = {"mode": "driving", **params}
+    points = [origin] + list(stops) + [destination]
+    # Cada segmento cobre MAX_WAYPOINTS + 1 trechos e compartilha o ponto de emenda
+    segment_size = MAX_WAYPOINTS + 1
+    segments = [points[i:i + segment_size + 1] for i in range(0, len(points) - 1, segment_size)]
+
+    async def fetch_segment(segment: List[dict]) -> List[dict]:
+        keys = [leg_cache_key("route_leg", a, b, params) for a, b in zip(segment, segment[1:])]
+        cached = [get_cached(key) for key in keys]
+        if all(leg is not None for leg in cached):
+            return cached
+
+        directions = await single_flight(
+            get_cache_key("route_directions_call", keys),
+            lambda: gmaps_async.directions(
+                origin=segment[0],
+                destination=segment[-1],
+                waypoints=segment[1:-1] or None,
+                **params
+            )
+        )
+        if not directions:
+            return [None] * (len(segment) - 1)
+        legs = [_compact_leg(leg) for leg in directions[0]["legs"]]
+        for key, leg in zip(keys, legs):
+            set_cached(key, leg, CACHE_TTL_ROUTES)
+        return legs
+
+    results = await asyncio.gather(*[fetch_segment(segment) for segment in segments])
+    return [leg for legs in results for leg in legs]
+
+
+def format_duration(seconds: float) -> str:
+    """
+    "1h 20min" / "15min" (mesmo formato do total da rota)
+    """
+    hours, mins = divmod(int(round(seconds / 60)), 60)
+    return f"{hours}h {mins}min" if hours else f"{mins}min"
+
+
+def format_distance(meters: float) -> str:
+    return f"{meters / 1000:.1f} km" if meters >= 1000 else f"{int(round(meters))} m"
+
+
+class RouteLeg:
+    """
+    Melhoria #30: trecho da rota com os valores numéricos do Directions
+    (segundos e metros). Os somatórios usam os números; o texto mostrado
+    ("15min", "3.2 km") só é gerado em to_dict(), na serialização.
+    `polyline` guarda a geometria completa do trecho.
+    """
+
+    __slots__ = (
+        "task", "address", "duration_s", "distance_m", "arrival_time", "closing_time",
+        "start_location", "end_location", "polyline", "person", "stop_type",
+    )
+
+    def __init__(self, task: str, address: Optional[str], duration_s: float, distance_m: float,
+                 arrival_time: str, closing_time: Optional[str], start_location: dict,
+                 end_location: dict, polyline: str, person: Optional[str] = None,
+                 stop_type: Optional[str] = None):
+        self.task = task
+        self.address = address
+        self.duration_s = duration_s
+        self.distance_m = distance_m
+        self.arrival_time = arrival_time
+        self.closing_time = closing_time
+        self.start_location = start_location
+        self.end_location = end_location
+        self.polyline = polyline
+        self.person = person
+        self.stop_type = stop_type
+
+    @classmethod
+    def from_directions(cls, leg: dict, task: str, address: Optional[str], arrival_time: str,
+                        closing_time: Optional[str] = None, **extra) -> "RouteLeg":
+        """
+        A partir de um leg compacto de fetch_route_legs
+        """
+        return cls(
+            task, address, leg["duration"]["value"], leg["distance"]["value"], arrival_time,
+            closing_time, leg["start_location"], leg["end_location"], leg["polyline"], **extra
+        )
+
+    def to_dict(self, polyline_tolerance: Optional[float] = None) -> dict:
+        """
+        Melhoria #29: a polyline do trecho só vai na resposta se
+        `polyline_tolerance` (metros) for dado, já simplificada com ela
+        """
+        leg = {
+            "task": self.task,
+            "person": self.person,
+            "stop_type": self.stop_type,
+            "address": self.address,
+            "distance": format_distance(self.distance_m),
+            "duration": format_duration(self.duration_s),
+            "distance_m": self.distance_m,
+            "duration_s": self.duration_s,
+            "arrival_time": self.arrival_time,
+            "closing_time": self.closing_time,
+            "start_location": self.start_location,
+            "end_location": self.end_location,
+        }
+        if polyline_tolerance is not None:
+            leg["polyline"] = polyline.simplify_encoded(self.polyline, polyline_tolerance)
+        return leg
+
+
+def nearest_neighbor_order(candidates: List[int], current: int, durations: List[List[float]]) -> List[int]:
+    """
+    Ordena índices da matriz pelo vizinho mais próximo a partir de `current`
+    """
+    remaining = list(candidates)
+    ordered = []
+    while remaining:
+        nxt = min(remaining, key=lambda j: durations[current][j])
+        ordered.append(nxt)
+        remaining.remove(nxt)
+        current = nxt
+    return ordered
+
+
+def order_by_constraints(tasks: list, durations: List[List[float]]) -> List[int]:
+    """
+    Ordem heurística: "first" -> com horário de fechamento (mais cedo antes)
+    -> demais por vizinho mais próximo -> "last".
+    `tasks[i]` corresponde à linha i + 1 da matriz (linha 0 é a partida).
+    Retorna os índices de `tasks` na ordem de visita.
+    """
+    first = [i for i, t in enumerate(tasks) if t.constraint == "first"]
+    last = [i for i, t in enumerate(tasks) if t.constraint == "last"]
+    urgent = sorted(
+        [i for i, t in enumerate(tasks)
+         if i not in first and i not in last and (t.constraint == "urgent" or t.closing_time)],
+        key=lambda i: tasks[i].closing_time or "23:59"
+    )
+    normal = [i for i in range(len(tasks)) if i not in first and i not in last and i not in urgent]
+
+    head = first + urgent
+    current = head[-1] + 1 if head else 0
+    normal = [j - 1 for j in nearest_neighbor_order([i + 1 for i in normal], current, durations)]
+    return head + normal + last
+
+
+def deadline_seconds(closing_time: Optional[str], start: datetime) -> float:
+    """
+    Converte "HH:MM" em segundos desde a partida (INF se não houver horário)
+    """
+    if not closing_time:
+        return INF
+    hour, minute = closing_time.split(":")[:2]
+    closing = start.replace(hour=int(hour), minute=int(minute), second=0, microsecond=0)
+    return (closing - start).total_seconds()
+
+
+def precedence_masks(tasks: list) -> List[int]:
+    """
+    Para cada tarefa, bitmask das tarefas que precisam vir antes dela:
+    "first" antes de todas as outras, "last" depois de todas as outras.
+    Melhoria #24: na carona, o embarque da pessoa vem antes das tarefas
+    dela, e o desembarque depois do embarque e de todas as tarefas dela.
+    O "first"/"last" de uma tarefa da carona ("pão na volta") vale só
+    dentro da janela embarque -> desembarque daquela pessoa.
+    """
+    n = len(tasks)
+    # Só as tarefas sem pessoa ordenam a rota inteira
+    first = sum(1 << i for i, t in enumerate(tasks)
+                if t.constraint == "first" and getattr(t, "person", None) is None)
+    last = sum(1 << i for i, t in enumerate(tasks)
+               if t.constraint == "last" and getattr(t, "person", None) is None)
+    everything = (1 << n) - 1
+    masks = []
+    for i, t in enumerate(tasks):
+        if getattr(t, "person", None) is None and t.constraint == "last":
+            masks.append(everything & ~last)
+        elif getattr(t, "person", None) is None and t.constraint == "first":
+            masks.append(0)
+        else:
+            masks.append(first)
+
+    pickups, errands, errands_first, errands_last = {}, {}, {}, {}
+    for i, t in enumerate(tasks):
+        person = getattr(t, "person", None)
+        if person is None:
+            continue
+        if getattr(t, "stop_type", None) == "pickup":
+            pickups[person] = pickups.get(person, 0) | (1 << i)
+        elif getattr(t, "stop_type", None) != "dropoff":
+            errands[person] = errands.get(person, 0) | (1 << i)
+            if t.constraint == "first":
+                errands_first[person] = errands_first.get(person, 0) | (1 << i)
+            elif t.constraint == "last":
+                errands_last[person] = errands_last.get(person, 0) | (1 << i)
+    for i, t in enumerate(tasks):
+        person = getattr(t, "person", None)
+        stop_type = getattr(t, "stop_type", None)
+        if person is None or stop_type == "pickup":
+            continue
+        masks[i] |= pickups.get(person, 0)
+        if stop_type == "dropoff":
+            masks[i] |= errands.get(person, 0)
+        elif t.constraint == "last":
+            masks[i] |= errands.get(person, 0) & ~errands_last.get(person, 0)
+        elif t.constraint != "first":
+            masks[i] |= errands_first.get(person, 0)
+        masks[i] &= ~(1 << i)
+    return masks
+
+
+def repair_order(order: List[int], predecessors: List[int]) -> List[int]:
+    """
+    Menor ajuste de uma ordem para respeitar as precedências: a cada passo
+    visita a primeira parada (na ordem original) cujas antecessoras já foram
+    visitadas. Precedências contraditórias não travam: a primeira restante segue.
+    """
+    remaining = list(order)
+    visited = 0
+    repaired = []
+    while remaining:
+        ready = next((k for k in remaining if predecessors[k] & ~visited == 0), remaining[0])
+        remaining.remove(ready)
+        repaired.append(ready)
+        visited |= 1 << ready
+    return repaired
+
+
+def route_seconds(durations: List[List[float]], order: List[int],
+                  service_seconds: float = SERVICE_SECONDS) -> float:
+    """
+    Duração da volta completa (partida -> paradas na ordem -> partida),
+    contando o tempo de serviço em cada parada
+    """
+    total, current = 0.0, 0
+    for k in order:
+        total += durations[current][k + 1] + service_seconds
+        current = k + 1
+    return total + durations[current][0]
+
+
+def solve_exact_order(durations: List[List[float]], deadlines: List[float],
+                      predecessors: List[int], service_seconds: float = SERVICE_SECONDS) -> Optional[List[int]]:
+    """
+    Held-Karp (DP em bitmask) sobre a matriz de durações.
+
+    `durations` é (n+1)x(n+1) com a partida no índice 0; `deadlines[k]` é o
+    horário limite de chegada na parada k (segundos desde a partida) e
+    `predecessors[k]` o bitmask de paradas que precisam vir antes de k.
+    Retorna a ordem mais rápida (ida e volta) que respeita todos os limites,
+    ou None se nenhuma ordem for viável.
+
+    Como esperar nunca ajuda (só há horários de fechamento), o menor horário
+    de saída por estado (visitadas, última) domina os demais e o DP é exato.
+    Cada camada é calculada de uma vez com NumPy: O(n² · 2ⁿ) operações vetoriais.
+    """
+    n = len(deadlines)
+    if n == 0:
+        return []
+
+    D = np.asarray(durations, dtype=float)
+    to_stop = D[1:, 1:]           # [j, k]: parada j -> parada k
+    deadline = np.asarray(deadlines, dtype=float)
+    full = (1 << n) - 1
+
+    # dp[mask, k]: menor horário de saída de k tendo visitado exatamente `mask`
+    dp = np.full((1 << n, n), INF)
+    parent = np.full((1 << n, n), -1, dtype=np.int8)
+
+    masks = np.arange(1 << n)
+    popcount = np.zeros(1 << n, dtype=np.int8)
+    for bit in range(n):
+        popcount += ((masks >> bit) & 1).astype(np.int8)
+
+    for k in range(n):
+        arrival = D[0, k + 1]
+        if predecessors[k] == 0 and arrival <= deadline[k]:
+            dp[1 << k, k] = arrival + service_seconds
+
+    for size in range(2, n + 1):
+        layer = masks[popcount == size]
+        for k in range(n):
+            bit = 1 << k
+            targets = layer[(layer & bit) != 0]
+            prev = targets ^ bit
+            targets = targets[(prev & predecessors[k]) == predecessors[k]]
+            if targets.size == 0:
+                continue
+            prev = targets ^ bit
+            candidates = dp[prev] + to_stop[:, k][None, :]
+            best = np.argmin(candidates, axis=1)
+            arrival = candidates[np.arange(len(targets)), best]
+            feasible = arrival <= deadline[k]
+            dp[targets, k] = np.where(feasible, arrival + service_seconds, INF)
+            parent[targets, k] = np.where(feasible, best, -1)
+
+    totals = dp[full] + D[1:, 0]
+    last = int(np.argmin(totals))
+    if not np.isfinite(totals[last]):
+        return None
+
+    order = []
+    mask = full
+    while last >= 0:
+        order.append(last)
+        prev_stop = int(parent[mask, last])
+        mask ^= 1 << last
+        last = prev_stop
+    return order[::-1]
+
+
+def order_stops(tasks: list, durations: List[List[float]], start: datetime) -> List[int]:
+    """
+    Ordem de visita das paradas (índices de `tasks`).
+    Até EXACT_SOLVER_MAX_STOPS usa o DP exato com horários de fechamento e
+    restrições "first"/"last"; acima disso (ou se nenhuma ordem for viável)
+    cai na heurística por prioridade.
+    """
+    if 0 < len(tasks) <= EXACT_SOLVER_MAX_STOPS:
+        deadlines = []
+        for i, task in enumerate(tasks):
+            limit = deadline_seconds(task.closing_time, start)
+            # Se nem indo direto dá tempo, o limite não ajuda a escolher a ordem
+            if durations[0][i + 1] > limit:
+                limit = INF
+            deadlines.append(limit)
+
+        order = solve_exact_order(durations, deadlines, precedence_masks(tasks))
+        if order is not None:
+            return order
+
+    return repair_order(order_by_constraints(tasks, durations), precedence_masks(tasks))
+
+
+def carpool_detours(tasks: list, durations: List[List[float]], start: datetime) -> Dict[str, float]:
+    """
+    Melhoria #24: desvio real (segundos) de cada pessoa da carona: duração da
+    rota com todas as paradas menos a rota ótima sem as paradas dela
+    (embarque, tarefas e desembarque), sobre a mesma matriz.
+    """
+    total = route_seconds(durations, order_stops(tasks, durations, start))
+    detours = {}
+    for person in dict.fromkeys(t.person for t in tasks if getattr(t, "person", None)):
+        keep = [i for i, t in enumerate(tasks) if getattr(t, "person", None) != person]
+        rows = [0] + [i + 1 for i in keep]
+        sub_durations = [[durations[r][c] for c in rows] for r in rows]
+        sub_tasks = [tasks[i] for i in keep]
+        without = route_seconds(sub_durations, order_stops(sub_tasks, sub_durations, start))
+        detours[person] = max(0.0, total - without)
+    return detours
+
+
+def matrix_avoid(avoid: Optional[List[str]]) -> Optional[str]:
+    """
+    A Distance Matrix aceita uma única restrição (a de Directions aceita lista)
+    """
+    return avoid[0] if avoid else None
@@ -0,0 +1,347 @@
+"""
+Melhoria #27: Índice espacial de pontos de interesse
+POIs ficam numa grade de geohash em memória, preenchida pelas buscas
+places_nearby (que já passam pelo cache) ou carregada de um dump regional.
+A busca de POIs ao longo da rota (corredor em volta da polyline) roda toda
+em memória, para qualquer tipo de POI.
+
+A precisão da grade sai do raio do corredor: as células vizinhas precisam
+alcançar o raio inteiro. Os POIs vindos das buscas expiram junto com o cache
+delas (CACHE_TTL_PLACES) e o índice tem um limite de POIs.
+"""
+
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from cache import CACHE_TTL_PLACES
+from geo import geohash_bounds, geohash_center, geohash_encode, geohash_neighbors
+
+# Precisão 6 ~ 1,2km x 0,6km: com as vizinhas cobre corredores de até ~600m
+POI_INDEX_PRECISION = 6
+
+# Maior latitude (em módulo) para a qual precision_for_radius garante o raio:
+# as células ficam mais estreitas em direção aos polos
+POI_INDEX_MAX_LAT = float(os.getenv("POI_INDEX_MAX_LAT", "60"))
+
+# Limite de POIs vindos das buscas (os do dump regional não contam)
+POI_INDEX_MAX_ENTRIES = int(os.getenv("POI_INDEX_MAX_ENTRIES", "50000"))
+
+# Tolerância (m) da simplificação da rota antes da busca no corredor: bem menor
+# que o raio da busca, e evita comparar cada POI com milhares de segmentos
+CORRIDOR_SIMPLIFY_M = 10
+
+# Quantas rotas recentes guardam as células do corredor
+CORRIDOR_CELLS_MEMO = 256
+
+EARTH_RADIUS_M = 6_371_000
+
+Point = Tuple[float, float]
+
+
+def _to_meters(lats: np.ndarray, lngs: np.ndarray, ref_lat: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Projeção equiretangular local (lat, lng) -> (x, y) em metros
+    """
+    scale = math.pi / 180 * EARTH_RADIUS_M
+    return lngs * scale * math.cos(math.radians(ref_lat)), lats * scale
+
+
+def point_to_polyline_distances(pois: Sequence[Point], path: Sequence[Point]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Para cada POI: (distância em metros até o segmento mais próximo, índice desse segmento)
+    """
+    p = np.asarray(pois, dtype=float)
+    q = np.asarray(path, dtype=float)
+    px, py = _to_meters(p[:, 0:1], p[:, 1:2], q[0, 0])  # colunas: um POI por linha
+    qx, qy = _to_meters(q[:, 0], q[:, 1], q[0, 0])
+    if len(q) == 1:
+        return np.hypot(px - qx, py - qy)[:, 0], np.zeros(len(p), dtype=int)
+
+    ax, ay = qx[:-1], qy[:-1]
+    dx, dy = qx[1:] - ax, qy[1:] - ay
+    length2 = np.maximum(dx * dx + dy * dy, 1e-9)
+    # t[i, s]: projeção do POI i no segmento s, limitada ao segmento
+    t = np.clip(((px - ax) * dx + (py - ay) * dy) / length2, 0, 1)
+    distances = np.hypot(px - ax - t * dx, py - ay - t * dy)
+    segment = distances.argmin(axis=1)
+    return distances[np.arange(len(p)), segment], segment
+
+
+def densify(path: Sequence[Point], max_step_deg: float) -> List[Point]:
+    """
+    Intercala pontos para que nenhum passo da polyline pule uma célula
+    """
+    if not path:
+        return []
+    dense = [path[0]]
+    for (lat1, lng1), (lat2, lng2) in zip(path, path[1:]):
+        steps = max(1, math.ceil(max(abs(lat2 - lat1), abs(lng2 - lng1)) / max_step_deg))
+        dense += [(lat1 + (lat2 - lat1) * k / steps, lng1 + (lng2 - lng1) * k / steps)
+                  for k in range(1, steps + 1)]
+    return dense
+
+
+@lru_cache(maxsize=4096)
+def _neighborhood(cell: str) -> Tuple[str, ...]:
+    return tuple(geohash_neighbors(cell))
+
+
+@lru_cache(maxsize=4096)
+def _center(cell: str) -> Point:
+    center = geohash_center(cell)
+    return center["lat"], center["lng"]
+
+
+def cell_size_m(precision: int, lat: float) -> Tuple[float, float]:
+    """
+    (altura, largura) em metros de uma célula de geohash na latitude `lat`
+    """
+    lat_bits = 5 * precision // 2
+    lng_bits = 5 * precision - lat_bits
+    scale = math.pi / 180 * EARTH_RADIUS_M
+    return 180 / 2 ** lat_bits * scale, 360 / 2 ** lng_bits * scale * math.cos(math.radians(lat))
+
+
+def precision_for_radius(radius_m: float, max_lat: float = POI_INDEX_MAX_LAT) -> int:
+    """
+    Maior precisão cujas células (até a latitude `max_lat`) têm lados de pelo
+    menos `radius_m`: assim a célula do ponto e as 8 vizinhas cobrem o raio
+    """
+    for precision in range(12, 0, -1):
+        if min(cell_size_m(precision, max_lat)) >= radius_m:
+            return precision
+    raise ValueError(f"Raio de {radius_m}m grande demais para a grade de geohash")
+
+
+def cell_radius_m(cell: str) -> int:
+    """
+    Raio (m) de uma busca a partir do centro da célula que cobre a célula toda
+    """
+    height, width = cell_size_m(len(cell), _center(cell)[0])
+    return math.ceil(math.hypot(height, width) / 2)
+
+
+def nearest_first(cells: Sequence[str], anchors: Sequence[Point]) -> List[str]:
+    """
+    Células em rodadas: a cada rodada, a próxima célula mais perto de cada
+    âncora (ex: o meio de cada trecho), para que nenhuma âncora fique sem
+    as células dela quando só as primeiras forem usadas
+    """
+    if not cells or not anchors:
+        return list(cells)
+    centers = [_center(cell) for cell in cells]
+    distances = np.array([point_to_polyline_distances(centers, [anchor])[0] for anchor in anchors])
+    nearest = distances.argmin(axis=0)
+    own = distances[nearest, np.arange(len(cells))]
+    # Posição de cada célula entre as células da mesma âncora
+    rank = np.empty(len(cells), dtype=int)
+    for anchor in range(len(anchors)):
+        members = np.flatnonzero(nearest == anchor)
+        rank[members[np.argsort(own[members], kind="stable")]] = np.arange(len(members))
+    return [cells[k] for k in np.lexsort((own, rank))]
+
+
+class POIIndex:
+    """
+    Grade de geohash por tipo: tipo -> célula -> {place_id: POI}. Cada POI é
+    um dict com place_id, name, types e location {"lat", "lng"} (formato do Places).
+
+    POIs vindos das buscas expiram após `ttl` segundos e no máximo
+    `max_entries` ficam no índice (sai o que expira primeiro); como o TTL é o
+    mesmo para todos, a ordem de inserção já é a ordem de expiração.
+    """
+
+    def __init__(self, precision: int = POI_INDEX_PRECISION,
+                 max_entries: int = POI_INDEX_MAX_ENTRIES, ttl: int = CACHE_TTL_PLACES):
+        self.precision = precision
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._grid: Dict[str, Dict[str, Dict[str, dict]]] = {}
+        self._ids: Dict[str, Tuple[str, Tuple[str, ...]]] = {}  # place_id -> (célula, tipos)
+        self._expiry: "OrderedDict[str, float]" = OrderedDict()  # place_id -> expira em
+        self._warm: "OrderedDict[Tuple[str, str], float]" = OrderedDict()  # (célula, tipo) -> expira em
+        # Células do corredor das últimas rotas: o aquecimento e a busca usam a mesma
+        self._corridor_cells: "OrderedDict[tuple, List[str]]" = OrderedDict()
+        # Tipos carregados de um dump completo: não precisam de busca externa
+        self.authoritative_types: set = set()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, poi: dict, expires: bool = False) -> None:
+        """
+        Adiciona (ou atualiza) um POI; com `expires` ele sai do índice após o TTL
+        """
+        place_id = poi["place_id"]
+        permanent = place_id in self._ids and place_id not in self._expiry
+        if place_id in self._ids:
+            self._discard(place_id)
+        location = poi["location"]
+        cell = geohash_encode(location["lat"], location["lng"], self.precision)
+        for poi_type in poi["types"]:
+            self._grid.setdefault(poi_type, {}).setdefault(cell, {})[place_id] = poi
+        self._ids[place_id] = (cell, tuple(poi["types"]))
+        # Um POI do dump continua permanente mesmo que uma busca o traga de novo
+        if expires and not permanent:
+            self._expiry[place_id] = time.monotonic() + self.ttl
+            while len(self._expiry) > self.max_entries:
+                self._discard(next(iter(self._expiry)))
+
+    def _discard(self, place_id: str) -> None:
+        cell, types = self._ids.pop(place_id)
+        self._expiry.pop(place_id, None)
+        for poi_type in types:
+            cells = self._grid[poi_type]
+            bucket = cells.get(cell)
+            if bucket is not None:
+                bucket.pop(place_id, None)
+                if not bucket:
+                    del cells[cell]
+
+    def purge_expired(self) -> int:
+        """
+        Remove os POIs e as células aquecidas cujo TTL passou
+        """
+        now = time.monotonic()
+        removed = 0
+        while self._expiry and next(iter(self._expiry.values())) <= now:
+            self._discard(next(iter(self._expiry)))
+            removed += 1
+        while self._warm and next(iter(self._warm.values())) <= now:
+            self._warm.popitem(last=False)
+        return removed
+
+    def is_warm(self, cell: str, poi_type: str) -> bool:
+        """
+        Se a busca de `poi_type` na célula já está no índice (e não expirou)
+        """
+        expires_at = self._warm.get((cell, poi_type))
+        return expires_at is not None and expires_at > time.monotonic()
+
+    def add_places_results(self, results: Iterable[dict], warmed: Optional[Tuple[str, str]] = None) -> None:
+        """
+        Adiciona resultados de places_nearby / places (formato da API), que
+        expiram com o TTL. `warmed` = (célula, tipo) da busca que os trouxe.
+        """
+        self.purge_expired()
+        for place in results:
+            self.add({
+                "place_id": place["place_id"],
+                "name": place.get("name"),
+                "types": place.get("types", []),
+                "location": place["geometry"]["location"],
+            }, expires=True)
+        if warmed is not None:
+            self._warm.pop(warmed, None)
+            self._warm[warmed] = time.monotonic() + self.ttl
+            while len(self._warm) > self.max_entries:
+                self._warm.popitem(last=False)
+
+    def load_dump(self, path: str, authoritative: bool = True) -> int:
+        """
+        Carrega um dump regional: lista JSON ou JSON Lines com
+        {"place_id", "name", "types", "lat", "lng"}. Com `authoritative`, os
+        tipos do dump passam a ser respondidos só pelo índice.
+        Retorna quantos POIs foram carregados.
+        """
+        with open(path, encoding="utf-8") as f:
+            text = f.read().strip()
+        rows = json.loads(text) if text.startswith("[") else [json.loads(line) for line in text.splitlines() if line]
+        for row in rows:
+            self.add({
+                "place_id": row["place_id"],
+                "name": row.get("name"),
+                "types": row.get("types", []),
+                "location": {"lat": row["lat"], "lng": row["lng"]},
+            })
+            if authoritative:
+                self.authoritative_types.update(row.get("types", []))
+        return len(rows)
+
+    def cells_along(self, path: Sequence[Point]) -> List[str]:
+        """
+        Células tocadas pela polyline (sem as vizinhas), na ordem do percurso
+        """
+        if not path:
+            return []
+        cell = geohash_encode(*path[0], self.precision)
+        min_lat, min_lng, max_lat, max_lng = bounds = geohash_bounds(cell)
+        step = min(max_lat - min_lat, max_lng - min_lng) / 2
+        cells = [cell]
+        for lat, lng in densify(path, step):
+            # Só recalcula o geohash quando o ponto sai da célula atual
+            if not (bounds[0] <= lat < bounds[2] and bounds[1] <= lng < bounds[3]):
+                cell = geohash_encode(lat, lng, self.precision)
+                bounds = geohash_bounds(cell)
+                cells.append(cell)
+        return list(dict.fromkeys(cells))
+
+    def max_radius(self, lat: float) -> float:
+        """
+        Maior raio de corredor que a grade cobre na latitude `lat`
+        """
+        return min(cell_size_m(self.precision, abs(lat)))
+
+    def corridor_cells(self, path: Sequence[Point], radius_m: float) -> List[str]:
+        """
+        Células que o corredor de `radius_m` metros em volta da polyline
+        alcança, na ordem do percurso. Levanta ValueError se o raio passar do
+        que as células vizinhas cobrem nesta precisão.
+        """
+        if not path:
+            return []
+        key = (tuple(path), radius_m)
+        if key in self._corridor_cells:
+            return self._corridor_cells[key]
+
+        max_lat = max(abs(lat) for lat, _ in path)
+        if radius_m > self.max_radius(max_lat):
+            raise ValueError(
+                f"Raio de {radius_m}m maior que o coberto pela precisão {self.precision} "
+                f"({self.max_radius(max_lat):.0f}m); use precision_for_radius"
+            )
+
+        candidates = list(dict.fromkeys(n for cell in self.cells_along(path) for n in _neighborhood(cell)))
+        # Célula alcançada: o centro está a menos de raio + meia diagonal da rota
+        distances, _ = point_to_polyline_distances([_center(cell) for cell in candidates], path)
+        height, width = cell_size_m(self.precision, 0.0)  # maior célula: no equador
+        reach = radius_m + math.hypot(height, width) / 2
+        cells = [cell for cell, d in zip(candidates, distances) if d <= reach]
+
+        self._corridor_cells[key] = cells
+        if len(self._corridor_cells) > CORRIDOR_CELLS_MEMO:
+            self._corridor_cells.popitem(last=False)
+        return cells
+
+    def corridor(self, path: Sequence[Point], radius_m: float,
+                 types: Optional[Iterable[str]] = None) -> List[dict]:
+        """
+        POIs a até `radius_m` metros da polyline, com "distance_m" e
+        "segment" (índice do segmento mais próximo), ordenados pelo percurso.
+        """
+        self.purge_expired()
+        grids = [self._grid[t] for t in (types or self._grid) if t in self._grid]
+        cells = self.corridor_cells(path, radius_m)
+        candidates = {}
+        for grid in grids:
+            for cell in cells:
+                candidates.update(grid.get(cell, ()))
+        if not candidates:
+            return []
+
+        pois = list(candidates.values())
+        distances, segments = point_to_polyline_distances(
+            [(p["location"]["lat"], p["location"]["lng"]) for p in pois], path
+        )
+        found = [
+            {**poi, "distance_m": round(float(d)), "segment": int(s)}
+            for poi, d, s in zip(pois, distances, segments) if d <= radius_m
+        ]
+        return sorted(found, key=lambda p: (p["segment"], p["distance_m"]))
@@ -0,0 +1,277 @@
+"""
+Testa o CacheEngine (LRU, limite de bytes, TTL por entrada, limpeza pelo heap,
+estatísticas incrementais por prefixo), a coalescência de chamadas
+concorrentes (single-flight), o cache de buscas e detalhes de lugares e o
+cache do LLM (acertos e tokens economizados)
+"""
+
+import asyncio
+import json
+import os
+import time
+from types import SimpleNamespace
+
+from cache import (
+    CacheEngine, _approx_size, cached_fetch, cached_llm_fetch, clear_cache, get_cache_key, get_cache_stats
+)
+
+
+def test_lru_eviction_by_entry_count():
+    cache = CacheEngine(max_entries=2, max_bytes=10_000)
+    cache.set("a", 1, ttl=60)
+    cache.set("b", 2, ttl=60)
+    assert cache.get("a") == 1  # "a" passa a ser o mais recente
+    cache.set("c", 3, ttl=60)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.evictions == 1
+
+
+def test_byte_budget_evicts_least_recently_used():
+    cache = CacheEngine(max_entries=100, max_bytes=2_500)
+    for i in range(5):
+        cache.set(f"k{i}", "x" * 1000, ttl=60)
+
+    assert cache.total_bytes <= 2_500
+    assert cache.get("k4") is not None
+    assert cache.get("k0") is None
+
+
+def test_ttl_is_stored_per_entry():
+    cache = CacheEngine()
+    cache.set("short", "a", ttl=0.05)
+    cache.set("long", "b", ttl=60)
+    time.sleep(0.06)
+
+    assert cache.get("short") is None
+    assert cache.get("long") == "b"
+
+
+def test_purge_expired_uses_heap_and_skips_overwritten_keys():
+    cache = CacheEngine()
+    cache.set("k", "old", ttl=0.01)
+    cache.set("k", "new", ttl=60)  # o item antigo do heap fica obsoleto
+    cache.set("gone", "x", ttl=0.01)
+    time.sleep(0.02)
+
+    assert cache.purge_expired() == 1
+    assert cache.get("k") == "new"
+    assert len(cache) == 1
+
+
+def recomputed_by_prefix(cache: CacheEngine) -> dict:
+    """entries / bytes por prefixo recalculados varrendo as entradas"""
+    totals = {}
+    for key, entry in cache._entries.items():
+        prefix = key.split(":", 1)[0] if ":" in key else "other"
+        stats = totals.setdefault(prefix, {"entries": 0, "bytes": 0})
+        stats["entries"] += 1
+        stats["bytes"] += entry.size
+    return totals
+
+
+def test_incremental_stats_match_a_full_scan():
+    cache = CacheEngine(max_entries=5, max_bytes=100_000)
+    cache.set("places:a", "x" * 100, ttl=60)
+    cache.set("places:b", "y" * 200, ttl=60)
+    cache.set("route_leg:a", [1, 2, 3], ttl=0.01)
+    cache.set("places:a", "z" * 50, ttl=60)  # sobrescrita troca o tamanho
+    cache.set("nokey", 1, ttl=60)
+    cache.set("route_matrix:a", (10, 20), ttl=60)
+    cache.set("route_matrix:b", (30, 40), ttl=60)  # despeja places:b, o menos usado
+    cache.delete("nokey")
+    time.sleep(0.02)
+    cache.purge_expired()
+
+    by_prefix = cache.stats()["by_prefix"]
+    live = {p: {"entries": s["entries"], "bytes": s["bytes"]} for p, s in by_prefix.items() if s["entries"]}
+    assert live == recomputed_by_prefix(cache)
+    assert cache.total_bytes == sum(e.size for e in cache._entries.values())
+    assert by_prefix["places"]["entries"] == 1 and by_prefix["places"]["bytes"] == _approx_size("z" * 50)
+    assert by_prefix["route_leg"]["entries"] == 0 and by_prefix["route_matrix"]["entries"] == 2
+    assert (cache.evictions, cache.expirations) == (1, 1)
+
+    cache.clear()
+    assert all(s["entries"] == s["bytes"] == 0 for s in cache.stats()["by_prefix"].values())
+
+
+def test_hits_and_misses_are_counted_per_prefix():
+    cache = CacheEngine()
+    cache.set("places:a", 1, ttl=60)
+    cache.set("llm_parse:a", 2, ttl=0.01)
+    time.sleep(0.02)
+
+    cache.get("places:a")
+    cache.get("places:a")
+    cache.get("places:missing")
+    cache.get("llm_parse:a")  # expirou: conta como miss
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["expirations"]) == (2, 2, 1)
+    assert stats["by_prefix"]["places"]["hits"] == 2 and stats["by_prefix"]["places"]["misses"] == 1
+    assert stats["by_prefix"]["places"]["hit_ratio"] == 2 / 3
+    assert stats["by_prefix"]["llm_parse"]["misses"] == 1 and stats["by_prefix"]["llm_parse"]["entries"] == 0
+
+
+def test_oldest_and_newest_entries_follow_write_order():
+    cache = CacheEngine()
+    cache.set("a", 1, ttl=60)
+    cache.set("b", 2, ttl=60)
+    cache.get("a")  # leitura não muda a ordem de escrita
+    first_b = cache._by_write["b"]
+    cache.set("c", 3, ttl=60)
+
+    stats = cache.stats()
+    assert stats["oldest_entry"] == cache._by_write["a"] <= first_b
+    assert stats["newest_entry"] == cache._by_write["c"]
+
+
+def test_single_flight_collapses_concurrent_misses():
+    calls = []
+
+    async def slow_geocode():
+        calls.append(1)
+        await asyncio.sleep(0.02)
+        return {"lat": -23.56, "lng": -46.65}
+
+    async def burst():
+        key = get_cache_key("geocoding", "Av. Paulista, 1578 (single-flight)")
+        return await asyncio.gather(*[cached_fetch(key, slow_geocode) for _ in range(10)])
+
+    before = get_cache_stats()["single_flight"]["deduplicated"]
+    results = asyncio.run(burst())
+
+    assert len(calls) == 1
+    assert all(r == {"lat": -23.56, "lng": -46.65} for r in results)
+    assert get_cache_stats()["single_flight"]["deduplicated"] - before == 9
+
+
+class PlacesMaps:
+    """places / place que contam as chamadas e guardam o centro da busca"""
+
+    def __init__(self):
+        self.searches = []
+        self.details = []
+
+    def places(self, query=None, location=None, radius=None, **kwargs):
+        self.searches.append((query, location))
+        return {"results": [{"name": query, "place_id": f"id-{len(self.searches)}"}]}
+
+    def place(self, place_id, fields=None, **kwargs):
+        self.details.append(place_id)
+        return {"result": {"name": place_id, "opening_hours": {"open_now": True}}}
+
+
+def install_places_maps(monkeypatch):
+    os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+    os.environ.setdefault("GOOGLE_MAPS_API_KEY", "AIzaTestKey")
+    import main
+    from external import AsyncClient
+
+    maps = PlacesMaps()
+    monkeypatch.setattr(main, "gmaps_async", AsyncClient(maps))
+    clear_cache()
+    return main, maps
+
+
+def test_place_search_hits_on_normalized_query_in_the_same_cell(monkeypatch):
+    main, maps = install_places_maps(monkeypatch)
+    paulista = {"lat": -23.5617, "lng": -46.6563}
+    nearby = {"lat": -23.5630, "lng": -46.6540}  # mesma célula (~4,9km)
+    far = {"lat": -23.6500, "lng": -46.7500}
+
+    first = asyncio.run(main.search_places_cached("Farmácia", paulista))
+    again = asyncio.run(main.search_places_cached("  farmacia ", nearby))
+    asyncio.run(main.search_places_cached("farmácia", far))
+
+    assert again == first
+    assert [q for q, _ in maps.searches] == ["Farmácia", "farmácia"]
+    # A busca sai do centro da célula, não do ponto de quem buscou primeiro
+    assert maps.searches[0][1] != (paulista["lat"], paulista["lng"])
+    assert get_cache_stats()["by_prefix"]["place_search"]["hits"] >= 1
+
+
+def test_place_details_hit_by_place_id(monkeypatch):
+    main, maps = install_places_maps(monkeypatch)
+
+    async def lookups():
+        return await asyncio.gather(*[main.get_place_details_cached("ChIJ-banco") for _ in range(3)])
+
+    results = asyncio.run(lookups())
+    asyncio.run(main.get_place_details_cached("ChIJ-banco"))
+    asyncio.run(main.get_place_details_cached("ChIJ-farmacia"))
+
+    assert maps.details == ["ChIJ-banco", "ChIJ-farmacia"]
+    assert all(r == results[0] for r in results)
+    assert get_cache_stats()["by_prefix"]["place_details"]["hits"] >= 1
+
+
+def tokens_saved() -> int:
+    return get_cache_stats()["llm"]["tokens_saved"]
+
+
+def test_llm_cache_hit_skips_the_model_and_counts_tokens_saved():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"suggestions": ["banco e lotérica ficam juntos"]}, 150
+
+    async def burst():
+        key = get_cache_key("llm_suggestions", "banco, lotérica (tokens)")
+        return await asyncio.gather(*[cached_llm_fetch(key, fetch) for _ in range(3)])
+
+    before = tokens_saved()
+    first = asyncio.run(burst())
+    after_burst = tokens_saved()
+    again = asyncio.run(burst())
+
+    assert len(calls) == 1 and first == again
+    assert after_burst == before  # chamadas concorrentes esperam a mesma chamada, não são hits
+    assert tokens_saved() - after_burst == 3 * 150
+    assert get_cache_stats()["llm"]["by_prefix"]["llm_suggestions"]["hits"] >= 3
+
+
+class CountingOpenAI:
+    """chat.completions.create com uso de tokens fixo; conta as chamadas"""
+
+    def __init__(self, content: str, tokens: int):
+        self.chat = SimpleNamespace(completions=self)
+        self.content = content
+        self.tokens = tokens
+        self.calls = 0
+
+    def create(self, **kwargs):
+        self.calls += 1
+        message = SimpleNamespace(content=self.content)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=message, finish_reason="stop")],
+            usage=SimpleNamespace(total_tokens=self.tokens),
+        )
+
+
+def test_errand_parse_hits_llm_cache_for_the_same_normalized_input(monkeypatch):
+    os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+    os.environ.setdefault("GOOGLE_MAPS_API_KEY", "AIzaTestKey")
+    import main
+    from external import AsyncClient
+
+    reply = json.dumps({"tasks": [
+        {"name": "ir ao dentista", "place_name": "dentista", "closing_time": None, "constraint": None},
+        {"name": "farmácia", "place_name": "farmácia", "closing_time": None, "constraint": None},
+    ]})
+    client = CountingOpenAI(reply, tokens=240)
+    monkeypatch.setattr(main, "openai_async", AsyncClient(client))
+    clear_cache()
+
+    # O parser local não resolve "dentista": vai para o GPT
+    first = asyncio.run(main.parse_errands_with_gpt("ir ao dentista e farmácia", "09:00"))
+    before = tokens_saved()
+    again = asyncio.run(main.parse_errands_with_gpt("  Ir ao  dentista e FARMÁCIA", "09:00"))
+    asyncio.run(main.parse_errands_with_gpt("ir ao dentista e farmácia", "14:00"))  # outro horário
+
+    assert client.calls == 2
+    assert [t.place_name for t in again] == [t.place_name for t in first] == ["dentista", "farmácia"]
+    assert tokens_saved() - before == 240
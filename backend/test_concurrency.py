@@ -0,0 +1,340 @@
+"""
+Testa que chamadas externas lentas não bloqueiam o event loop:
+N requisições concorrentes devem terminar em ~o tempo de uma só.
+"""
+
+import asyncio
+import json
+import os
+import time
+import zlib
+from types import SimpleNamespace
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("GOOGLE_MAPS_API_KEY", "AIzaTestKey")
+
+import features  # noqa: E402
+import main  # noqa: E402
+from cache import clear_cache  # noqa: E402
+from external import AsyncClient  # noqa: E402
+from spatial import POIIndex, precision_for_radius  # noqa: E402
+
+SLOW_CALL_SECONDS = 0.05
+CONCURRENT_REQUESTS = 8
+
+PARSED_TASKS = """{"tasks": [
+    {"name": "ir ao banco", "place_name": "banco", "closing_time": "16:00", "constraint": "urgent"},
+    {"name": "passar na farmácia", "place_name": "farmácia", "closing_time": null, "constraint": null},
+    {"name": "comprar pão", "place_name": "padaria", "closing_time": null, "constraint": "last"}
+]}"""
+
+
+class SlowOpenAI:
+    """Imita o SDK síncrono do OpenAI: bloqueia a thread durante a chamada"""
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, **kwargs):
+        time.sleep(SLOW_CALL_SECONDS)
+        message = SimpleNamespace(content=PARSED_TASKS)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+class SlowMaps:
+    """Imita o googlemaps.Client síncrono com latência fixa por chamada"""
+
+    def _location(self, point):
+        if isinstance(point, dict):
+            return {"lat": point["lat"], "lng": point["lng"]}
+        return {"lat": point[0], "lng": point[1]}
+
+    def geocode(self, address):
+        time.sleep(SLOW_CALL_SECONDS)
+        return [{"geometry": {"location": {"lat": -23.561, "lng": -46.656}}}]
+
+    def places(self, query, location=None, radius=None):
+        time.sleep(SLOW_CALL_SECONDS)
+        offset = len(query) / 1000
+        return {"results": [{
+            "place_id": f"place-{query}",
+            "formatted_address": f"Rua {query}, 100",
+            "geometry": {"location": {"lat": -23.56 + offset, "lng": -46.65 - offset}},
+            "types": ["bank"],
+        }]}
+
+    def place(self, place_id, fields=None):
+        time.sleep(SLOW_CALL_SECONDS)
+        return {"result": {"opening_hours": {"periods": [{"close": {"time": "1800"}}]}}}
+
+    def directions(self, origin, destination, waypoints=None, **kwargs):
+        time.sleep(SLOW_CALL_SECONDS)
+        points = [origin] + list(waypoints or []) + [destination]
+        legs = [{
+            "duration": {"value": 600, "text": "10 mins"},
+            "distance": {"value": 2000, "text": "2.0 km"},
+            "start_location": self._location(a),
+            "end_location": self._location(b),
+            "end_address": "Av. Paulista",
+            "steps": [{"polyline": {"points": "_p~iF~ps|U_ulLnnqC"}}],
+        } for a, b in zip(points, points[1:])]
+        return [{"legs": legs, "overview_polyline": {"points": "_p~iF~ps|U_ulLnnqC"}}]
+
+    def distance_matrix(self, origins, destinations, **kwargs):
+        time.sleep(SLOW_CALL_SECONDS)
+        element = {"status": "OK", "duration": {"value": 600}, "distance": {"value": 2000}}
+        return {"rows": [{"elements": [element for _ in destinations]} for _ in origins]}
+
+    def places_nearby(self, location=None, radius=None, type=None, **kwargs):
+        time.sleep(SLOW_CALL_SECONDS)
+        return {"results": []}
+
+
+def install_slow_backends(monkeypatch):
+    monkeypatch.setattr(main, "openai_async", AsyncClient(SlowOpenAI()))
+    monkeypatch.setattr(main, "gmaps_async", AsyncClient(SlowMaps()))
+    monkeypatch.setattr(features, "openai_async", AsyncClient(SlowOpenAI()))
+
+
+def make_request(i: int) -> main.ErrandRequest:
+    return main.ErrandRequest(
+        user_input="banco (fecha às 16h), farmácia e pão na volta",
+        start_address=f"Av. Paulista, {1000 + i}, São Paulo",
+        start_time="09:00",
+    )
+
+
+async def timed(coro) -> float:
+    started = time.perf_counter()
+    await coro
+    return time.perf_counter() - started
+
+
+class DistinctMaps(SlowMaps):
+    """Cada endereço cai numa região própria: requisições diferentes não dividem cache"""
+
+    def geocode(self, address):
+        time.sleep(SLOW_CALL_SECONDS)
+        offset = zlib.crc32(address.encode()) % 1000 * 0.1
+        return [{"geometry": {"location": {"lat": -60.0 + offset / 10, "lng": -80.0 + offset}}}]
+
+    def places(self, query, location=None, radius=None):
+        time.sleep(SLOW_CALL_SECONDS)
+        lat, lng = location
+        offset = len(query) / 1000
+        return {"results": [{
+            "place_id": f"place-{query}-{lat:.3f}-{lng:.3f}",
+            "formatted_address": f"Rua {query}, 100",
+            "geometry": {"location": {"lat": lat + offset, "lng": lng - offset}},
+            "types": ["bank"],
+        }]}
+
+
+def cold_start(monkeypatch):
+    """Cache e índice de POIs vazios: cada medição faz todas as chamadas externas"""
+    clear_cache()
+    monkeypatch.setattr(main, "poi_index", POIIndex(precision_for_radius(main.NEARBY_POI_RADIUS)))
+
+
+def test_concurrent_requests_do_not_block_each_other(monkeypatch):
+    install_slow_backends(monkeypatch)
+    monkeypatch.setattr(main, "gmaps_async", AsyncClient(DistinctMaps()))
+
+    cold_start(monkeypatch)
+    single = asyncio.run(timed(main.optimize_errands(make_request(0))))
+
+    async def burst():
+        await asyncio.gather(*[
+            main.optimize_errands(make_request(i)) for i in range(1, CONCURRENT_REQUESTS + 1)
+        ])
+
+    cold_start(monkeypatch)
+    concurrent = asyncio.run(timed(burst()))
+
+    print(f"1 requisição: {single:.2f}s | {CONCURRENT_REQUESTS} concorrentes: {concurrent:.2f}s")
+    # Com chamadas bloqueando o loop seriam ~N x single (cada requisição faz as próprias chamadas)
+    assert concurrent < CONCURRENT_REQUESTS * single / 3
+
+
+class StreamingOpenAI(SlowOpenAI):
+    """Imita o stream=True do SDK: o JSON do parse chega em pedaços ao longo do tempo"""
+
+    def __init__(self):
+        super().__init__()
+        self.finished_at = None
+
+    def create(self, **kwargs):
+        if not kwargs.get("stream"):
+            return super().create(**kwargs)
+        return self._chunks()
+
+    def _chunks(self):
+        for piece in PARSED_TASKS.splitlines(keepends=True):
+            time.sleep(SLOW_CALL_SECONDS)
+            delta = SimpleNamespace(content=piece)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=None)], usage=None)
+        self.finished_at = time.perf_counter()
+
+
+class RecordingMaps(SlowMaps):
+    def __init__(self):
+        self.first_search_at = None
+
+    def places(self, query, location=None, radius=None):
+        self.first_search_at = self.first_search_at or time.perf_counter()
+        return super().places(query, location, radius)
+
+
+def test_streaming_parse_starts_place_lookups_before_generation_ends(monkeypatch):
+    openai_stub, maps_stub = StreamingOpenAI(), RecordingMaps()
+    monkeypatch.setattr(main, "LLM_STREAM_PARSE", True)
+    monkeypatch.setattr(main, "openai_async", AsyncClient(openai_stub))
+    monkeypatch.setattr(main, "gmaps_async", AsyncClient(maps_stub))
+    monkeypatch.setattr(features, "openai_async", AsyncClient(SlowOpenAI()))
+    clear_cache()  # as buscas do teste anterior estariam em cache
+
+    request = main.ErrandRequest(
+        # Fora do vocabulário do parser local: obriga a passar pelo GPT
+        user_input="resolver umas pendências no centro (streaming)",
+        start_address="Av. Paulista, 900, São Paulo",
+        start_time="09:00",
+    )
+    response = asyncio.run(main.optimize_errands(request))
+
+    assert [t.place_name for t in response.tasks] == ["banco", "farmácia", "padaria"]
+    assert all(t.address for t in response.tasks)
+    assert maps_stub.first_search_at < openai_stub.finished_at
+
+
+class CountingMaps(SlowMaps):
+    """SlowMaps que conta as chamadas de geocoding e busca textual"""
+
+    def __init__(self):
+        self.calls = {"geocode": 0, "places": 0}
+
+    def geocode(self, address):
+        self.calls["geocode"] += 1
+        return super().geocode(address)
+
+    def places(self, query, location=None, radius=None):
+        self.calls["places"] += 1
+        return super().places(query, location, radius)
+
+
+def test_batch_endpoint_shares_work_and_isolates_failures(monkeypatch):
+    maps_stub = CountingMaps()
+    monkeypatch.setattr(main, "gmaps_async", AsyncClient(maps_stub))
+    monkeypatch.setattr(main, "openai_async", AsyncClient(SlowOpenAI()))
+    monkeypatch.setattr(features, "openai_async", AsyncClient(SlowOpenAI()))
+    clear_cache()
+
+    requests = [
+        main.ErrandRequest(
+            user_input="banco (fecha às 16h), farmácia e pão na volta",
+            start_address=f"Depósito {i % 2}, São Paulo",
+            start_time="09:00",
+        )
+        for i in range(6)
+    ]
+    requests.append(main.ErrandRequest(
+        user_input="banco", start_address="Depósito 0, São Paulo", start_time="25:99"
+    ))
+
+    response = asyncio.run(main.optimize_errands_batch(main.BatchErrandRequest(requests=requests)))
+
+    assert (response.succeeded, response.failed) == (6, 1)
+    assert response.results[6].status_code == 500 and response.results[6].error
+    assert all(r.result.optimized_route for r in response.results[:6])
+    # Dois depósitos distintos e as mesmas três lojas para o lote inteiro
+    assert maps_stub.calls["geocode"] == 2
+    assert maps_stub.calls["places"] == 3
+
+
+def test_stream_emits_route_before_enrichments(monkeypatch):
+    install_slow_backends(monkeypatch)
+
+    async def collect():
+        request = make_request(50)
+        request.suggest_best_time = True
+        return [json.loads(line) async for line in main.stream_plan_events(request, sse=False)]
+
+    events = [e["event"] for e in asyncio.run(collect())]
+
+    assert events.index("parsed_tasks") < events.index("tasks") < events.index("route")
+    assert events.index("route") < events.index("nearby_points")
+    assert "better_alternatives" in events  # só depende das tarefas; pode vir do cache antes da rota
+    assert "best_departure_time" in events and "tourist_itinerary" not in events
+    assert events[-1] == "done"
+
+
+class RatedNearbyMaps(SlowMaps):
+    """places_nearby lento com um lugar bem avaliado; conta as chamadas"""
+
+    def __init__(self):
+        self.nearby_calls = 0
+
+    def places_nearby(self, location=None, radius=None, type=None, **kwargs):
+        self.nearby_calls += 1
+        time.sleep(SLOW_CALL_SECONDS)
+        return {"results": [{"name": "Loja Nota 5", "rating": 4.8, "user_ratings_total": 120, "vicinity": "Rua A"}]}
+
+
+def test_better_alternatives_run_concurrently_and_share_cells(monkeypatch):
+    maps_stub = RatedNearbyMaps()
+    monkeypatch.setattr(main, "gmaps_async", AsyncClient(maps_stub))
+    monkeypatch.setattr(main, "ALTERNATIVES_BUDGET", 2)
+    clear_cache()
+
+    # Duas tarefas na mesma célula, uma em outra e uma fora do orçamento
+    tasks = [
+        main.Task(name="banco", lat=-23.5610, lng=-46.6560),
+        main.Task(name="farmácia", lat=-23.5612, lng=-46.6562),
+        main.Task(name="padaria", lat=-23.5900, lng=-46.6900),
+        main.Task(name="correios", lat=-23.6500, lng=-46.7500),
+    ]
+    elapsed = asyncio.run(timed(main.find_better_alternatives(tasks)))
+    result = asyncio.run(main.find_better_alternatives(tasks))
+
+    assert [r["for_task"] for r in result] == ["banco", "farmácia", "padaria"]
+    assert maps_stub.nearby_calls == 2
+    assert elapsed < 2 * SLOW_CALL_SECONDS
+
+
+class SlowBatchOpenAI(SlowOpenAI):
+    """Resposta combinada lenta (várias seções com max_tokens somados); o parse é rápido"""
+
+    def create(self, **kwargs):
+        if "## Seção" in kwargs["messages"][0]["content"]:
+            time.sleep(10 * SLOW_CALL_SECONDS)
+        return super().create(**kwargs)
+
+
+@pytest.mark.parametrize("user_input", [
+    "banco (fecha às 16h), farmácia e pão na volta",  # parser local resolve sozinho
+    "resolver aquela pendência com o contador e depois ver o presente da Ju",  # precisa do GPT
+])
+def test_route_does_not_wait_for_batched_analysis(monkeypatch, user_input):
+    monkeypatch.setattr(main, "LLM_PROMPT_BATCHING", True)
+    monkeypatch.setattr(main, "LLM_STREAM_PARSE", False)
+    monkeypatch.setattr(main, "openai_async", AsyncClient(SlowBatchOpenAI()))
+    monkeypatch.setattr(main, "gmaps_async", AsyncClient(SlowMaps()))
+    monkeypatch.setattr(features, "openai_async", AsyncClient(SlowBatchOpenAI()))
+    clear_cache()
+
+    request = make_request(60)
+    request.user_input = user_input
+    request.tourist_mode = True
+
+    async def finished_stages():
+        return [stage async for stage, _ in main.build_errand_graph(request).iter_results()]
+
+    stages = asyncio.run(finished_stages())
+
+    assert stages.index("route") < stages.index("llm_batch")
+    assert stages.index("parsed_tasks") < stages.index("llm_batch")
+
+if __name__ == "__main__":
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        test_concurrent_requests_do_not_block_each_other(monkeypatch)
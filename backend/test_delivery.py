@@ -0,0 +1,70 @@
+"""
+Testa o Modo Entregador (delivery.py): solve_tour / two_opt / or_opt devolvem
+uma permutação válida das paradas, nunca pior que o tour guloso, e respeitam
+o orçamento de tempo.
+"""
+
+import time
+
+import numpy as np
+
+from delivery import greedy_tour, haversine_matrix, or_opt, order_deliveries, solve_tour, tour_length, two_opt
+
+# Centro de São Paulo, paradas espalhadas num raio de ~15km (como bench_delivery.py)
+CENTER = (-23.5505, -46.6333)
+SPREAD_DEG = 0.14
+
+
+def random_dist(n: int, seed: int = 42) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    lats = CENTER[0] + rng.uniform(-SPREAD_DEG, SPREAD_DEG, n)
+    lngs = CENTER[1] + rng.uniform(-SPREAD_DEG, SPREAD_DEG, n)
+    return haversine_matrix(lats, lngs)
+
+
+def closed(order) -> np.ndarray:
+    return np.array([0] + list(order) + [0])
+
+
+def test_solve_tour_is_a_permutation_never_worse_than_greedy():
+    for n, seed in [(2, 1), (3, 2), (10, 3), (60, 4), (200, 5)]:
+        dist = random_dist(n, seed)
+        order = solve_tour(dist, time_budget=0.2)
+
+        assert sorted(order) == list(range(1, n))
+        assert tour_length(closed(order), dist) <= tour_length(greedy_tour(dist), dist) + 1e-6
+
+
+def test_local_search_moves_keep_a_valid_tour_and_improve():
+    dist = random_dist(80, seed=7)
+    tour = greedy_tour(dist)
+    before = tour_length(tour, dist)
+    deadline = time.perf_counter() + 1.0
+
+    two_opt(tour, dist, deadline)
+    after_two_opt = tour_length(tour, dist)
+    tour, _ = or_opt(tour, dist, deadline)
+
+    assert tour[0] == tour[-1] == 0 and sorted(tour[1:-1]) == list(range(1, 80))
+    assert tour_length(tour, dist) <= after_two_opt <= before
+    assert tour_length(tour, dist) < before
+
+
+def test_solve_tour_respects_time_budget():
+    dist = random_dist(500, seed=11)
+    budget = 0.1
+
+    started = time.perf_counter()
+    order = solve_tour(dist, time_budget=budget)
+    elapsed = time.perf_counter() - started
+
+    assert sorted(order) == list(range(1, 500))
+    # Uma passada interrompida no prazo termina a iteração corrente
+    assert elapsed < budget + 0.25
+
+
+def test_order_deliveries_returns_stop_indices():
+    start = {"lat": CENTER[0], "lng": CENTER[1]}
+    stops = [{"lat": CENTER[0] + 0.01 * k, "lng": CENTER[1]} for k in (3, 1, 2)]
+
+    assert order_deliveries(start, stops, time_budget=0.05) in ([1, 2, 0], [0, 2, 1])
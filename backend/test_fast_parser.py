@@ -0,0 +1,125 @@
+"""
+Testa o parser local (fast_parser) contra um corpus de entradas reais com a
+saída do GPT: onde ele se declara confiante, deve concordar com o modelo.
+Rodar direto (python test_fast_parser.py --live) compara com o GPT ao vivo.
+"""
+
+import asyncio
+import json
+import os
+import sys
+import time
+
+from fast_parser import parse_errands_locally, parse_if_confident
+
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), "fast_parser_corpus.json")
+
+
+def load_corpus():
+    with open(CORPUS_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def signature(tasks):
+    return [[t["place_name"], t["closing_time"], t["constraint"]] for t in tasks]
+
+
+def agreement(corpus):
+    """
+    (entradas em que o parser local foi usado, quantas concordam com o GPT)
+    """
+    used = agreed = 0
+    for entry in corpus:
+        tasks = parse_if_confident(entry["input"])
+        if tasks is None:
+            continue
+        used += 1
+        agreed += signature(tasks) == entry["gpt"]
+    return used, agreed
+
+
+def test_confident_parses_agree_with_gpt():
+    corpus = load_corpus()
+    used, agreed = agreement(corpus)
+
+    assert agreed == used
+    # A maior parte das entradas formulaicas não deve precisar do GPT
+    assert used >= 0.7 * len(corpus)
+
+
+def test_unknown_places_fall_back_to_gpt():
+    tasks, confidence = parse_errands_locally("ir ao dentista, farmácia e mercado")
+
+    assert confidence < 1.0
+    assert parse_if_confident("ir ao dentista, farmácia e mercado") is None
+    assert [t["place_name"] for t in tasks] == ["farmácia", "supermercado"]
+
+
+def test_negation_and_ambiguity_fall_back_to_gpt():
+    for text in [
+        "não preciso ir ao banco, só farmácia",  # o banco está negado
+        "buscar pacote na portaria",  # "pacote" não é ir aos correios
+        "farmácia ou drogaria",
+        "se der tempo, padaria",
+    ]:
+        assert parse_if_confident(text) is None, text
+
+    # "sem falta" é urgência, não negação
+    assert signature(parse_if_confident("enviar um sedex sem falta")) == [["correios", None, "urgent"]]
+
+
+def test_task_names_drop_connectives_and_keep_place_prefixes():
+    tasks = parse_if_confident("passar no banco e depois no correio")
+    assert [t["name"] for t in tasks] == ["Passar no banco", "Correio"]
+
+    # "banco:" é o lugar, não o nome de quem pediu ("Maria: ...")
+    assert [t["name"] for t in parse_if_confident("banco: depositar cheque")] == ["Banco: depositar cheque"]
+    assert [t["name"] for t in parse_if_confident("Maria: farmácia")] == ["Farmácia"]
+
+
+def test_closing_time_needs_a_whole_word():
+    tasks = parse_if_confident("mercado comprar chocolate 2 horas antes do jantar")
+    assert signature(tasks) == [["supermercado", None, None]]
+
+
+def test_parse_runs_in_microseconds():
+    text = load_corpus()[0]["input"]
+    runs = 1000
+
+    started = time.perf_counter()
+    for _ in range(runs):
+        parse_errands_locally(text)
+    per_call_us = (time.perf_counter() - started) / runs * 1_000_000
+
+    assert per_call_us < 1000
+
+
+async def live_agreement():
+    """
+    Compara o parser local com o GPT de verdade (precisa de OPENAI_API_KEY)
+    """
+    import main
+
+    corpus = load_corpus()
+    used = agreed = 0
+    for entry in corpus:
+        gpt_tasks, _ = await main.request_errand_parse(entry["input"], None)
+        local_tasks = parse_if_confident(entry["input"])
+        if local_tasks is None:
+            print(f"   GPT   {entry['input']}")
+            continue
+        used += 1
+        same = signature(local_tasks) == signature(gpt_tasks)
+        agreed += same
+        print(f"{'✅' if same else '❌'} local {entry['input']}")
+        if not same:
+            print(f"     GPT:   {signature(gpt_tasks)}\n     local: {signature(local_tasks)}")
+    print(f"\nParser local usado em {used}/{len(corpus)}; concordância {agreed}/{used}")
+
+
+if __name__ == "__main__":
+    if "--live" in sys.argv:
+        asyncio.run(live_agreement())
+    else:
+        used, agreed = agreement(load_corpus())
+        print(f"Parser local usado em {used}/{len(load_corpus())}; concordância {agreed}/{used}")
@@ -0,0 +1,222 @@
+"""
+Testa o helper de saída estruturada (llm.complete_json): validação no
+modelo tipado, nova tentativa com o erro e falha tipada; e o decodificador
+incremental usado no parse em streaming e o prompt batching do main.
+"""
+
+import asyncio
+import json
+import os
+from types import SimpleNamespace
+from typing import List, Optional
+
+import pytest
+from pydantic import BaseModel
+
+from llm import JSONArrayStream, LLMResponseError, complete_json, response_format
+
+
+class Suggestions(BaseModel):
+    suggestions: List[str]
+
+
+class ScriptedOpenAI:
+    """Devolve as respostas na ordem e guarda os pedidos"""
+
+    def __init__(self, *contents):
+        self.contents = list(contents)
+        self.requests = []
+        self.chat = SimpleNamespace(completions=self)
+
+    async def create(self, **kwargs):
+        self.requests.append(kwargs)
+        message = SimpleNamespace(content=self.contents.pop(0))
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=message, finish_reason="stop")],
+            usage=SimpleNamespace(total_tokens=10),
+        )
+
+
+def run(client):
+    return asyncio.run(complete_json(
+        client, [{"role": "user", "content": "sugira"}], Suggestions, max_tokens=50
+    ))
+
+
+def test_valid_reply_inside_fences_is_accepted():
+    client = ScriptedOpenAI('```json\n{"suggestions": ["sacar na farmácia"]}\n```')
+    result, tokens = run(client)
+
+    assert result.suggestions == ["sacar na farmácia"]
+    assert tokens == 10
+    assert client.requests[0]["response_format"]["json_schema"]["strict"] is True
+    assert client.requests[0]["max_tokens"] == 50
+
+
+def test_schema_error_is_retried_once_with_the_error():
+    client = ScriptedOpenAI('{"tips": []}', '{"suggestions": ["ok"]}')
+    result, tokens = run(client)
+
+    assert result.suggestions == ["ok"]
+    assert tokens == 20
+    retry_messages = client.requests[1]["messages"]
+    assert retry_messages[-2] == {"role": "assistant", "content": '{"tips": []}'}
+    assert "suggestions" in retry_messages[-1]["content"]
+
+
+def test_second_invalid_reply_raises_typed_error():
+    client = ScriptedOpenAI("não sei", '{"suggestions": "x"}')
+
+    with pytest.raises(LLMResponseError):
+        run(client)
+    assert len(client.requests) == 2
+
+
+class Book(BaseModel):
+    title: str
+    default: Optional[str] = None
+
+
+class Shelf(BaseModel):
+    books: List[Book]
+    label: str = "estante"
+
+
+def test_strict_schema_keeps_properties_named_like_keywords():
+    schema = response_format(Shelf)["json_schema"]["schema"]
+    book = schema["$defs"]["Book"]
+
+    assert "title" not in schema and "default" not in schema["properties"]["label"]
+    assert list(book["properties"]) == ["title", "default"]
+    assert book["required"] == ["title", "default"] and book["additionalProperties"] is False
+    assert "title" not in book["properties"]["title"]
+
+
+def test_parse_schema_descriptions_are_plain_instructions():
+    os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+    os.environ.setdefault("GOOGLE_MAPS_API_KEY", "AIzaTestKey")
+    import main
+
+    for model in (main.ParsedErrands, main.ParsedCarpool):
+        assert "Melhoria" not in json.dumps(response_format(model), ensure_ascii=False)
+
+
+def test_array_stream_emits_each_object_when_it_closes():
+    decoder = JSONArrayStream()
+    text = '{"tasks": [{"name": "a } \\" {", "x": [1, {"y": 2}]}, {"name": "b"}], "other": [{"z": 1}]}'
+
+    emitted = []
+    for i, char in enumerate(text):
+        for item in decoder.feed(char):
+            emitted.append((item, i))
+
+    assert [item for item, _ in emitted] == [{"name": 'a } " {', "x": [1, {"y": 2}]}, {"name": "b"}]
+    # O primeiro objeto sai antes de o segundo começar
+    assert emitted[0][1] < text.index('{"name": "b"}')
+
+
+BATCHED_REPLY = json.dumps({
+    "smart_suggestions": ["Compre as lembrancinhas na loja do próprio museu"],
+    "tourist_itinerary": {
+        "itinerary": [{"attraction": "MASP", "visit_duration": "90", "best_time": "10:00",
+                       "tips": "terça é gratuito", "nearby_restaurants": ["A Baianeira"]}],
+        "total_time": "2h", "recommendations": [],
+    },
+    "task_split": {
+        "splits": [{"person": 1, "tasks": ["visitar o MASP"], "estimated_time": "90",
+                    "route_summary": "Paulista"}],
+        "meeting_point": "MASP", "time_saved": "20 min", "recommendations": [],
+    },
+})
+
+
+def test_enabled_features_share_one_structured_call(monkeypatch):
+    os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+    os.environ.setdefault("GOOGLE_MAPS_API_KEY", "AIzaTestKey")
+    import main
+
+    client = ScriptedOpenAI(BATCHED_REPLY)
+    monkeypatch.setattr(main, "openai_async", client)
+    request = main.ErrandRequest(
+        user_input="visitar o MASP e comprar lembrancinhas (lote)",
+        start_address="Av. Paulista, 1578",
+        tourist_mode=True,
+        num_people_split=2,
+    )
+
+    parsed_tasks = [
+        main.Task(name="visitar o MASP", place_name="museu"),
+        main.Task(name="comprar lembrancinhas", place_name="loja de presentes", constraint="last"),
+    ]
+
+    result = asyncio.run(main.request_batched_analysis(request, parsed_tasks, include_split=True))
+
+    assert len(client.requests) == 1
+    sections = client.requests[0]["response_format"]["json_schema"]["schema"]["required"]
+    assert sections == ["smart_suggestions", "tourist_itinerary", "task_split"]
+    assert "- comprar lembrancinhas em loja de presentes" in client.requests[0]["messages"][0]["content"]
+    assert result["smart_suggestions"] == ["Compre as lembrancinhas na loja do próprio museu"]
+    assert result["tourist_itinerary"]["itinerary"][0]["attraction"] == "MASP"
+    assert result["task_split"]["meeting_point"] == "MASP"
+    assert result["shopping_analysis"] is None
+
+
+def test_carpool_riders_are_parsed_in_one_call_and_tagged(monkeypatch):
+    os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+    os.environ.setdefault("GOOGLE_MAPS_API_KEY", "AIzaTestKey")
+    import main
+
+    client = ScriptedOpenAI(json.dumps({"tasks": [
+        {"name": "levar o cachorro ao veterinário", "place_name": "veterinário",
+         "closing_time": None, "constraint": None, "person": "Maria"},
+        {"name": "buscar o terno", "place_name": "alfaiataria",
+         "closing_time": "18:00", "constraint": "urgent", "person": "João"},
+    ]}))
+    monkeypatch.setattr(main, "openai_async", client)
+    carpooling = [
+        {"name": "Ana", "tasks": "farmácia e padaria"},  # parser local, sem GPT
+        {"name": "Maria", "tasks": "levar o cachorro ao veterinário (carona)"},
+        {"name": "João", "tasks": "buscar o terno na alfaiataria (carona)"},
+    ]
+
+    tasks = asyncio.run(main.parse_carpooling_tasks(carpooling, {}))
+    info = asyncio.run(main.optimize_carpooling(tasks, tasks))
+
+    assert len(client.requests) == 1
+    assert [(t.person, t.place_name) for t in tasks] == [
+        ("Ana", "farmácia"), ("Ana", "padaria"), ("Maria", "veterinário"), ("João", "alfaiataria"),
+    ]
+    assert tasks[3].name == "buscar o terno"
+    assert tasks[3].display_name == "buscar o terno (João)"
+    assert info["total_people"] == 4
+
+
+def test_riders_without_errands_cost_no_model_calls(monkeypatch):
+    os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+    os.environ.setdefault("GOOGLE_MAPS_API_KEY", "AIzaTestKey")
+    import main
+    from cache import clear_cache
+
+    # A resposta válida deixa o Pedro sem tarefas: ele não é reinterpretado sozinho
+    client = ScriptedOpenAI(json.dumps({"tasks": [
+        {"name": "buscar o terno", "place_name": "alfaiataria",
+         "closing_time": None, "constraint": None, "person": "João"},
+    ]}))
+    monkeypatch.setattr(main, "openai_async", client)
+    clear_cache()
+    carpooling = [
+        {"name": "Bia", "tasks": "", "pickup_address": "Rua A, 1"},  # só a carona
+        {"name": "Caio", "tasks": None},
+        {"name": "João", "tasks": "buscar o terno na alfaiataria (sem tarefas)"},
+        {"name": "Pedro", "tasks": "resolver umas coisas no centro (sem tarefas)"},
+    ]
+
+    tasks = asyncio.run(main.parse_carpooling_tasks(carpooling, {}))
+
+    assert len(client.requests) == 1
+    prompt = client.requests[0]["messages"][-1]["content"]
+    assert "Bia" not in prompt and "Caio" not in prompt
+    assert [(t.person, t.place_name) for t in tasks] == [("João", "alfaiataria")]
+
+    assert asyncio.run(main.parse_carpooling_tasks(carpooling[:2], {})) == []
+    assert len(client.requests) == 1
@@ -0,0 +1,52 @@
+"""
+Testa a instrumentação (metrics.py): spans dos estágios e das chamadas
+externas no header Server-Timing e a exposição em /metrics
+"""
+
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("GOOGLE_MAPS_API_KEY", "AIzaTestKey")
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import main  # noqa: E402
+import metrics  # noqa: E402
+from test_concurrency import install_slow_backends  # noqa: E402
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram("test_seconds", "teste", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe(value, name="x")
+
+    lines = histogram.render()
+    assert 'test_seconds_bucket{name="x",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{name="x",le="1"} 3' in lines
+    assert 'test_seconds_bucket{name="x",le="+Inf"} 4' in lines
+    assert 'test_seconds_count{name="x"} 4' in lines
+
+
+def test_server_timing_header_and_metrics_endpoint(monkeypatch):
+    install_slow_backends(monkeypatch)
+    client = TestClient(main.app)
+    body = {
+        "user_input": "banco (fecha às 16h), farmácia e pão na volta",
+        "start_address": "Av. Paulista, 2000 (métricas), São Paulo",
+        "start_time": "09:00",
+    }
+
+    plain = client.post("/api/optimize-errands", json=body)
+    debug = client.post("/api/optimize-errands", json=body, headers={"X-Debug-Timing": "1"})
+
+    assert plain.status_code == debug.status_code == 200
+    assert "server-timing" not in plain.headers
+    timing = debug.headers["server-timing"]
+    assert "stage.route;dur=" in timing and "stage.totals;dur=" in timing
+    assert timing.endswith(tuple("0123456789")) and "total;dur=" in timing
+
+    exposition = client.get("/metrics").text
+    assert 'errand_span_seconds_count{kind="stage",name="route"}' in exposition
+    assert 'method="geocode",service="test_concurrency",status="ok"' in exposition
+    assert 'path="/api/optimize-errands",status="200"' in exposition
+    assert 'errand_cache_requests_total{cache="api",prefix="geocoding",result="hit"}' in exposition
@@ -0,0 +1,107 @@
+"""
+Testa o grafo de estágios (pipeline.StageGraph): ramos independentes em
+paralelo, ciclos e dependências desconhecidas, estágios desabilitados e o
+cancelamento dos dependentes quando um estágio falha.
+"""
+
+import asyncio
+import time
+
+import pytest
+
+from pipeline import StageGraph
+
+STAGE_SECONDS = 0.05
+
+
+async def slow(value):
+    await asyncio.sleep(STAGE_SECONDS)
+    return value
+
+
+def test_independent_stages_run_concurrently():
+    graph = (
+        StageGraph()
+        .add("a", lambda: slow(1))
+        .add("b", lambda: slow(2))
+        .add("c", lambda: slow(3))
+        .add("total", lambda a, b, c: a + b + c, deps=["a", "b", "c"])
+    )
+
+    started = time.perf_counter()
+    results = asyncio.run(graph.run())
+    elapsed = time.perf_counter() - started
+
+    assert results["total"] == 6
+    assert elapsed < 2 * STAGE_SECONDS  # em série seriam 3x
+
+
+def test_cycle_and_unknown_dependency_raise():
+    cycle = StageGraph().add("a", lambda b: b, deps=["b"]).add("b", lambda a: a, deps=["a"])
+    with pytest.raises(ValueError, match="Ciclo"):
+        asyncio.run(cycle.run())
+
+    unknown = StageGraph().add("a", lambda missing: missing, deps=["missing"])
+    with pytest.raises(ValueError, match="desconhecida"):
+        asyncio.run(unknown.run())
+
+    with pytest.raises(ValueError, match="duplicado"):
+        StageGraph().add("a", lambda: 1).add("a", lambda: 2)
+
+
+def test_disabled_stage_returns_default_without_running():
+    calls = []
+    graph = (
+        StageGraph()
+        .add("tasks", lambda: ["banco"])
+        .add("tourist", lambda tasks: calls.append(tasks), deps=["tasks"], enabled=False, default={})
+        .add("summary", lambda tourist: tourist, deps=["tourist"])
+    )
+
+    done = []
+    results = asyncio.run(graph.run(lambda name, _: done.append(name)))
+
+    assert calls == []
+    assert results["tourist"] == {} and results["summary"] == {}
+    assert "tourist" not in done  # on_stage_done só para estágios que rodaram
+
+
+def test_failure_cancels_dependent_and_pending_stages():
+    finished = []
+
+    async def long_stage():
+        await asyncio.sleep(1)
+        finished.append("long")
+
+    def failing():
+        raise RuntimeError("Maps fora do ar")
+
+    graph = (
+        StageGraph()
+        .add("geocode", failing)
+        .add("route", lambda geocode: finished.append("route"), deps=["geocode"])
+        .add("long", long_stage)
+    )
+
+    started = time.perf_counter()
+    with pytest.raises(RuntimeError, match="Maps fora do ar"):
+        asyncio.run(graph.run())
+
+    assert finished == []
+    assert time.perf_counter() - started < 0.5  # o estágio longo foi cancelado
+
+
+def test_iter_results_yields_in_completion_order():
+    graph = (
+        StageGraph()
+        .add("slow", lambda: slow("slow"))
+        .add("fast", lambda: "fast")
+        .add("after_fast", lambda fast: fast + "!", deps=["fast"])
+    )
+
+    async def collect():
+        return [name async for name, _ in graph.iter_results()]
+
+    order = asyncio.run(collect())
+
+    assert order.index("fast") < order.index("after_fast") < order.index("slow")
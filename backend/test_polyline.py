@@ -0,0 +1,105 @@
+"""
+Testa a simplificação Douglas–Peucker, a junção das polylines da rota e o
+tamanho da rota serializada na resposta
+"""
+
+import json
+import math
+import os
+import random
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("GOOGLE_MAPS_API_KEY", "AIzaTestKey")
+
+import main  # noqa: E402
+import polyline  # noqa: E402
+from routing import RouteLeg  # noqa: E402
+from spatial import point_to_polyline_distances  # noqa: E402
+
+
+def wiggly_path(n: int = 2000):
+    rng = random.Random(3)
+    return [(-23.56 + 0.00004 * k, -46.65 + 0.00003 * k + 0.000005 * rng.random()) for k in range(n)]
+
+
+def test_simplify_stays_within_tolerance():
+    points = wiggly_path()
+    simplified = polyline.simplify(points, 5)
+
+    assert simplified[0] == points[0] and simplified[-1] == points[-1]
+    assert len(simplified) < len(points) / 20
+    distances, _ = point_to_polyline_distances(points, simplified)
+    assert distances.max() <= 5.01
+
+
+def test_simplify_keeps_corners():
+    corner = [(0.0, 0.0), (0.0, 0.001), (0.0, 0.002), (0.001, 0.002), (0.002, 0.002)]
+    assert polyline.simplify(corner, 1) == [(0.0, 0.0), (0.0, 0.002), (0.002, 0.002)]
+
+
+def test_merge_joins_legs_and_shrinks_payload():
+    points = wiggly_path()
+    legs = [polyline.encode(points[:1000]), polyline.encode(points[999:])]
+    tolerance = polyline.zoom_tolerance(16, points[0][0])
+
+    merged = polyline.merge(legs, tolerance)
+
+    assert math.isclose(tolerance, 2.19, abs_tol=0.01)
+    assert len(merged) < sum(map(len, legs)) / 10
+    decoded = polyline.decode(merged)
+    assert decoded[0] == polyline.decode(legs[0])[0] and decoded[-1] == polyline.decode(legs[1])[-1]
+    assert polyline.merge(legs) == polyline.join(legs)
+
+
+def curvy_path(n: int):
+    # Curvas de ~30m a cada ~150m: o quanto sobra depende do zoom
+    return [(-23.56 + 0.00004 * k, -46.65 + 0.0003 * math.sin(k / 40)) for k in range(n)]
+
+
+def dense_route(legs: int = 5, points_per_leg: int = 1500):
+    points = curvy_path(legs * points_per_leg + 1)
+    return [RouteLeg(
+        f"Parada {i}", "Rua A, 1", 600, 2000, "09:10", None,
+        {"lat": points[i * points_per_leg][0], "lng": points[i * points_per_leg][1]},
+        {"lat": points[(i + 1) * points_per_leg][0], "lng": points[(i + 1) * points_per_leg][1]},
+        polyline.encode(points[i * points_per_leg:(i + 1) * points_per_leg + 1]),
+    ) for i in range(legs)], points
+
+
+def serialized_size(request, route, body=None) -> int:
+    response = main.RouteResponse(
+        tasks=[], total_duration="1h", total_distance="10.0 km", warnings=[],
+        **(body or main.serialize_route(request, route))
+    )
+    return len(response.model_dump_json())
+
+
+def test_serialized_route_is_smaller_than_the_full_leg_geometry():
+    route, points = dense_route()
+    request = main.ErrandRequest(user_input="x", start_address="y", map_zoom=14)
+    # Formato anterior: polyline completa em cada trecho + rota juntada sem simplificar
+    full = {
+        "optimized_route": [{**leg.to_dict(), "polyline": leg.polyline} for leg in route],
+        "route_polyline": polyline.merge(leg.polyline for leg in route),
+    }
+
+    body = main.serialize_route(request, route)
+
+    assert all("polyline" not in leg for leg in body["optimized_route"])
+    assert serialized_size(request, route) < serialized_size(request, route, full) / 5
+    tolerance = polyline.zoom_tolerance(14, points[0][0])
+    distances, _ = point_to_polyline_distances(points[::50], polyline.decode(body["route_polyline"]))
+    assert distances.max() <= tolerance + 1  # +1m: arredondamento da codificação (1e-5 grau)
+
+
+def test_leg_polylines_are_opt_in_and_follow_the_client_zoom():
+    route, _ = dense_route(legs=2)
+    far = main.ErrandRequest(user_input="x", start_address="y", map_zoom=11, leg_polylines=True)
+    near = main.ErrandRequest(user_input="x", start_address="y", map_zoom=18, leg_polylines=True)
+
+    far_legs = main.serialize_route(far, route)["optimized_route"]
+    near_legs = main.serialize_route(near, route)["optimized_route"]
+
+    assert all(leg["polyline"] for leg in far_legs)
+    assert len(far_legs[0]["polyline"]) < len(near_legs[0]["polyline"]) <= len(route[0].polyline)
+    assert serialized_size(far, route) < serialized_size(near, route)
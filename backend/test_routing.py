@@ -0,0 +1,310 @@
+"""
+Testa a ordenação exata de paradas (routing.solve_exact_order) contra
+força bruta em instâncias pequenas aleatórias, as precedências da carona
+(embarque -> tarefas -> desembarque), os somatórios numéricos dos trechos
+(routing.RouteLeg) e, com um Maps de mentira, os blocos da Distance Matrix,
+o cache por célula e a divisão em segmentos do Directions.
+"""
+
+import asyncio
+import itertools
+import os
+import random
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+from cache import clear_cache, get_cache_stats
+from external import AsyncClient
+from routing import (
+    INF, MAX_MATRIX_ELEMENTS, MAX_MATRIX_SIDE, MAX_WAYPOINTS, SERVICE_SECONDS, RouteLeg, carpool_detours,
+    fetch_duration_matrix, fetch_route_legs, order_stops, precedence_masks, repair_order, solve_exact_order
+)
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("GOOGLE_MAPS_API_KEY", "AIzaTestKey")
+
+
+def brute_force(durations, deadlines, predecessors):
+    best_order, best_total = None, INF
+    for perm in itertools.permutations(range(len(deadlines))):
+        elapsed, current, visited, feasible = 0, 0, 0, True
+        for k in perm:
+            elapsed += durations[current][k + 1]
+            if predecessors[k] & ~visited or elapsed > deadlines[k]:
+                feasible = False
+                break
+            elapsed += SERVICE_SECONDS
+            current, visited = k + 1, visited | (1 << k)
+        if feasible and elapsed + durations[current][0] < best_total:
+            best_order, best_total = list(perm), elapsed + durations[current][0]
+    return best_order, best_total
+
+
+def route_total(durations, order):
+    elapsed, current = 0, 0
+    for k in order:
+        elapsed += durations[current][k + 1] + SERVICE_SECONDS
+        current = k + 1
+    return elapsed + durations[current][0]
+
+
+def random_instance(rng, n):
+    durations = [[0 if i == j else rng.randint(60, 1800) for j in range(n + 1)] for i in range(n + 1)]
+    deadlines = [rng.choice([INF, rng.randint(600, 6000)]) for _ in range(n)]
+    predecessors = [0] * n
+    if n > 2 and rng.random() < 0.5:
+        first = rng.randrange(n)
+        predecessors = [0 if k == first else 1 << first for k in range(n)]
+    return durations, deadlines, predecessors
+
+
+def test_exact_order_matches_brute_force():
+    rng = random.Random(7)
+    for _ in range(200):
+        durations, deadlines, predecessors = random_instance(rng, rng.randint(1, 6))
+        expected_order, expected_total = brute_force(durations, deadlines, predecessors)
+        order = solve_exact_order(durations, deadlines, predecessors)
+
+        assert (order is None) == (expected_order is None)
+        if order is not None:
+            assert route_total(durations, order) == expected_total
+
+
+def test_exact_order_twelve_stops_in_milliseconds():
+    rng = random.Random(11)
+    durations, _, _ = random_instance(rng, 12)
+
+    started = time.perf_counter()
+    order = solve_exact_order(durations, [INF] * 12, [0] * 12)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    assert sorted(order) == list(range(12))
+    assert elapsed_ms < 200
+
+
+def carpool_stop(person=None, stop_type=None, constraint=None):
+    return SimpleNamespace(person=person, stop_type=stop_type, constraint=constraint, closing_time=None)
+
+
+def test_carpool_pickup_before_errands_before_dropoff():
+    rng = random.Random(3)
+    tasks = [
+        carpool_stop(), carpool_stop(),
+        carpool_stop("Maria", "dropoff"), carpool_stop("Maria"), carpool_stop("Maria", "pickup"),
+        carpool_stop("João", "dropoff"), carpool_stop("João", "pickup"),
+    ]
+    durations, _, _ = random_instance(rng, len(tasks))
+    start = datetime(2025, 1, 6, 9, 0)
+
+    def check(order):
+        position = {k: i for i, k in enumerate(order)}
+        assert sorted(order) == list(range(len(tasks)))
+        assert position[4] < position[3] < position[2]  # Maria: embarque, tarefa, desembarque
+        assert position[6] < position[5]
+
+    check(order_stops(tasks, durations, start))
+    check(repair_order(list(range(len(tasks))), precedence_masks(tasks)))
+
+    detours = carpool_detours(tasks, durations, start)
+    assert set(detours) == {"Maria", "João"}
+    assert all(seconds >= 0 for seconds in detours.values())
+
+
+def test_rider_last_errand_stays_inside_the_ride():
+    # "pão na volta" da Ana: last dentro da carona dela, não da rota toda
+    tasks = [
+        carpool_stop(constraint="urgent"),  # banco do motorista
+        carpool_stop("Ana", "pickup"), carpool_stop("Ana", "dropoff"),
+        carpool_stop("Ana", constraint="last"), carpool_stop("Ana"),
+        carpool_stop(constraint="last"),  # última tarefa do motorista
+    ]
+    durations, _, _ = random_instance(random.Random(5), len(tasks))
+    start = datetime(2025, 1, 6, 9, 0)
+    masks = precedence_masks(tasks)
+
+    assert solve_exact_order(durations, [INF] * len(tasks), masks) is not None
+    for order in (order_stops(tasks, durations, start), repair_order([0, 3, 1, 2, 4, 5], masks)):
+        position = {k: i for i, k in enumerate(order)}
+        assert position[1] < position[4] < position[3] < position[2]  # embarque, tarefa, padaria, desembarque
+        assert order[-1] == 5
+
+
+def route_leg(task, seconds, meters):
+    point = {"lat": -23.56, "lng": -46.65}
+    return RouteLeg(task, "Rua A, 1", seconds, meters, "09:00", None, point, point, "")
+
+
+def test_route_legs_sum_numbers_and_format_only_on_serialization():
+    import main
+    from features import add_rest_stops, check_calendar_conflicts
+
+    route = [route_leg("Banco", 3000, 25_400), route_leg("Farmácia", 1080, 850), route_leg("Retornar para casa", 600, 3000)]
+
+    duration, distance, seconds, meters = main.calculate_totals(route)
+    assert (seconds, meters) == (3000 + 1080 + 2 * SERVICE_SECONDS, 26_250)
+    assert (duration, distance) == ("1h 28min", "26.2 km")
+    assert route[0].to_dict()["duration"] == "50min" and route[1].to_dict()["distance"] == "850 m"
+
+    # Antes, "1h 28min" quebrava o parse do texto no calendário
+    calendar = check_calendar_conflicts({"total_duration_s": seconds}, [{"time": "14:00", "title": "Dentista"}])
+    assert calendar["conflicts"][0]["conflict_level"] == "low"
+
+    rest = add_rest_stops(route, max_driving_time=60)
+    assert [s["after_stop"] for s in rest["rest_suggestions"]] == ["Farmácia"]
+    assert rest["total_driving_time"] == "78 min"
+
+
+def grid_points(n):
+    return [{"lat": -23.50 - 0.01 * (i // 8), "lng": -46.60 - 0.01 * (i % 8)} for i in range(n)]
+
+
+def fake_seconds(a, b):
+    return int(abs(a["lat"] - b["lat"]) * 1e5 + abs(a["lng"] - b["lng"]) * 1e5)
+
+
+class FakeMaps:
+    """Distance Matrix e Directions determinísticos; guarda o tamanho de cada chamada"""
+
+    def __init__(self):
+        self.matrix_calls = []
+        self.directions_calls = []
+
+    def distance_matrix(self, origins=None, destinations=None, **params):
+        self.matrix_calls.append((len(origins), len(destinations)))
+        return {"rows": [{"elements": [
+            {"status": "OK", "duration": {"value": fake_seconds(o, d)}, "distance": {"value": 10 * fake_seconds(o, d)}}
+            for d in destinations
+        ]} for o in origins]}
+
+    def directions(self, origin=None, destination=None, waypoints=None, **params):
+        stops = [origin] + list(waypoints or []) + [destination]
+        self.directions_calls.append(len(waypoints or []))
+        return [{"legs": [{
+            "duration": {"value": fake_seconds(a, b)},
+            "distance": {"value": 10 * fake_seconds(a, b)},
+            "start_location": a,
+            "end_location": b,
+            "steps": [],
+        } for a, b in zip(stops, stops[1:])]}]
+
+
+def test_matrix_blocks_respect_api_limits_and_fill_every_pair():
+    clear_cache()
+    maps = FakeMaps()
+    points = grid_points(60)
+
+    durations, distances = asyncio.run(fetch_duration_matrix(AsyncClient(maps), points))
+
+    assert len(maps.matrix_calls) > 1
+    assert all(rows * cols <= MAX_MATRIX_ELEMENTS for rows, cols in maps.matrix_calls)
+    assert all(rows <= MAX_MATRIX_SIDE and cols <= MAX_MATRIX_SIDE for rows, cols in maps.matrix_calls)
+    assert sum(rows * cols for rows, cols in maps.matrix_calls) == 60 * 60
+    assert all(
+        durations[i][j] == fake_seconds(a, b) and distances[i][j] == 10 * fake_seconds(a, b)
+        for i, a in enumerate(points) for j, b in enumerate(points) if i != j
+    )
+
+
+def test_matrix_fetches_only_cells_missing_from_cache():
+    clear_cache()
+    maps = FakeMaps()
+    points = grid_points(8)
+    asyncio.run(fetch_duration_matrix(AsyncClient(maps), points))
+    maps.matrix_calls.clear()
+
+    again = asyncio.run(fetch_duration_matrix(AsyncClient(maps), points))
+    assert maps.matrix_calls == []
+    assert again[0][0][1] == fake_seconds(points[0], points[1])
+
+    # Um ponto novo: um único bloco cobre as linhas e colunas com células faltando
+    extended = points + [{"lat": -23.70, "lng": -46.70}]
+    durations, _ = asyncio.run(fetch_duration_matrix(AsyncClient(maps), extended))
+    assert maps.matrix_calls == [(9, 9)]
+    assert durations[8][0] == fake_seconds(extended[8], extended[0])
+
+
+def test_route_over_waypoint_limit_is_split_and_legs_stay_aligned():
+    clear_cache()
+    maps = FakeMaps()
+    origin, *stops = grid_points(41)
+    destination = origin
+
+    legs = asyncio.run(fetch_route_legs(AsyncClient(maps), origin, stops, destination))
+
+    assert len(maps.directions_calls) == 2
+    assert all(waypoints <= MAX_WAYPOINTS for waypoints in maps.directions_calls)
+    # Um trecho por tarefa, na ordem: o trecho k termina na parada k
+    assert len(legs) == len(stops) + 1
+    assert [leg["end_location"] for leg in legs] == stops + [destination]
+    assert all(a["end_location"] == b["start_location"] for a, b in zip(legs, legs[1:]))
+
+    maps.directions_calls.clear()
+    assert asyncio.run(fetch_route_legs(AsyncClient(maps), origin, stops, destination)) == legs
+    assert maps.directions_calls == []
+
+
+def prefix_hits(prefix):
+    return get_cache_stats()["by_prefix"].get(prefix, {}).get("hits", 0)
+
+
+def test_nearby_points_and_departures_in_the_same_window_share_cached_legs():
+    clear_cache()
+    maps = FakeMaps()
+    origin, *stops = grid_points(4)
+    # ~2m de diferença e 5 minutos depois: mesma chave de cache (coordenadas e janela de 15min)
+    nudged = [{"lat": p["lat"] + 0.00002, "lng": p["lng"]} for p in stops]
+    departure = datetime(2026, 3, 2, 9, 0)
+    later = datetime(2026, 3, 2, 9, 5)
+
+    asyncio.run(fetch_route_legs(AsyncClient(maps), origin, stops, origin, departure_time=departure))
+    leg_hits = prefix_hits("route_leg")
+    asyncio.run(fetch_route_legs(AsyncClient(maps), origin, nudged, origin, departure_time=later))
+
+    assert len(maps.directions_calls) == 1
+    assert prefix_hits("route_leg") - leg_hits == len(stops) + 1
+
+    # Outro modo ou outra janela de horário não reaproveitam o trecho
+    asyncio.run(fetch_route_legs(AsyncClient(maps), origin, stops, origin, mode="walking"))
+    asyncio.run(fetch_route_legs(AsyncClient(maps), origin, stops, origin,
+                                 departure_time=datetime(2026, 3, 2, 9, 20)))
+    assert len(maps.directions_calls) == 3
+
+
+def test_matrix_cells_are_cache_hits_for_the_next_request():
+    clear_cache()
+    maps = FakeMaps()
+    points = grid_points(5)
+
+    asyncio.run(fetch_duration_matrix(AsyncClient(maps), points, avoid="tolls"))
+    cell_hits = prefix_hits("route_matrix")
+    asyncio.run(fetch_duration_matrix(AsyncClient(maps), points, avoid=["tolls"]))
+
+    assert len(maps.matrix_calls) == 1
+    assert prefix_hits("route_matrix") - cell_hits == 5 * 4
+
+    asyncio.run(fetch_duration_matrix(AsyncClient(maps), points))  # sem avoid: outra chave
+    assert len(maps.matrix_calls) == 2
+
+
+def test_delivery_mode_keeps_carpool_precedence_and_detours(monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "gmaps_async", AsyncClient(FakeMaps()))
+    clear_cache()
+    points = grid_points(5)
+    tasks = [
+        main.Task(name="Deixar Ana", lat=points[1]["lat"], lng=points[1]["lng"], person="Ana", stop_type="dropoff"),
+        main.Task(name="padaria", lat=points[2]["lat"], lng=points[2]["lng"], person="Ana", constraint="last"),
+        main.Task(name="Buscar Ana", lat=points[3]["lat"], lng=points[3]["lng"], person="Ana", stop_type="pickup"),
+        main.Task(name="banco", lat=points[4]["lat"], lng=points[4]["lng"]),
+    ]
+
+    route, warnings, detours = asyncio.run(main.optimize_route_with_constraints(
+        tasks, points[0], "09:00", delivery_mode=True
+    ))
+
+    names = [leg.task for leg in route]
+    assert names.index("Buscar Ana") < names.index("padaria (Ana)") < names.index("Deixar Ana")
+    assert set(detours) == {"Ana"}
+    assert any("Modo Entregador ignorado" in w for w in warnings)
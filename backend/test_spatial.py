@@ -0,0 +1,195 @@
+"""
+Testa o índice espacial de POIs (spatial.POIIndex): busca no corredor contra
+força bruta, dump regional, precisão pelo raio, limite e expiração do índice
+e o aquecimento por célula em find_nearby_points_of_interest (uma busca
+externa por célula do corredor e tipo)
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("GOOGLE_MAPS_API_KEY", "AIzaTestKey")
+
+import main  # noqa: E402
+import polyline  # noqa: E402
+from geo import geohash_encode  # noqa: E402
+from cache import clear_cache  # noqa: E402
+from external import AsyncClient  # noqa: E402
+from routing import RouteLeg  # noqa: E402
+import pytest  # noqa: E402
+from spatial import POIIndex, point_to_polyline_distances, precision_for_radius  # noqa: E402
+
+ROUTE = [(-23.5610, -46.6560), (-23.5570, -46.6620), (-23.5480, -46.6380), (-23.5630, -46.6300)]
+
+
+def random_index(n: int, seed: int = 7) -> POIIndex:
+    rng = random.Random(seed)
+    index = POIIndex()
+    for i in range(n):
+        index.add({
+            "place_id": f"p{i}",
+            "name": f"POI {i}",
+            "types": [rng.choice(["gas_station", "cafe", "pharmacy"])],
+            "location": {"lat": -23.60 + rng.random() * 0.08, "lng": -46.70 + rng.random() * 0.10},
+        })
+    return index
+
+
+def test_corridor_matches_brute_force():
+    index = random_index(3000)
+    found = index.corridor(ROUTE, 400, ["gas_station"])
+
+    every = [p for grid in index._grid["gas_station"].values() for p in grid.values()]
+    distances, _ = point_to_polyline_distances(
+        [(p["location"]["lat"], p["location"]["lng"]) for p in every], ROUTE
+    )
+    expected = {p["place_id"] for p, d in zip(every, distances) if d <= 400}
+
+    assert expected and {p["place_id"] for p in found} == expected
+    assert all("gas_station" in p["types"] and p["distance_m"] <= 400 for p in found)
+    assert [p["segment"] for p in found] == sorted(p["segment"] for p in found)
+
+
+def test_corridor_query_is_in_memory_and_fast():
+    index = random_index(3000)
+    index.corridor(ROUTE, 400, ["cafe"])
+
+    started = time.perf_counter()
+    for _ in range(100):
+        index.corridor(ROUTE, 400, ["cafe"])
+    assert (time.perf_counter() - started) / 100 < 0.001
+
+
+def test_load_dump_json_lines(tmp_path):
+    dump = tmp_path / "pois.jsonl"
+    dump.write_text("\n".join(json.dumps(row) for row in [
+        {"place_id": "a", "name": "Posto A", "types": ["gas_station"], "lat": -23.5590, "lng": -46.6590},
+        {"place_id": "b", "name": "Café B", "types": ["cafe"], "lat": -23.5000, "lng": -46.6000},
+    ]))
+    index = POIIndex()
+
+    assert index.load_dump(str(dump)) == 2
+    assert index.authoritative_types == {"gas_station", "cafe"}
+    assert [p["name"] for p in index.corridor(ROUTE, 300)] == ["Posto A"]
+
+
+def test_precision_follows_the_radius():
+    assert precision_for_radius(500) == 6
+    assert precision_for_radius(700) == 5  # precisão 6 só cobre ~600m
+
+    with pytest.raises(ValueError):
+        POIIndex(precision=6).corridor(ROUTE, 2000)
+    assert POIIndex(precision=precision_for_radius(2000)).corridor(ROUTE, 2000) == []
+
+
+def place(i: int, lat: float = -23.5590, lng: float = -46.6590) -> dict:
+    return {"place_id": f"p{i}", "name": f"Posto {i}", "types": ["gas_station"],
+            "geometry": {"location": {"lat": lat, "lng": lng}}}
+
+
+def test_index_is_bounded_and_keeps_the_dump(tmp_path):
+    dump = tmp_path / "pois.jsonl"
+    dump.write_text(json.dumps({"place_id": "d", "name": "Dump", "types": ["gas_station"],
+                                "lat": -23.5590, "lng": -46.6590}))
+    index = POIIndex(max_entries=2)
+    index.load_dump(str(dump))
+    index.add_places_results([place(i) for i in range(3)])
+
+    names = {p["name"] for p in index.corridor(ROUTE, 300)}
+    assert len(index) == 3 and names == {"Dump", "Posto 1", "Posto 2"}
+
+
+def test_searched_pois_expire_with_the_cache_ttl():
+    index = POIIndex(ttl=0)
+    index.add_places_results([place(1)], warmed=("6gycf", "gas_station"))
+
+    assert index.corridor(ROUTE, 300) == []
+    assert len(index) == 0 and not index.is_warm("6gycf", "gas_station")
+
+    index = POIIndex()
+    index.add_places_results([place(1)], warmed=("6gycf", "gas_station"))
+    assert len(index.corridor(ROUTE, 300)) == 1 and index.is_warm("6gycf", "gas_station")
+
+
+class NearbyMaps:
+    """places_nearby que devolve um posto no centro pedido e conta as chamadas"""
+
+    def __init__(self):
+        self.calls = []
+
+    def places_nearby(self, location=None, radius=None, type=None, **kwargs):
+        self.calls.append((location, type))
+        lat, lng = location
+        return {"results": [{
+            "place_id": f"{type}-{lat:.4f}-{lng:.4f}",
+            "name": f"Posto {len(self.calls)}",
+            "types": [type, "point_of_interest"],
+            "geometry": {"location": {"lat": lat, "lng": lng}},
+        }]}
+
+
+def make_route():
+    stops = [("Banco", ROUTE[0], ROUTE[1]), ("Farmácia", ROUTE[1], ROUTE[2]), ("Retornar para casa", ROUTE[2], ROUTE[3])]
+    return [RouteLeg(
+        task, None, 600, 2000, "09:10", None,
+        {"lat": a[0], "lng": a[1]}, {"lat": b[0], "lng": b[1]}, polyline.encode([a, b])
+    ) for task, a, b in stops]
+
+
+def test_nearby_points_warm_corridor_cells_once_and_keep_output_shape(monkeypatch):
+    clear_cache()
+    maps = NearbyMaps()
+    index = POIIndex(precision_for_radius(main.NEARBY_POI_RADIUS))
+    monkeypatch.setattr(main, "gmaps_async", AsyncClient(maps))
+    monkeypatch.setattr(main, "poi_index", index)
+    monkeypatch.setattr(main, "NEARBY_POI_WARM_BUDGET", 1000)
+
+    first = asyncio.run(main.find_nearby_points_of_interest(make_route()))
+    calls = len(maps.calls)
+    second = asyncio.run(main.find_nearby_points_of_interest(make_route()))
+
+    # Uma busca por célula que o corredor alcança (não só o meio de cada trecho)
+    cells = index.corridor_cells(ROUTE, main.NEARBY_POI_RADIUS)
+    assert calls == len(cells) > len(make_route())
+    assert len(maps.calls) == calls  # células já aquecidas: nenhuma busca nova
+    assert first == second and 0 < len(first) <= 3
+    assert set(first[0]) == {"name", "type", "location", "between"}
+    assert first[0]["type"] == "Posto de gasolina"
+
+
+def test_warm_budget_caps_searches_per_plan_nearest_midpoints_first(monkeypatch):
+    clear_cache()
+    maps = NearbyMaps()
+    index = POIIndex(precision_for_radius(main.NEARBY_POI_RADIUS))
+    monkeypatch.setattr(main, "gmaps_async", AsyncClient(maps))
+    monkeypatch.setattr(main, "poi_index", index)
+    monkeypatch.setattr(main, "NEARBY_POI_WARM_BUDGET", 2)
+
+    asyncio.run(main.find_nearby_points_of_interest(make_route()))
+
+    assert len(maps.calls) == 2
+    midpoints = [((a[0] + b[0]) / 2, (a[1] + b[1]) / 2) for a, b in zip(ROUTE, ROUTE[1:])]
+    warmed = [geohash_encode(lat, lng, index.precision) for (lat, lng), _ in maps.calls]
+    assert set(warmed) <= {geohash_encode(lat, lng, index.precision) for lat, lng in midpoints}
+
+    # O plano seguinte aquece as próximas células frias
+    asyncio.run(main.find_nearby_points_of_interest(make_route()))
+    assert len(maps.calls) == 4 and len(set(geohash_encode(lat, lng, index.precision)
+                                            for (lat, lng), _ in maps.calls)) == 4
+
+
+def test_radius_the_grid_cannot_cover_skips_nearby_points(monkeypatch):
+    maps = NearbyMaps()
+    monkeypatch.setattr(main, "gmaps_async", AsyncClient(maps))
+    monkeypatch.setattr(main, "poi_index", POIIndex(precision_for_radius(main.NEARBY_POI_RADIUS)))
+    polar = [RouteLeg(
+        "Farol", None, 600, 2000, "09:10", None,
+        {"lat": 78.22, "lng": 15.63}, {"lat": 78.23, "lng": 15.70}, ""
+    ), *make_route()[1:]]
+
+    assert asyncio.run(main.find_nearby_points_of_interest(polar)) == []
+    assert maps.calls == []
@@ -8,6 +8,7 @@ import SkeletonLoader from './components/SkeletonLoader'
 import { useTheme } from './hooks/useTheme'
 import { useGeolocation } from './hooks/useGeolocation'
 import { useScrollReveal } from './hooks/useScrollReveal'
+import { ROUTE_MAP_ZOOM } from './utils/mapStyles'
 import axios from 'axios'
 import './App.css'
 import './styles/glassmorphism.css'
@@ -65,7 +66,8 @@ function App() {
         mode: mode,
         suggest_best_time: suggestBestTime,
         delivery_mode: deliveryMode,
-        carpooling: carpooling.length > 0 ? carpooling : null
+        carpooling: carpooling.length > 0 ? carpooling : null,
+        map_zoom: ROUTE_MAP_ZOOM
       })
 
       setLoadingStep('complete')
@@ -437,7 +439,7 @@ function App() {
                     <SkeletonLoader type="map" />
                   </div>
                 }>
-                  <MapView route={result.optimized_route} nearbyPoints={result.nearby_points} />
+                  <MapView route={result.optimized_route} routePolyline={result.route_polyline} nearbyPoints={result.nearby_points} />
                 </Suspense>
               </div>
             </div>
@@ -12,7 +12,7 @@ function BentoResults({ result }) {
     <div className="bento-container">
       {/* Mapa Grande - Item Principal */}
       <div className="bento-item bento-map glass-card">
-        <MapView route={result.optimized_route} nearbyPoints={result.nearby_points} />
+        <MapView route={result.optimized_route} routePolyline={result.route_polyline} nearbyPoints={result.nearby_points} />
       </div>
 
       {/* Stats Rápidos */}
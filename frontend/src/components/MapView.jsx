@@ -1,7 +1,7 @@
 import { GoogleMap, LoadScript, Marker, Polyline, InfoWindow } from '@react-google-maps/api'
 import { useState, useEffect } from 'react'
 import polyline from '@mapbox/polyline'
-import { lightMapStyles, darkMapStyles, getMarkerIcon } from '../utils/mapStyles'
+import { lightMapStyles, darkMapStyles, getMarkerIcon, ROUTE_MAP_ZOOM } from '../utils/mapStyles'
 
 const containerStyle = {
   width: '100%',
@@ -9,7 +9,7 @@ const containerStyle = {
   borderRadius: '12px'
 }
 
-function MapView({ route, nearbyPoints }) {
+function MapView({ route, routePolyline, nearbyPoints }) {
   const [selectedMarker, setSelectedMarker] = useState(null)
   const [map, setMap] = useState(null)
   const [isDark, setIsDark] = useState(false)
@@ -38,17 +38,17 @@ function MapView({ route, nearbyPoints }) {
   }, [])
 
   // Decode polylines and create path
-  const paths = route.map(leg => {
-    if (leg.polyline) {
-      try {
-        const decoded = polyline.decode(leg.polyline)
-        return decoded.map(([lat, lng]) => ({ lat, lng }))
-      } catch (e) {
-        return []
-      }
+  // A rota inteira vem em route_polyline; polylines por trecho só se pedidas (leg_polylines)
+  const decodePath = (encoded) => {
+    try {
+      return polyline.decode(encoded).map(([lat, lng]) => ({ lat, lng }))
+    } catch (e) {
+      return []
     }
-    return []
-  }).flat()
+  }
+  const paths = routePolyline
+    ? decodePath(routePolyline)
+    : route.map(leg => (leg.polyline ? decodePath(leg.polyline) : [])).flat()
 
   // Get all markers
   const markers = route
@@ -119,7 +119,7 @@ function MapView({ route, nearbyPoints }) {
       <GoogleMap
         mapContainerStyle={containerStyle}
         center={center}
-        zoom={13}
+        zoom={ROUTE_MAP_ZOOM}
         onLoad={onLoad}
         options={mapOptions}
       >
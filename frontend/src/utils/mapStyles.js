@@ -1,4 +1,8 @@
 // Melhoria #16: Tema customizado para Google Maps
+
+// Zoom inicial do mapa; enviado ao backend como map_zoom para simplificar a rota
+export const ROUTE_MAP_ZOOM = 13
+
 // Light theme
 export const lightMapStyles = [
   {